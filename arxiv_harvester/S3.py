@@ -1,10 +1,17 @@
 import os
+import threading
 from boto3 import client
+from botocore.exceptions import ClientError
+
+# parallel listing by partitions
+import arxiv_harvester.listing as listing
+
+# bandwidth limits shared by the harvesting processes
+from arxiv_harvester import bandwidth
 
 # logging
 import logging
 import logging.handlers
-logging.basicConfig(filename='harvester.log', filemode='w', level=logging.ERROR)
 
 '''
 Note: we probably should manage retry
@@ -20,6 +27,11 @@ class S3(object):
             region = "us-west-2"
         self.bucket_name = self.config['bucket_name']
 
+        # for requester-pays buckets, like the arXiv source bucket
+        self.extra_args = {}
+        if 'requester_pays' in self.config and self.config['requester_pays']:
+            self.extra_args['RequestPayer'] = 'requester'
+
         if 'aws_end_point' in self.config and len(self.config['aws_end_point'])>1:
             # for non-AWS S3 compatible storage, e.g. OVHCloud
             end_point = self.config['aws_end_point']
@@ -35,12 +47,17 @@ class S3(object):
                             aws_access_key_id=self.config['aws_access_key_id'],
                             aws_secret_access_key=self.config['aws_secret_access_key'])
 
+        # conditional headers of the next put_object() of the current thread, see put_object_conditional()
+        self._conditional = threading.local()
+        self.conn.meta.events.register('before-sign.s3.PutObject', self._add_conditional_headers)
+
     def upload_file_to_s3(self, file_path, dest_path=None, storage_class='STANDARD_IA'):
         """
         Upload the given file to s3 using a managed uploader, which will split up large
         files automatically and upload parts in parallel.
         By default, files are stored with the class standard infrequent access. 
         Possible storage classes are: STANDARD, STANDARD_IA, REDUCED_REDUNDANCY or ONEZONE_IA
+        Return True if the upload succeeded.
         """
         s3_client = self.conn
         file_name = file_path.split('/')[-1]
@@ -52,9 +69,33 @@ class S3(object):
         else:
             full_path = file_name
         try:
-            s3_client.upload_file(file_path, self.bucket_name, full_path, ExtraArgs={"Metadata": {"StorageClass": storage_class}})
+            s3_client.upload_file(file_path, self.bucket_name, full_path, ExtraArgs={"Metadata": {"StorageClass": storage_class}},
+                                  Callback=bandwidth.governor.callback("egress"))
         except Exception as e: 
             logging.exception('Could not upload file ' + file_path)    
+            return False
+        return True
+
+    def upload_fileobj_to_s3(self, fileobj, file_name, dest_path=None, storage_class='STANDARD_IA'):
+        """
+        Upload the content of a file object to s3 under the given file name, using the managed uploader 
+        as upload_file_to_s3(), return True if the upload succeeded
+        """
+        s3_client = self.conn
+        if dest_path:
+            if dest_path.endswith("/"):
+                full_path = dest_path + file_name
+            else:
+                full_path = dest_path + "/" + file_name
+        else:
+            full_path = file_name
+        try:
+            s3_client.upload_fileobj(fileobj, self.bucket_name, full_path, ExtraArgs={"Metadata": {"StorageClass": storage_class}},
+                                     Callback=bandwidth.governor.callback("egress"))
+        except Exception as e: 
+            logging.exception('Could not upload file ' + full_path)    
+            return False
+        return True
 
     def upload_object(self, body, s3_key, storage_class='STANDARD_IA'):
         """
@@ -72,32 +113,176 @@ class S3(object):
         s3_client = self.conn
         file_name = os.path.basename(file_path)
         try:
-            s3_client.download_file(self.bucket_name, file_path, dest_path)
+            s3_client.download_file(self.bucket_name, file_path, dest_path, ExtraArgs=self.extra_args,
+                                    Callback=bandwidth.governor.callback("ingress"))
         except Exception as e: 
             logging.exception('Could not download file: ' + file_path)
             return None
         
         return dest_path
 
+    def get_object_stream(self, file_path):
+        """
+        Return a file-like object streaming the content of a file given a S3 path, to be read 
+        sequentially and closed by the caller, or None if the object cannot be accessed
+        """
+        try:
+            response = self.conn.get_object(Bucket=self.bucket_name, Key=file_path, **self.extra_args)
+            return bandwidth.ThrottledReader(response['Body'], "ingress")
+        except Exception as e:
+            logging.exception('Could not access file: ' + file_path)
+            return None
+
+    def get_object_range(self, file_path, start, end):
+        """
+        Return the bytes of an object between the offsets start and end (inclusive) given its S3 path,
+        with a ranged GET, or None if the object cannot be accessed
+        """
+        try:
+            response = self.conn.get_object(Bucket=self.bucket_name, Key=file_path, Range="bytes=%d-%d" % (start, end), **self.extra_args)
+            data = response['Body'].read()
+            bandwidth.throttle("ingress", len(data))
+            return data
+        except Exception as e:
+            logging.exception('Could not access range of file: ' + file_path)
+            return None
+
+    def get_object_size(self, file_path):
+        """
+        Return the size in bytes of an object given its S3 path, or None if not available 
+        """
+        try:
+            response = self.conn.head_object(Bucket=self.bucket_name, Key=file_path, **self.extra_args)
+            return response['ContentLength']
+        except Exception as e:
+            logging.exception('Could not get object metadata: ' + file_path)
+            return None
+
+    def get_object_head(self, file_path):
+        """
+        Return the metadata of an object given its S3 path as a dict with its size, ETag and server 
+        side encryption, or None if not available 
+        """
+        try:
+            response = self.conn.head_object(Bucket=self.bucket_name, Key=file_path, **self.extra_args)
+            return {"size": response['ContentLength'], "etag": response['ETag'].strip('"'), "encryption": response.get('ServerSideEncryption')}
+        except Exception as e:
+            logging.exception('Could not get object metadata: ' + file_path)
+            return None
+
+    def get_object_etag(self, file_path):
+        """
+        Return the ETag of an object given its S3 path, to detect changes, or None if not available 
+        """
+        try:
+            response = self.conn.head_object(Bucket=self.bucket_name, Key=file_path, **self.extra_args)
+            return response['ETag'].strip('"')
+        except Exception as e:
+            logging.exception('Could not get object metadata: ' + file_path)
+            return None
+
+    def get_object_with_etag(self, file_path):
+        """
+        Return the content and the ETag of a small object given its S3 path, or (None, None) if the
+        object does not exist. Other errors are raised to the caller.
+        """
+        try:
+            response = self.conn.get_object(Bucket=self.bucket_name, Key=file_path, **self.extra_args)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ["NoSuchKey", "404"]:
+                return None, None
+            raise
+        return response['Body'].read(), response['ETag'].strip('"')
+
+    def put_object_conditional(self, file_path, body, if_match=None, if_none_match=False):
+        """
+        Write a small object only if its current ETag is if_match, or only if it does not exist
+        with if_none_match (S3 conditional writes). Return the new ETag, or None if the condition
+        does not hold because the object was changed concurrently. Other errors are raised to the
+        caller.
+        """
+        headers = {}
+        if if_match is not None:
+            headers['If-Match'] = '"' + if_match + '"'
+        if if_none_match:
+            headers['If-None-Match'] = '*'
+        self._conditional.headers = headers
+        try:
+            response = self.conn.put_object(Bucket=self.bucket_name, Key=file_path, Body=body)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ["PreconditionFailed", "ConditionalRequestConflict", "412", "409"]:
+                return None
+            raise
+        finally:
+            self._conditional.headers = None
+        return response['ETag'].strip('"')
+
+    def _add_conditional_headers(self, request, **kwargs):
+        # the conditional headers are added to the request directly, as they are not supported as
+        # parameters by all the boto3 versions
+        headers = getattr(self._conditional, "headers", None)
+        if headers:
+            for key, value in headers.items():
+                request.headers[key] = value
+
     def get_s3_list(self, dir_name):
         """
-        Return all contents of a given dir in s3.
-        Goes through the pagination to obtain all file names, so possibly super inefficient
+        Return the file names of all the contents of a given dir in s3.
+        For large buckets, prefer the generator iter_s3_list() which lists partitions in parallel
+        and does not hold the whole listing in memory.
         """
         dir_name = dir_name.split('tmp/')[-1]
-        paginator = self.conn.get_paginator('list_objects')
+        bucket_object_list = []
+        for key, size, etag in self.iter_objects(dir_name):
+            bucket_object_list.append(key.split('/')[-1])
+        return bucket_object_list
+
+    def iter_s3_list(self, prefixes=None, nb_threads=16):
+        """
+        Iterate over the objects of the bucket, yielding (full key, size, etag).
+        The listing is partitioned by the given prefixes (e.g. ["arxiv/1501/", "arxiv/1502/"]), which 
+        are listed in parallel. By default, the partitions are the collection/YYMM prefixes present in 
+        the bucket.
+        """
+        if prefixes is None:
+            prefixes = listing.list_partitions(self)
+        return listing.iter_parallel(self, prefixes, nb_threads=nb_threads)
+
+    def list_dirs(self, dir_name):
+        """
+        Return the sub-directories (common prefixes) directly under a given dir in s3, 
+        e.g. "arxiv/" -> ["arxiv/0704/", "arxiv/0705/", ...]
+        """
+        paginator = self.conn.get_paginator('list_objects_v2')
         s3_results = paginator.paginate(
             Bucket=self.bucket_name,
             Prefix=dir_name,
-            PaginationConfig={'PageSize': 1000}
+            Delimiter="/",
+            PaginationConfig={'PageSize': 1000},
+            **self.extra_args
+        )
+        dirs = []
+        for page in s3_results:
+            if "CommonPrefixes" in page:
+                for common_prefix in page["CommonPrefixes"]:
+                    dirs.append(common_prefix["Prefix"])
+        return dirs
+
+    def iter_objects(self, dir_name):
+        """
+        Iterate over all the objects under a given dir in s3, yielding (full key, size, etag) 
+        """
+        paginator = self.conn.get_paginator('list_objects_v2')
+        s3_results = paginator.paginate(
+            Bucket=self.bucket_name,
+            Prefix=dir_name,
+            PaginationConfig={'PageSize': 1000},
+            **self.extra_args
         )
-        bucket_object_list = []
         for page in s3_results:
             if "Contents" in page:
                 for key in page["Contents"]:
-                    s3_file_name = key['Key'].split('/')[-1]
-                    bucket_object_list.append(s3_file_name)
-        return bucket_object_list
+                    yield key['Key'], key['Size'], key['ETag'].strip('"')
 
     def remove_file(self, file_path):
         """
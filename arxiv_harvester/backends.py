@@ -0,0 +1,48 @@
+"""
+Registry of the storage backends, loaded on demand.
+
+The client libraries of the backends (boto3, swiftclient/keystoneclient, huggingface_hub) are
+slow to import and large in memory, so the module of a backend is imported only when the config
+actually selects it. A command line which does not use a backend, or only prints its help, does
+not pay for it.
+"""
+
+import importlib
+
+# backend name -> (module, class)
+BACKENDS = {
+    "s3": ("arxiv_harvester.S3", "S3"),
+    "swift": ("arxiv_harvester.swift", "Swift"),
+    "hf": ("arxiv_harvester.hf", "HuggingFace"),
+    "local": ("arxiv_harvester.local", "Local"),
+}
+
+def is_configured(name, config):
+    '''
+    Return True if the backend of the given name is selected by the config
+    '''
+    if name == "s3":
+        return "bucket_name" in config and len(config["bucket_name"].strip()) > 0
+    elif name == "swift":
+        return "swift" in config and len(config["swift"]) > 0 and "swift_container" in config and len(config["swift_container"]) > 0
+    elif name == "hf":
+        return "hf_repo_id" in config and len(config["hf_repo_id"].strip()) > 0
+    elif name == "local":
+        return True
+    return False
+
+def load(name, config):
+    '''
+    Import the module of a backend and return a new instance of the backend for the config
+    '''
+    module_name, class_name = BACKENDS[name]
+    module = importlib.import_module(module_name)
+    return getattr(module, class_name)(config)
+
+def get_backend(name, config):
+    '''
+    Return an instance of the backend of the given name if it is selected by the config, None otherwise
+    '''
+    if not is_configured(name, config):
+        return None
+    return load(name, config)
@@ -0,0 +1,227 @@
+"""
+Bandwidth limits of the harvesting, shared by all the threads of a process and by all the processes
+on the same machine.
+
+The network transfers are accounted in two directions, "ingress" (downloads: PDF files from GCS,
+arXiv source archives and objects from S3 or SWIFT) and "egress" (uploads to S3, SWIFT and
+HuggingFace), each one limited by a token bucket:
+
+- "bandwidth_ingress" and "bandwidth_egress": limits in bytes per second (default none),
+- "bandwidth_burst": seconds of transfer at the limit which can be accumulated when idle (default 1),
+- "bandwidth_schedule": limits for periods of the day (local time) overriding the above ones, e.g.
+  [{"from": "22:00", "to": "07:00", "ingress": null, "egress": null}] for no limit at night. A
+  period can span midnight, the first matching period is used.
+
+The state of the token buckets is kept in a small file locked by the processes ("bandwidth_path",
+default data_path/bandwidth.state), so that all the harvesting processes using the same file share
+the same limits, e.g. the harvesting of PDF and of sources running in parallel.
+
+A transfer is accounted by chunks as it goes when the client library allows it (GCS downloads,
+S3 transfers and streams), or once done for SWIFT and HuggingFace, the next transfers then
+waiting for the consumed bytes. The transferred bytes, the achieved rate and the waiting time are
+reported in the metrics (counter bandwidth_bytes, gauges bandwidth_rate_bytes and
+bandwidth_limit_bytes, stage bandwidth_wait), by direction.
+"""
+
+import os
+import time
+import fcntl
+import struct
+import threading
+
+# metrics of the harvesting stages
+from arxiv_harvester.metrics import metrics
+
+# logging
+import logging
+import logging.handlers
+
+DIRECTIONS = ["ingress", "egress"]
+
+# period in seconds of the update of the achieved rates
+RATE_WINDOW = 5.0
+
+class _FileBucket(object):
+    """
+    Token bucket of one direction, its state (tokens, timestamp of the last update) being stored in
+    a file at a given offset, locked during every update so that it can be shared by processes
+    """
+
+    def __init__(self, fd, offset):
+        self.fd = fd
+        self.offset = offset
+        # the file locks are held by the process, so the threads of the process are serialized apart
+        self._lock = threading.Lock()
+
+    def consume(self, nb_bytes, rate, burst):
+        '''
+        Take nb_bytes from the bucket, return the time to wait before the transfer can go on. The
+        bucket can be in debt, so that a chunk larger than the burst is still admitted after the
+        right waiting time.
+        '''
+        with self._lock:
+            return self._consume(nb_bytes, rate, burst)
+
+    def _consume(self, nb_bytes, rate, burst):
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, 16, self.offset)
+        try:
+            now = time.time()
+            data = os.pread(self.fd, 16, self.offset)
+            if len(data) == 16:
+                tokens, last = struct.unpack("<dd", data)
+            else:
+                tokens, last = burst, now
+            tokens = min(burst, tokens + max(0.0, now - last) * rate)
+            tokens -= nb_bytes
+            os.pwrite(self.fd, struct.pack("<dd", tokens, now), self.offset)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, 16, self.offset)
+        if tokens >= 0:
+            return 0.0
+        return -tokens / rate
+
+class BandwidthGovernor(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.limits = {}
+        self.schedule = []
+        self.burst = 1.0
+        self._buckets = {}
+        self._fd = None
+        self.path = None
+        # direction -> [start of the current rate window, bytes in the window]
+        self._windows = dict((direction, [time.time(), 0]) for direction in DIRECTIONS)
+
+    def configure(self, config):
+        '''
+        Set the limits from a harvester config. The limits are process-wide, the last config wins.
+        '''
+        with self._lock:
+            self.limits = {}
+            for direction in DIRECTIONS:
+                self.limits[direction] = config.get("bandwidth_" + direction, None)
+            self.schedule = []
+            for period in config.get("bandwidth_schedule", []):
+                try:
+                    self.schedule.append((_minutes(period["from"]), _minutes(period["to"]), period))
+                except (KeyError, ValueError):
+                    logging.error("invalid bandwidth_schedule period " + str(period) + ", ignored")
+            self.burst = config.get("bandwidth_burst", 1.0)
+
+            path = config.get("bandwidth_path", None)
+            if path is None and "data_path" in config:
+                path = os.path.join(config["data_path"], "bandwidth.state")
+            if path != self.path and self._limited():
+                if self._fd is not None:
+                    os.close(self._fd)
+                    self._fd = None
+                self._buckets = {}
+                try:
+                    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+                    self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+                    for i, direction in enumerate(DIRECTIONS):
+                        self._buckets[direction] = _FileBucket(self._fd, 16 * i)
+                    self.path = path
+                except OSError:
+                    logging.exception("Could not open the bandwidth state file " + str(path) + ", bandwidth not limited")
+        for direction in DIRECTIONS:
+            limit = self.limit(direction)
+            metrics.set("bandwidth_limit_bytes", limit if limit is not None else 0, direction=direction)
+
+    def _limited(self):
+        if any(limit is not None for limit in self.limits.values()):
+            return True
+        return any(period.get(direction) is not None for start, end, period in self.schedule for direction in DIRECTIONS)
+
+    def limit(self, direction):
+        '''
+        Current limit in bytes per second of a direction, None if not limited
+        '''
+        if len(self.schedule) > 0:
+            now = time.localtime()
+            minutes = now.tm_hour * 60 + now.tm_min
+            for start, end, period in self.schedule:
+                if (start <= minutes < end) if start <= end else (minutes >= start or minutes < end):
+                    return period.get(direction, self.limits.get(direction))
+        return self.limits.get(direction)
+
+    def throttle(self, direction, nb_bytes):
+        '''
+        Account nb_bytes transferred in a direction, waiting if the limit is exceeded
+        '''
+        if nb_bytes <= 0:
+            return
+        metrics.inc("bandwidth_bytes", nb_bytes, direction=direction)
+        self._update_rate(direction, nb_bytes)
+        limit = self.limit(direction)
+        bucket = self._buckets.get(direction)
+        if limit is None or limit <= 0 or bucket is None:
+            return
+        try:
+            wait = bucket.consume(nb_bytes, float(limit), max(1.0, self.burst * limit))
+        except OSError:
+            logging.exception("Could not update the bandwidth state file " + str(self.path))
+            return
+        if wait > 0:
+            time.sleep(wait)
+            metrics.observe_stage("bandwidth_wait", wait, direction=direction)
+
+    def _update_rate(self, direction, nb_bytes):
+        with self._lock:
+            window = self._windows[direction]
+            window[1] += nb_bytes
+            elapsed = time.time() - window[0]
+            if elapsed >= RATE_WINDOW:
+                metrics.set("bandwidth_rate_bytes", round(window[1] / elapsed), direction=direction)
+                window[0] += elapsed
+                window[1] = 0
+
+    def callback(self, direction):
+        '''
+        Function accounting the bytes transferred, e.g. as Callback of the boto3 managed transfers
+        '''
+        def _callback(nb_bytes):
+            self.throttle(direction, nb_bytes)
+        return _callback
+
+class ThrottledReader(object):
+    """
+    File-like object wrapper accounting the bytes read in a direction
+    """
+
+    def __init__(self, fileobj, direction="ingress"):
+        self.fileobj = fileobj
+        self.direction = direction
+
+    def read(self, *args, **kwargs):
+        data = self.fileobj.read(*args, **kwargs)
+        governor.throttle(self.direction, len(data))
+        return data
+
+    def close(self):
+        self.fileobj.close()
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+def _minutes(hour):
+    # "22:30" -> minutes since midnight
+    hours, minutes = hour.split(":")
+    return int(hours) * 60 + int(minutes)
+
+# bandwidth governor of the current process
+governor = BandwidthGovernor()
+
+def configure(config):
+    governor.configure(config)
+
+def throttle(direction, nb_bytes):
+    governor.throttle(direction, nb_bytes)
@@ -0,0 +1,138 @@
+import time
+import threading
+import queue
+
+# logging
+import logging
+import logging.handlers
+
+class BatchQueue(object):
+    """
+    Accumulate items added from any thread and process them by batches in a background thread.
+
+    A batch is cut when it reaches max_items items or max_bytes bytes (if not None), or when its
+    oldest item has waited for more than max_delay seconds. At most max_pending_batches cut batches
+    wait for processing, beyond that producers are blocked, so that they slow down when the
+    processing lags behind.
+
+    process_batch(batch) is called in the background thread with the list of items of the batch.
+    """
+
+    def __init__(self, process_batch, max_items=1000, max_bytes=None, max_delay=60, max_pending_batches=2, name="batch-queue"):
+        self.process_batch = process_batch
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+
+        self._lock = threading.Lock()
+        self._staged = []
+        self._staged_bytes = 0
+        self._staged_since = None
+
+        self._batches = queue.Queue(maxsize=max_pending_batches)
+        # held by the background thread while processing a batch
+        self._process_lock = threading.Lock()
+        self._worker = threading.Thread(target=self._process_loop, name=name, daemon=True)
+        self._worker.start()
+
+    def add(self, item, size=0):
+        batch = None
+        with self._lock:
+            self._staged.append(item)
+            self._staged_bytes += size
+            if self._staged_since is None:
+                self._staged_since = time.time()
+            if len(self._staged) >= self.max_items or (self.max_bytes is not None and self._staged_bytes >= self.max_bytes):
+                batch = self._cut_batch()
+
+        if batch is not None:
+            self._batches.put(batch)
+
+    def _cut_batch(self):
+        # caller must hold the lock
+        batch = self._staged
+        self._staged = []
+        self._staged_bytes = 0
+        self._staged_since = None
+        return batch
+
+    def staged(self):
+        """
+        Return the number of items staged and not yet in a batch
+        """
+        with self._lock:
+            return len(self._staged)
+
+    def flush(self):
+        """
+        Process all the currently staged items and wait until all pending batches are processed
+        """
+        with self._lock:
+            batch = self._cut_batch()
+        if len(batch) > 0:
+            self._batches.put(batch)
+        self._batches.join()
+        # wait for a possible time-based batch started by the background thread
+        with self._process_lock:
+            pass
+
+    def close(self):
+        self.flush()
+        self._batches.put(None)
+        self._worker.join()
+
+    def _process_loop(self):
+        while True:
+            try:
+                batch = self._batches.get(timeout=1)
+            except queue.Empty:
+                # time-based flush, so that slowly added items are still processed regularly
+                with self._process_lock:
+                    with self._lock:
+                        if self._staged_since is not None and time.time() - self._staged_since >= self.max_delay:
+                            batch = self._cut_batch()
+                        else:
+                            batch = []
+                    if len(batch) > 0:
+                        self._process(batch)
+                continue
+
+            if batch is None:
+                self._batches.task_done()
+                break
+
+            try:
+                with self._process_lock:
+                    self._process(batch)
+            finally:
+                self._batches.task_done()
+
+    def _process(self, batch):
+        try:
+            self.process_batch(batch)
+        except Exception:
+            logging.exception("Unexpected error processing a batch of " + str(len(batch)) + " items")
+
+class CallbackGroup(object):
+    """
+    Callback to be called once per member of a group of n asynchronous operations, calling in turn
+    callback(success) once all the members have reported, success being True only if all
+    the members succeeded.
+    """
+
+    def __init__(self, n, callback):
+        self.remaining = n
+        self.success = True
+        self.callback = callback
+        self._lock = threading.Lock()
+        if n == 0 and callback is not None:
+            callback(True)
+
+    def __call__(self, success):
+        with self._lock:
+            self.remaining -= 1
+            if not success:
+                self.success = False
+            done = (self.remaining == 0)
+        if done and self.callback is not None:
+            self.callback(self.success)
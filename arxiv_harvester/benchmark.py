@@ -0,0 +1,504 @@
+"""
+Offline benchmark of the harvesting, without any access to real cloud services.
+
+- the PDF files are served by a local HTTP server emulating storage.googleapis.com/arxiv-dataset,
+  with configurable latency, size distribution and rates of 404 and 503 errors,
+- the arXiv source bucket is emulated with moto (pip install moto), filled with synthetic
+  arXiv_src tar archives and their manifest,
+- the metadata file is generated at the requested scale from data/test/test_metadata_file.json.
+
+Every stage is measured (wall time, entries/s, MB/s, CPU seconds and peak RSS) and the results
+are written as a JSON report, so that runs with different configs or code versions can be compared.
+
+python3 -m arxiv_harvester.benchmark --entries 2000 --archives 4 --output report.json
+
+With --startup, only the startup time and memory of the command line tools are measured, as
+well as the import of each storage backend:
+
+python3 -m arxiv_harvester.benchmark --startup --output startup_report.json
+"""
+
+import os
+import io
+import json
+import time
+import gzip
+import random
+import shutil
+import tarfile
+import hashlib
+import argparse
+import tempfile
+import threading
+import resource
+import statistics
+import subprocess
+import sys
+import multiprocessing
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from arxiv_harvester.harvester import ArXivHarvester, _load_config
+from arxiv_harvester.harvester_sources import ArXivSourceHarvester
+from arxiv_harvester.metrics import metrics
+
+# logging
+import logging
+import logging.handlers
+
+try:
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
+
+# random data used to build the served files, sliced rather than generated for each request
+RANDOM_BLOCK = random.Random(42).randbytes(4 * 1024 * 1024)
+
+SOURCE_BUCKET = "arxiv-benchmark-src"
+
+class FakeGCSHandler(BaseHTTPRequestHandler):
+    """
+    Serve synthetic PDF files under /arxiv-dataset/arxiv/, the size of a file being drawn from
+    a log-normal distribution seeded by its path, so that the same path always gives the same file
+    """
+
+    # set by the server process
+    settings = None
+    counters = None
+
+    def do_GET(self):
+        settings = self.settings
+        rnd = random.Random(self.path)
+
+        latency = max(0.0, rnd.gauss(settings['latency'], settings['latency_jitter']))
+        if latency > 0:
+            time.sleep(latency)
+
+        if not self.path.startswith("/arxiv-dataset/arxiv/") or not self.path.endswith(".pdf"):
+            self._send_error(404)
+            return
+
+        draw = random.random()
+        if draw < settings['error_503']:
+            self._send_error(503)
+            return
+        # missing files are always missing
+        if rnd.random() < settings['error_404']:
+            self._send_error(404)
+            return
+
+        size = int(rnd.lognormvariate(0, settings['pdf_size_sigma']) * settings['pdf_size_median'])
+        body = _synthetic_pdf(size, rnd)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/pdf")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        # a straggler: the transfer stalls in the middle of the body, for this request only
+        if random.random() < settings.get('stall', 0):
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            time.sleep(settings['stall_seconds'])
+            try:
+                self.wfile.write(body[len(body) // 2:])
+            except OSError:
+                # interrupted by the harvester
+                return
+        else:
+            self.wfile.write(body)
+
+        with self.counters['lock']:
+            self.counters['requests'].value += 1
+            self.counters['bytes'].value += len(body)
+
+    def _send_error(self, code):
+        self.send_response(code)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        with self.counters['lock']:
+            self.counters['requests'].value += 1
+            self.counters['errors'].value += 1
+
+    def log_message(self, format, *args):
+        pass
+
+def _synthetic_pdf(size, rnd):
+    header = b"%PDF-1.4\n"
+    trailer = b"\n%%EOF\n"
+    size = max(size, len(header) + len(trailer))
+    length = size - len(header) - len(trailer)
+    chunks = []
+    while length > 0:
+        start = rnd.randrange(0, len(RANDOM_BLOCK) - 1)
+        chunk = RANDOM_BLOCK[start:start + length]
+        chunks.append(chunk)
+        length -= len(chunk)
+    return header + b"".join(chunks) + trailer
+
+def _serve(port, settings, lock, requests_count, bytes_count, errors_count, ready):
+    FakeGCSHandler.settings = settings
+    FakeGCSHandler.counters = { 'lock': lock, 'requests': requests_count, 'bytes': bytes_count, 'errors': errors_count }
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeGCSHandler)
+    server.daemon_threads = True
+    ready.set()
+    server.serve_forever()
+
+class FakeGCSServer(object):
+    """
+    The fake GCS server, run in a separate process so that its CPU usage is not mixed with the one
+    of the harvester
+    """
+
+    def __init__(self, settings, port=0):
+        self.settings = settings
+        if port == 0:
+            port = _free_port()
+        self.port = port
+        context = multiprocessing.get_context("spawn")
+        self.lock = context.Lock()
+        self.requests = context.Value('q', 0, lock=False)
+        self.bytes = context.Value('q', 0, lock=False)
+        self.errors = context.Value('q', 0, lock=False)
+        self._ready = context.Event()
+        self._process = context.Process(target=_serve, args=(port, settings, self.lock, self.requests, self.bytes, self.errors, self._ready), daemon=True)
+
+    def start(self):
+        self._process.start()
+        self._ready.wait(30)
+        return "http://127.0.0.1:" + str(self.port) + "/arxiv-dataset/arxiv/"
+
+    def stop(self):
+        self._process.terminate()
+        self._process.join()
+
+    def stats(self):
+        with self.lock:
+            return { 'requests': self.requests.value, 'bytes': self.bytes.value, 'errors': self.errors.value }
+
+def _free_port():
+    import socket
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+class StageMeter(object):
+    """
+    Measure a benchmark stage: wall time, CPU seconds (process and terminated child processes)
+    and peak RSS, sampled in a background thread during the stage
+    """
+
+    def __init__(self, name, sampling_interval=0.1):
+        self.name = name
+        self.sampling_interval = sampling_interval
+        self.result = None
+
+    def __enter__(self):
+        # stage metrics of the harvester, per stage of the benchmark
+        metrics.reset()
+        self.peak_rss = _current_rss()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, name="rss-sampler", daemon=True)
+        self._sampler.start()
+        self._start_usage = _cpu_seconds()
+        self._start_time = time.time()
+        return self
+
+    def _sample(self):
+        while not self._stop.wait(self.sampling_interval):
+            self.peak_rss = max(self.peak_rss, _current_rss())
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.time() - self._start_time
+        cpu = _cpu_seconds() - self._start_usage
+        self._stop.set()
+        self._sampler.join()
+        self.peak_rss = max(self.peak_rss, _current_rss())
+
+        self.result = {}
+        self.result['wall_seconds'] = round(wall, 3)
+        self.result['cpu_seconds'] = round(cpu, 3)
+        self.result['peak_rss_mb'] = round(self.peak_rss / (1024 * 1024), 1)
+        # peak over the whole run, process pools workers included
+        self.result['max_child_rss_mb'] = round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)
+        self.metrics = metrics.to_dict()
+        return False
+
+    def report(self, entries, nb_bytes, **extra):
+        wall = max(self.result['wall_seconds'], 0.001)
+        self.result['entries'] = entries
+        self.result['bytes'] = nb_bytes
+        self.result['entries_per_second'] = round(entries / wall, 2)
+        self.result['mb_per_second'] = round(nb_bytes / (1024 * 1024) / wall, 3)
+        self.result.update(extra)
+        print(self.name + ":", json.dumps(self.result))
+        self.result['metrics'] = { 'stages': self.metrics['stages'], 'counters': self.metrics['counters'] }
+        return self.result
+
+def _cpu_seconds():
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage_self.ru_utime + usage_self.ru_stime + usage_children.ru_utime + usage_children.ru_stime
+
+def _current_rss():
+    try:
+        with open("/proc/self/statm", "r") as the_file:
+            return int(the_file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError):
+        # no procfs, peak of the process so far
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def generate_metadata(template_file, nb_entries, output_file, seed=42):
+    '''
+    Write a jsonl metadata file of nb_entries entries, based on the entries of a template
+    metadata file with new-style arXiv identifiers generated month by month
+    '''
+    templates = []
+    with open(template_file, "r") as the_file:
+        for line in the_file:
+            if len(line.strip()) > 0:
+                templates.append(json.loads(line))
+
+    rnd = random.Random(seed)
+    year, month, number = 15, 1, 0
+    with open(output_file, "w") as the_file:
+        for i in range(nb_entries):
+            number += 1
+            if number > 99999:
+                year, month, number = year + (month // 12), (month % 12) + 1, 1
+            entry = dict(templates[i % len(templates)])
+            entry['id'] = "%02d%02d.%05d" % (year, month, number)
+            entry['versions'] = [ "v" + str(v+1) for v in range(rnd.randint(1, 3)) ]
+            if 'doi' in entry and entry['doi'] != None:
+                entry['doi'] = "10.48550/arXiv." + entry['id']
+            the_file.write(json.dumps(entry))
+            the_file.write("\n")
+
+def generate_source_archives(s3_client, bucket, nb_archives, nb_members, member_size, seed=42):
+    '''
+    Create synthetic arXiv_src archives and their manifest in a S3 bucket, return the total size of
+    the archives and their number of members
+    '''
+    rnd = random.Random(seed)
+    manifest = ["<arXivSRC>"]
+    total_bytes = 0
+    total_members = 0
+    for a in range(nb_archives):
+        yymm = "%02d%02d" % (15 + a // 12, (a % 12) + 1)
+        name = "arXiv_src_" + yymm + "_001.tar"
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w") as tar:
+            for m in range(nb_members):
+                identifier = yymm + ".%05d" % (m + 1)
+                draw = rnd.random()
+                if draw < 0.02:
+                    member_name, data = identifier + ".pdf", _synthetic_pdf(member_size, rnd)
+                elif draw < 0.04:
+                    member_name, data = identifier + ".gz", gzip.compress(b"%auto-ignore\nwithdrawn paper")
+                elif draw < 0.2:
+                    member_name, data = identifier + ".gz", gzip.compress(b"\\documentclass{article}\n" + _synthetic_text(member_size, rnd))
+                else:
+                    member_name, data = identifier + ".gz", _synthetic_tar_gz(member_size, rnd)
+                info = tarfile.TarInfo(yymm + "/" + member_name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        data = buffer.getvalue()
+        s3_client.put_object(Bucket=bucket, Key="src/" + name, Body=data)
+        total_bytes += len(data)
+        total_members += nb_members
+        manifest.append("<file><filename>src/%s</filename><first_item>%s.00001</first_item><last_item>%s.%05d</last_item><md5sum>%s</md5sum><num_items>%d</num_items><size>%d</size><yymm>%s</yymm></file>"
+            % (name, yymm, yymm, nb_members, hashlib.md5(data).hexdigest(), nb_members, len(data), yymm))
+    manifest.append("</arXivSRC>")
+    s3_client.put_object(Bucket=bucket, Key="src/arXiv_src_manifest.xml", Body="\n".join(manifest).encode("UTF-8"))
+    return total_bytes, total_members
+
+def _synthetic_text(size, rnd):
+    # latex-like compressible text
+    words = [b"\\section{Introduction}", b"theorem", b"the", b"of", b"quantum", b"$x^2$", b"\\cite{ref}", b"model", b"we", b"show"]
+    pieces = []
+    length = 0
+    while length < size:
+        word = rnd.choice(words)
+        pieces.append(word)
+        length += len(word) + 1
+    return b" ".join(pieces)
+
+def _synthetic_tar_gz(size, rnd):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        files = [ ("main.tex", b"\\documentclass{article}\n" + _synthetic_text(size // 2, rnd)),
+                  ("figures/figure1.png", _synthetic_pdf(size // 2, rnd)) ]
+        for name, data in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+# command lines of which the startup is measured, as python code run in a new interpreter
+STARTUP_COMMANDS = [
+    ("python", "pass"),
+    ("harvester_help", "import sys, runpy; sys.argv = ['harvester', '--help']; runpy.run_module('arxiv_harvester.harvester', run_name='__main__')"),
+    ("harvester_sources_help", "import sys, runpy; sys.argv = ['harvester_sources', '--help']; runpy.run_module('arxiv_harvester.harvester_sources', run_name='__main__')"),
+    ("import_backend_s3", "import arxiv_harvester.S3"),
+    ("import_backend_swift", "import arxiv_harvester.swift"),
+    ("import_backend_hf", "import arxiv_harvester.hf"),
+]
+
+# the peak RSS is written by the process itself at exit, as ru_maxrss of a child process also
+# accounts for the memory of the parent at fork time
+_STARTUP_PROBE = "import atexit, sys; atexit.register(lambda: sys.stderr.write(''.join(line for line in open('/proc/self/status') if line.startswith('VmHWM'))))\n"
+
+def run_startup_benchmark(args):
+    '''
+    Run every startup command several times in a new interpreter, reporting the wall time (median
+    and min) and the peak RSS of the process
+    '''
+    report = {}
+    report['timestamp'] = time.strftime("%Y-%m-%dT%H:%M:%S")
+    report['parameters'] = vars(args)
+    report['startup'] = {}
+    for name, code in STARTUP_COMMANDS:
+        walls = []
+        peak_rss = None
+        status = 0
+        for i in range(args.startup_runs):
+            start = time.time()
+            process = subprocess.run([sys.executable, "-c", _STARTUP_PROBE + code], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            walls.append(time.time() - start)
+            status = process.returncode
+            for line in process.stderr.decode("UTF-8", errors="replace").splitlines():
+                if line.startswith("VmHWM:"):
+                    # in kB
+                    peak_rss = max(peak_rss or 0, int(line.split()[1]))
+        result = {}
+        result['wall_seconds_median'] = round(statistics.median(walls), 3)
+        result['wall_seconds_min'] = round(min(walls), 3)
+        result['peak_rss_mb'] = round(peak_rss / 1024, 1) if peak_rss is not None else None
+        result['exit_status'] = status
+        print(name + ":", json.dumps(result))
+        report['startup'][name] = result
+    return report
+
+def run_benchmark(args, config):
+    report = {}
+    report['timestamp'] = time.strftime("%Y-%m-%dT%H:%M:%S")
+    report['parameters'] = vars(args)
+    report['stages'] = {}
+
+    work_path = tempfile.mkdtemp(prefix="benchmark-", dir=args.work_dir)
+    try:
+        # metadata generation
+        metadata_file = os.path.join(work_path, "metadata.json")
+        with StageMeter("metadata") as meter:
+            generate_metadata(args.template, args.entries, metadata_file)
+        report['stages']['metadata'] = meter.report(args.entries, os.path.getsize(metadata_file))
+
+        # harvesting of metadata and PDF from the fake GCS server
+        if args.entries > 0:
+            settings = {}
+            settings['latency'] = args.latency / 1000.0
+            settings['latency_jitter'] = args.latency_jitter / 1000.0
+            settings['pdf_size_median'] = args.pdf_size_median
+            settings['pdf_size_sigma'] = args.pdf_size_sigma
+            settings['error_404'] = args.error_404
+            settings['error_503'] = args.error_503
+            settings['stall'] = args.stall
+            settings['stall_seconds'] = args.stall_seconds
+            server = FakeGCSServer(settings)
+            harvest_config = dict(config)
+            harvest_config['data_path'] = os.path.join(work_path, "harvest")
+            harvest_config['gcs_base'] = server.start()
+            try:
+                harvester = ArXivHarvester(harvest_config)
+                with StageMeter("harvest") as meter:
+                    harvester.harvest(metadata_file)
+                stats = server.stats()
+                with harvester.env.begin() as txn:
+                    nb_harvested = txn.stat()['entries']
+            finally:
+                server.stop()
+            report['stages']['harvest'] = meter.report(args.entries, stats['bytes'], harvested=nb_harvested,
+                requests=stats['requests'], errors=stats['errors'])
+
+        # harvesting of the sources from the emulated S3 source bucket
+        if args.archives > 0:
+            if mock_aws is None:
+                print("moto is not installed, skipping the source harvesting stages")
+            else:
+                report['stages'].update(_run_source_stages(args, config, work_path))
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_path, ignore_errors=True)
+
+    return report
+
+def _run_source_stages(args, config, work_path):
+    import boto3
+    stages = {}
+    with mock_aws():
+        s3_client = boto3.client('s3', region_name="us-east-1")
+        s3_client.create_bucket(Bucket=SOURCE_BUCKET)
+        total_bytes, total_members = generate_source_archives(s3_client, SOURCE_BUCKET, args.archives, args.members, args.member_size)
+
+        modes = [ ("sources", False) ]
+        if args.stream:
+            modes.append(("sources_stream", True))
+        for stage, streaming in modes:
+            source_config = dict(config)
+            # local storage, the target S3 or SWIFT storage are not emulated
+            source_config['bucket_name'] = ""
+            source_config['swift'] = {}
+            source_config['hf_repo_id'] = ""
+            source_config['data_path'] = os.path.join(work_path, stage)
+            source_config['arxiv-source'] = { 'bucket_name': SOURCE_BUCKET, 'region': "us-east-1", 'requester_pays': True,
+                'aws_access_key_id': "benchmark", 'aws_secret_access_key': "benchmark" }
+            harvester = ArXivSourceHarvester(source_config)
+            with StageMeter(stage) as meter:
+                harvester.harvest_sources(streaming=streaming)
+            with harvester.env_papers.begin() as txn:
+                nb_papers = txn.stat()['entries']
+            stages[stage] = meter.report(total_members, total_bytes, papers=nb_papers)
+    return stages
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "offline benchmark of the arXiv harvester")
+    parser.add_argument("--config", default=None, help="path to a config file for the harvester settings (batch_size, source_processes, etc.), the storage is always local")
+    parser.add_argument("--template", default="data/test/test_metadata_file.json", help="metadata file used as template for the generated entries")
+    parser.add_argument("--entries", type=int, default=1000, help="number of metadata entries to harvest, default 1000")
+    parser.add_argument("--latency", type=float, default=50, help="mean latency of the fake GCS server in ms, default 50")
+    parser.add_argument("--latency-jitter", type=float, default=20, help="standard deviation of the latency in ms, default 20")
+    parser.add_argument("--pdf-size-median", type=int, default=500*1024, help="median size of the PDF files in bytes, default 500KB")
+    parser.add_argument("--pdf-size-sigma", type=float, default=0.8, help="sigma of the log-normal distribution of the PDF sizes, default 0.8")
+    parser.add_argument("--error-404", type=float, default=0.02, help="rate of missing PDF files, default 0.02")
+    parser.add_argument("--error-503", type=float, default=0.01, help="rate of 503 errors, default 0.01")
+    parser.add_argument("--stall", type=float, default=0, help="rate of PDF downloads stalling in the middle of the transfer, default 0")
+    parser.add_argument("--stall-seconds", type=float, default=60, help="duration of a stalled transfer in seconds, default 60")
+    parser.add_argument("--archives", type=int, default=2, help="number of synthetic source archives, 0 for no source harvesting, default 2")
+    parser.add_argument("--members", type=int, default=200, help="number of members per source archive, default 200")
+    parser.add_argument("--member-size", type=int, default=100*1024, help="approximative size of the source members in bytes, default 100KB")
+    parser.add_argument("--stream", action="store_true", help="also benchmark the source harvesting in stream mode")
+    parser.add_argument("--work-dir", default=None, help="directory for the temporary harvesting data, default is the system temporary directory")
+    parser.add_argument("--keep", action="store_true", help="keep the harvested data after the benchmark")
+    parser.add_argument("--output", default="benchmark_report.json", help="path of the JSON report, default benchmark_report.json")
+    parser.add_argument("--startup", action="store_true", help="only measure the startup time and memory of the command line tools and of the import of the storage backends")
+    parser.add_argument("--startup-runs", type=int, default=5, help="number of runs of each command for --startup, default 5")
+
+    args = parser.parse_args()
+
+    if args.startup:
+        report = run_startup_benchmark(args)
+        with open(args.output, "w") as the_file:
+            json.dump(report, the_file, indent=2)
+        print("benchmark report written in", args.output)
+        sys.exit(0)
+
+    config = {}
+    if args.config is not None:
+        config = _load_config(args.config)
+    config['compression'] = config.get('compression', True)
+    config['bucket_name'] = ""
+    config['swift'] = {}
+    config['swift_container'] = ""
+    config['hf_repo_id'] = ""
+
+    report = run_benchmark(args, config)
+    with open(args.output, "w") as the_file:
+        json.dump(report, the_file, indent=2)
+    print("benchmark report written in", args.output)
@@ -0,0 +1,92 @@
+import time
+import threading
+
+# metrics of the harvesting stages
+from arxiv_harvester.metrics import metrics
+
+# logging
+import logging
+import logging.handlers
+
+class ByteBudget(object):
+    """
+    A budget of bytes (e.g. local disk space) shared between threads.
+
+    acquire(n) blocks while the bytes currently in use plus n would exceed the limit. A request
+    larger than the whole limit is admitted when nothing else is in use, so that it can never
+    block forever. A limit of None means no limit.
+
+    The usage is reported in the metrics as the gauges budget_used_bytes and budget_limit_bytes,
+    and the time spent waiting for the budget as the stage budget_wait, labelled with the name
+    of the budget.
+    """
+
+    def __init__(self, limit=None, name="budget"):
+        self.limit = limit
+        self.name = name
+        self.used = 0
+        self._condition = threading.Condition()
+        if self.limit is not None:
+            metrics.set("budget_limit_bytes", self.limit, budget=self.name)
+        metrics.set("budget_used_bytes", 0, budget=self.name)
+
+    def acquire(self, n):
+        with self._condition:
+            if self.limit is not None and self.used > 0 and self.used + n > self.limit:
+                start = time.time()
+                while self.used > 0 and self.used + n > self.limit:
+                    self._condition.wait()
+                metrics.observe_stage("budget_wait", time.time() - start, budget=self.name)
+            self.used += n
+            metrics.set("budget_used_bytes", self.used, budget=self.name)
+
+    def release(self, n):
+        with self._condition:
+            self.used -= n
+            if self.used < 0:
+                logging.warning(self.name + " released more bytes than acquired")
+                self.used = 0
+            metrics.set("budget_used_bytes", self.used, budget=self.name)
+            self._condition.notify_all()
+
+    def resize(self, old, new):
+        """
+        Change the number of bytes of a previous acquire() when the actual size is known, without
+        blocking, e.g. to replace an estimation by the size of a downloaded file. The budget can
+        then be exceeded, further acquire() waiting until it is back under the limit.
+        """
+        with self._condition:
+            self.used += new - old
+            if self.used < 0:
+                self.used = 0
+            metrics.set("budget_used_bytes", self.used, budget=self.name)
+            if new < old:
+                self._condition.notify_all()
+
+class Reservation(object):
+    """
+    Bytes acquired from a budget for one item (e.g. an entry being harvested), blocking until they
+    are available. The reservation can then be resized and released once, from any thread.
+    """
+
+    def __init__(self, budget, size=0):
+        self.budget = budget
+        self.size = size
+        self._lock = threading.Lock()
+        self._released = False
+        if size > 0:
+            budget.acquire(size)
+
+    def resize(self, size):
+        with self._lock:
+            if self._released:
+                return
+            self.budget.resize(self.size, size)
+            self.size = size
+
+    def release(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+            self.budget.release(self.size)
@@ -0,0 +1,350 @@
+"""
+Coordination of several harvesting nodes working on the same corpus.
+
+The work is split into units, shards of lines of the metadata file for the PDF harvesting and
+source archives for the source harvesting. A node processes a unit only after taking a lease on
+it in a coordination store shared by all the nodes:
+
+- "s3": lease objects under a prefix of the target S3 bucket, updated with S3 conditional writes,
+- "sqlite": a SQLite file on a shared file system (e.g. NFS).
+
+A lease expires after "lease_duration" seconds unless renewed, the leases held by a node being
+renewed by a background thread. The lease of a node which stopped (crash, preemption) is therefore
+stolen by another node once expired. When a unit is completed, the node publishes the state of the
+unit (the records of its local LMDB for this unit), so that the states of all the nodes can be
+merged into a global view on any node.
+
+A lease record is a small json dict: {"owner": node id, "status": "leased"|"done"|"released",
+"expires": timestamp, "updated": timestamp}. Every update is a compare-and-swap on the version of
+the record (ETag for S3, a version number for SQLite), so that two nodes can never both take the
+same lease. The clocks of the nodes are assumed to be roughly synchronized, compared to the lease
+duration.
+"""
+
+import os
+import json
+import gzip
+import time
+import socket
+import sqlite3
+import threading
+
+# metrics of the harvesting stages
+from arxiv_harvester.metrics import metrics
+
+# logging
+import logging
+import logging.handlers
+
+class S3LeaseStore(object):
+    """
+    Lease records and unit states as objects under a prefix of a S3 bucket
+    """
+
+    def __init__(self, s3, prefix="coordination/"):
+        self.s3 = s3
+        if len(prefix) > 0 and not prefix.endswith("/"):
+            prefix += "/"
+        self.prefix = prefix
+
+    def get(self, key):
+        body, etag = self.s3.get_object_with_etag(self.prefix + "leases/" + key + ".json")
+        if body is None:
+            return None, None
+        return json.loads(body.decode("UTF-8")), etag
+
+    def put(self, key, record, version=None):
+        body = json.dumps(record).encode("UTF-8")
+        if version is None:
+            return self.s3.put_object_conditional(self.prefix + "leases/" + key + ".json", body, if_none_match=True)
+        return self.s3.put_object_conditional(self.prefix + "leases/" + key + ".json", body, if_match=version)
+
+    def iter_records(self, namespace):
+        dir_name = self.prefix + "leases/" + namespace + "/"
+        for s3_key, size, etag in self.s3.iter_objects(dir_name):
+            if not s3_key.endswith(".json"):
+                continue
+            key = s3_key[len(self.prefix + "leases/"):-len(".json")]
+            record, version = self.get(key)
+            if record is not None:
+                yield key, record
+
+    def put_state(self, key, state):
+        body = gzip.compress(json.dumps(state).encode("UTF-8"))
+        self.s3.put_object_conditional(self.prefix + "states/" + key + ".json.gz", body)
+
+    def get_state(self, key):
+        body, etag = self.s3.get_object_with_etag(self.prefix + "states/" + key + ".json.gz")
+        if body is None:
+            return None
+        return json.loads(gzip.decompress(body).decode("UTF-8"))
+
+class SQLiteLeaseStore(object):
+    """
+    Lease records and unit states in a SQLite file, which can be on a shared file system
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, record TEXT, version INTEGER)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS states (key TEXT PRIMARY KEY, state BLOB)")
+
+    def get(self, key):
+        with self._lock:
+            row = self.conn.execute("SELECT record, version FROM leases WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None, None
+        return json.loads(row[0]), row[1]
+
+    def put(self, key, record, version=None):
+        with self._lock:
+            if version is None:
+                cursor = self.conn.execute("INSERT OR IGNORE INTO leases (key, record, version) VALUES (?, ?, 1)", (key, json.dumps(record)))
+                return 1 if cursor.rowcount == 1 else None
+            cursor = self.conn.execute("UPDATE leases SET record = ?, version = version + 1 WHERE key = ? AND version = ?", (json.dumps(record), key, version))
+            return version + 1 if cursor.rowcount == 1 else None
+
+    def iter_records(self, namespace):
+        with self._lock:
+            rows = self.conn.execute("SELECT key, record FROM leases WHERE key LIKE ?", (namespace + "/%",)).fetchall()
+        for key, record in rows:
+            yield key, json.loads(record)
+
+    def put_state(self, key, state):
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO states (key, state) VALUES (?, ?)", (key, gzip.compress(json.dumps(state).encode("UTF-8"))))
+
+    def get_state(self, key):
+        with self._lock:
+            row = self.conn.execute("SELECT state FROM states WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(gzip.decompress(row[0]).decode("UTF-8"))
+
+class Coordinator(object):
+    """
+    Lease-based partitioning of the work units of a harvester (namespace "entries" or "sources")
+    between nodes
+    """
+
+    def __init__(self, config, store, namespace):
+        self.store = store
+        self.namespace = namespace
+        self.node_id = config.get("node_id", None)
+        if self.node_id is None:
+            self.node_id = socket.gethostname() + "-" + str(os.getpid())
+        self.lease_duration = config.get("lease_duration", 300)
+        # waiting time before trying again the units leased by other nodes
+        self.poll_interval = config.get("lease_poll_interval", min(30, self.lease_duration / 4))
+
+        self._lock = threading.Lock()
+        # unit -> version of the lease record, for the leases held by this node
+        self.held = {}
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def start(self):
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=self._renew_loop, name="lease-heartbeat", daemon=True)
+        self._heartbeat.start()
+        return self
+
+    def stop(self):
+        # the leases still held are released, so that other nodes do not wait for their expiration
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+        with self._lock:
+            units = list(self.held.keys())
+        for unit in units:
+            self.release(unit)
+
+    def _key(self, unit):
+        return self.namespace + "/" + unit
+
+    def _record(self, status):
+        record = {}
+        record['owner'] = self.node_id
+        record['status'] = status
+        record['updated'] = time.time()
+        record['expires'] = record['updated'] + self.lease_duration
+        return record
+
+    def acquire(self, unit):
+        '''
+        Try to take the lease of a unit, return True if the unit is now leased by this node. A unit
+        already done, or leased by another node and not expired, cannot be acquired.
+        '''
+        try:
+            record, version = self.store.get(self._key(unit))
+            if record is not None:
+                if record['status'] == "done":
+                    return False
+                if record['status'] == "leased" and record['owner'] != self.node_id and record['expires'] > time.time():
+                    return False
+            new_version = self.store.put(self._key(unit), self._record("leased"), version)
+        except Exception:
+            logging.exception("Could not acquire the lease of " + unit)
+            return False
+
+        if new_version is None:
+            # taken concurrently by another node
+            return False
+        with self._lock:
+            self.held[unit] = new_version
+        if record is not None and record['status'] == "leased" and record['owner'] != self.node_id:
+            logging.warning("lease of " + unit + " stolen from node " + record['owner'] + ", expired since " + str(round(time.time() - record['expires'])) + "s")
+            metrics.inc("leases", event="stolen")
+        else:
+            metrics.inc("leases", event="acquired")
+        return True
+
+    def complete(self, unit, state=None):
+        '''
+        Mark a unit as done, after publishing its state if given. The unit is marked as done even if
+        the lease was lost in the meantime, as the work is done anyway.
+        '''
+        with self._lock:
+            version = self.held.pop(unit, None)
+        try:
+            if state is not None:
+                self.store.put_state(self._key(unit), state)
+            while True:
+                new_version = self.store.put(self._key(unit), self._record("done"), version)
+                if new_version is not None:
+                    break
+                record, version = self.store.get(self._key(unit))
+                if record is not None and record['status'] == "done":
+                    break
+        except Exception:
+            logging.exception("Could not mark the unit " + unit + " as done")
+            return False
+        metrics.inc("leases", event="completed")
+        return True
+
+    def release(self, unit):
+        '''
+        Give up the lease of a unit not completed, so that it can be taken immediately by another node
+        '''
+        with self._lock:
+            version = self.held.pop(unit, None)
+        if version is None:
+            return
+        try:
+            self.store.put(self._key(unit), self._record("released"), version)
+        except Exception:
+            logging.exception("Could not release the lease of " + unit)
+        metrics.inc("leases", event="released")
+
+    def is_held(self, unit):
+        with self._lock:
+            return unit in self.held
+
+    def _renew_loop(self):
+        while not self._stop.wait(self.lease_duration / 3):
+            with self._lock:
+                held = list(self.held.items())
+            for unit, version in held:
+                try:
+                    new_version = self.store.put(self._key(unit), self._record("leased"), version)
+                except Exception:
+                    logging.exception("Could not renew the lease of " + unit)
+                    continue
+                with self._lock:
+                    if unit not in self.held:
+                        # completed or released in the meantime
+                        continue
+                    if new_version is None:
+                        # stolen by another node after expiration
+                        logging.warning("lease of " + unit + " lost")
+                        metrics.inc("leases", event="lost")
+                        del self.held[unit]
+                    else:
+                        self.held[unit] = new_version
+            metrics.set("leases_held", len(held))
+
+    def iter_units(self, units):
+        '''
+        Iterate over the given units, yielding the units leased by this node in their order. The
+        units leased by other nodes are tried again every poll_interval seconds, until they are all
+        done, so that the leases of the stopped nodes are stolen once expired. The yielded units
+        must be completed or released by the caller.
+        '''
+        remaining = list(units)
+        while len(remaining) > 0 and not self._stop.is_set():
+            waiting = []
+            for unit in remaining:
+                if self.acquire(unit):
+                    yield unit
+                elif not self.is_done(unit):
+                    waiting.append(unit)
+            remaining = waiting
+            if len(remaining) > 0:
+                logging.info(str(len(remaining)) + " units leased by other nodes, waiting")
+                if self._stop.wait(self.poll_interval):
+                    break
+
+    def is_done(self, unit):
+        try:
+            record, version = self.store.get(self._key(unit))
+        except Exception:
+            logging.exception("Could not get the lease of " + unit)
+            return False
+        return record is not None and record['status'] == "done"
+
+    def iter_states(self):
+        '''
+        Iterate over the published states of the done units, from all the nodes, yielding (unit, node, state)
+        '''
+        for key, record in self.store.iter_records(self.namespace):
+            if record['status'] != "done":
+                continue
+            state = self.store.get_state(key)
+            if state is not None:
+                yield key[len(self.namespace) + 1:], record['owner'], state
+
+    def global_view(self):
+        '''
+        Summary of the units of all the nodes: number of units per status, and number of done and
+        currently leased units per node
+        '''
+        now = time.time()
+        view = {}
+        view['units'] = {}
+        view['nodes'] = {}
+        for key, record in self.store.iter_records(self.namespace):
+            status = record['status']
+            if status == "leased" and record['expires'] < now:
+                status = "expired"
+            view['units'][status] = view['units'].get(status, 0) + 1
+            node = view['nodes'].setdefault(record['owner'], {})
+            node[status] = node.get(status, 0) + 1
+        return view
+
+def get_coordinator(config, namespace, s3=None):
+    '''
+    Return the coordinator of the given harvester namespace as set in the config ("coordination"
+    being "s3" or "sqlite"), or None if the harvesting is not distributed
+    '''
+    mode = config.get("coordination", None)
+    if mode is None or len(mode) == 0:
+        return None
+    if mode == "s3":
+        if s3 is None:
+            logging.error("S3 coordination requires a S3 storage (bucket_name), running without coordination")
+            return None
+        store = S3LeaseStore(s3, config.get("coordination_prefix", "coordination/"))
+    elif mode == "sqlite":
+        path = config.get("coordination_path", None)
+        if path is None:
+            logging.error("SQLite coordination requires coordination_path, running without coordination")
+            return None
+        store = SQLiteLeaseStore(path)
+    else:
+        logging.error("invalid coordination value " + str(mode) + ", running without coordination")
+        return None
+    return Coordinator(config, store, namespace)
@@ -0,0 +1,417 @@
+"""
+Long-running service mode of the PDF harvester (--daemon), instead of a cold run from cron.
+
+The harvester is created once and kept between the harvests, with its open lmdb environments, its
+storage clients and their authentication (SWIFT token, S3 and HuggingFace clients) and a pool of
+keep-alive HTTP connections for the downloads. An incremental harvest is started:
+
+- when a new or modified metadata file is found: "daemon_watch" is a metadata file or a directory
+  of metadata files (.json, .json.gz or .zip) checked every "daemon_poll_interval" seconds
+  (default 300), a file being harvested once unchanged for "daemon_settle_seconds" (default 60),
+- when a new version of the metadata file at "daemon_feed_url" is available, polled with
+  conditional requests and downloaded under data_path/feed,
+- at the local times of "daemon_refresh_times" (e.g. ["03:00"]), with the latest metadata file
+  even if unchanged, e.g. to retry the entries which failed,
+- on request through the control API.
+
+As the entries already harvested are skipped, every harvest only processes the new entries and
+the entries not harvested yet. The metadata files already harvested are recorded in
+data_path/daemon_state.json.
+
+A small HTTP control API listens on the local interface ("daemon_host", default 127.0.0.1, and
+"daemon_port", default 8079, 0 to disable):
+
+- GET /status: state of the daemon, current and last harvests, counts of the entries,
+- POST /pause: no new entry is started, the entries in progress are completed,
+- POST /resume: the harvesting continues,
+- POST /drain: no new entry is started, the entries in progress are completed and stored, the
+  state is flushed and the daemon stops,
+- POST /harvest: start an incremental harvest now.
+
+SIGTERM and SIGINT drain the daemon the same way, for a graceful shutdown.
+"""
+
+import os
+import json
+import time
+import signal
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+# metrics of the harvesting stages
+from arxiv_harvester.metrics import metrics
+
+# logging
+import logging
+import logging.handlers
+
+METADATA_SUFFIXES = (".json", ".json.gz", ".zip")
+
+class HarvestGate(object):
+    """
+    Admission of the entries by the harvester: blocks while paused, and stops the harvesting once
+    drained
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self.paused = False
+        self.draining = False
+
+    def admit(self):
+        '''
+        Return True if a new entry can be started, waiting while paused, False once drained
+        '''
+        with self._condition:
+            while self.paused and not self.draining:
+                self._condition.wait()
+            return not self.draining
+
+    def is_open(self):
+        return not self.draining
+
+    def pause(self):
+        with self._condition:
+            self.paused = True
+
+    def resume(self):
+        with self._condition:
+            self.paused = False
+            self._condition.notify_all()
+
+    def drain(self):
+        with self._condition:
+            self.draining = True
+            self._condition.notify_all()
+
+class HarvestDaemon(object):
+
+    def __init__(self, harvester, config, metadata_file=None):
+        self.harvester = harvester
+        self.config = config
+        self.watch_path = config.get("daemon_watch", metadata_file)
+        self.feed_url = config.get("daemon_feed_url", None)
+        self.poll_interval = config.get("daemon_poll_interval", 300)
+        self.settle_seconds = config.get("daemon_settle_seconds", 60)
+        self.refresh_times = []
+        for refresh_time in config.get("daemon_refresh_times", []):
+            try:
+                hours, minutes = refresh_time.split(":")
+                self.refresh_times.append(int(hours) * 60 + int(minutes))
+            except ValueError:
+                logging.error("invalid daemon_refresh_times value " + str(refresh_time) + ", ignored")
+        self.host = config.get("daemon_host", "127.0.0.1")
+        self.port = config.get("daemon_port", 8079)
+        self.state_path = os.path.join(config["data_path"], "daemon_state.json")
+        self.feed_path = os.path.join(config["data_path"], "feed")
+
+        self.gate = HarvestGate()
+        harvester.gate = self.gate
+        if harvester.session is None:
+            # keep-alive connections to the PDF server, kept between the harvests
+            harvester.session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=config.get("daemon_http_pool_size", 16))
+            harvester.session.mount("http://", adapter)
+            harvester.session.mount("https://", adapter)
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._harvest_requested = False
+        self._server = None
+        self.state = _load_state(self.state_path)
+        self.started = time.time()
+        self.current = None
+        self.last = None
+        self._last_refresh = None
+
+    def run(self):
+        '''
+        Serve until drained, by the control API or a signal
+        '''
+        self._install_signal_handlers()
+        self._start_server()
+        logging.info("harvester daemon started")
+        print("harvester daemon started" + (", control API on http://" + self.host + ":" + str(self.port) if self._server is not None else ""))
+        try:
+            while self.gate.is_open():
+                for metadata_file, reason in self._pending_harvests():
+                    if not self.gate.is_open():
+                        break
+                    self._harvest(metadata_file, reason)
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        # the files still queued for the batched storages are uploaded and the state flushed
+        self.harvester._flush_storage()
+        self.harvester.env.sync()
+        self.harvester.env_failures.sync()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        logging.info("harvester daemon stopped")
+        print("harvester daemon stopped")
+
+    def pause(self):
+        self.gate.pause()
+        logging.info("harvester daemon paused")
+
+    def resume(self):
+        self.gate.resume()
+        logging.info("harvester daemon resumed")
+
+    def drain(self):
+        logging.info("harvester daemon draining")
+        self.gate.drain()
+        self._wakeup.set()
+
+    def request_harvest(self):
+        with self._lock:
+            self._harvest_requested = True
+        self._wakeup.set()
+
+    def status(self):
+        if self.gate.draining:
+            state = "draining"
+        elif self.gate.paused:
+            state = "paused"
+        elif self.current is not None:
+            state = "harvesting"
+        else:
+            state = "idle"
+        entries = {}
+        for counter in metrics.to_dict().get("counters", []):
+            if counter['name'] == "entries":
+                status = counter['labels'].get("status")
+                entries[status] = entries.get(status, 0) + counter['value']
+        status = {}
+        status['state'] = state
+        status['uptime'] = round(time.time() - self.started, 3)
+        status['current'] = self.current
+        status['last'] = self.last
+        status['entries'] = entries
+        status['watch'] = self.watch_path
+        status['feed'] = self.feed_url
+        return status
+
+    def _harvest(self, metadata_file, reason):
+        logging.info("incremental harvest of " + metadata_file + " (" + reason + ")")
+        self.current = {"metadata": metadata_file, "reason": reason, "started": time.time()}
+        error = None
+        try:
+            self.harvester.harvest(metadata_file)
+        except Exception as e:
+            logging.exception("Harvesting failed for " + metadata_file)
+            error = str(e)
+        finally:
+            finished = time.time()
+            self.last = dict(self.current, finished=finished, runtime=round(finished - self.current['started'], 3), error=error, completed=self.gate.is_open())
+            self.current = None
+        metrics.inc("daemon_harvests", reason=reason)
+        if error is None and self.gate.is_open():
+            self.state['files'][os.path.abspath(metadata_file)] = _signature(metadata_file)
+            self.state['last_file'] = os.path.abspath(metadata_file)
+            _save_state(self.state_path, self.state)
+
+    def _pending_harvests(self):
+        # (metadata file, reason) of the harvests to start now
+        harvests = []
+        for metadata_file in self._changed_files():
+            harvests.append((metadata_file, "new_metadata"))
+        feed_file = self._poll_feed()
+        if feed_file is not None:
+            harvests.append((feed_file, "feed"))
+
+        with self._lock:
+            requested = self._harvest_requested
+            self._harvest_requested = False
+        refresh = self._refresh_due()
+        if (requested or refresh) and len(harvests) == 0:
+            latest = self.state.get('last_file')
+            if latest is None or not os.path.isfile(latest):
+                files = self._watched_files()
+                latest = files[-1] if len(files) > 0 else None
+            if latest is not None:
+                harvests.append((latest, "requested" if requested else "scheduled"))
+        return harvests
+
+    def _watched_files(self):
+        # metadata files under watch, from the oldest to the most recent
+        if self.watch_path is None:
+            return []
+        if os.path.isfile(self.watch_path):
+            return [ self.watch_path ]
+        if not os.path.isdir(self.watch_path):
+            return []
+        files = []
+        for name in os.listdir(self.watch_path):
+            path = os.path.join(self.watch_path, name)
+            if name.endswith(METADATA_SUFFIXES) and os.path.isfile(path):
+                files.append(path)
+        return sorted(files, key=os.path.getmtime)
+
+    def _changed_files(self):
+        changed = []
+        now = time.time()
+        for path in self._watched_files():
+            try:
+                signature = _signature(path)
+            except OSError:
+                continue
+            if now - signature['mtime'] < self.settle_seconds:
+                # still being written
+                continue
+            if self.state['files'].get(os.path.abspath(path)) != signature:
+                changed.append(path)
+        return changed
+
+    def _poll_feed(self):
+        '''
+        Download the metadata file of the feed if modified since the last poll, return its path or None
+        '''
+        if self.feed_url is None:
+            return None
+        feed_state = self.state.setdefault('feed', {})
+        headers = {}
+        if feed_state.get('etag') is not None:
+            headers['If-None-Match'] = feed_state['etag']
+        if feed_state.get('last_modified') is not None:
+            headers['If-Modified-Since'] = feed_state['last_modified']
+        name = os.path.basename(self.feed_url.split("?")[0])
+        if not name.endswith(METADATA_SUFFIXES):
+            name += ".json"
+        destination = os.path.join(self.feed_path, name)
+        try:
+            with requests.get(self.feed_url, headers=headers, timeout=60, stream=True) as response:
+                if response.status_code == 304:
+                    return None
+                if response.status_code != 200:
+                    logging.error("Could not poll the metadata feed " + self.feed_url + ": HTTP " + str(response.status_code))
+                    return None
+                os.makedirs(self.feed_path, exist_ok=True)
+                with open(destination + ".tmp", "wb") as f_out:
+                    for chunk in response.iter_content(chunk_size=1024 * 1024):
+                        f_out.write(chunk)
+                os.replace(destination + ".tmp", destination)
+                feed_state['etag'] = response.headers.get("ETag")
+                feed_state['last_modified'] = response.headers.get("Last-Modified")
+        except (requests.exceptions.RequestException, OSError):
+            logging.exception("Could not poll the metadata feed " + self.feed_url)
+            return None
+        _save_state(self.state_path, self.state)
+        return destination
+
+    def _refresh_due(self):
+        # True once per scheduled refresh time
+        if len(self.refresh_times) == 0:
+            return False
+        now = time.localtime()
+        minutes = now.tm_hour * 60 + now.tm_min
+        today = time.strftime("%Y-%m-%d", now)
+        for refresh_time in self.refresh_times:
+            key = today + " " + str(refresh_time)
+            if refresh_time <= minutes < refresh_time + max(1, int(self.poll_interval // 60) + 1) and self._last_refresh != key:
+                self._last_refresh = key
+                return True
+        return False
+
+    def _install_signal_handlers(self):
+        if threading.current_thread() is not threading.main_thread():
+            return
+        def handler(signum, frame):
+            logging.warning("signal " + str(signum) + " received, draining the harvester daemon")
+            print("draining, the entries in progress are completed...")
+            self.drain()
+        signal.signal(signal.SIGTERM, handler)
+        signal.signal(signal.SIGINT, handler)
+
+    def _start_server(self):
+        if self.port is None or self.port <= 0:
+            return
+        try:
+            self._server = ThreadingHTTPServer((self.host, self.port), _ControlHandler)
+            self._server.daemon_threads = True
+            self._server.harvest_daemon = self
+            threading.Thread(target=self._server.serve_forever, name="daemon-control", daemon=True).start()
+        except OSError:
+            logging.exception("Could not start the control API on port " + str(self.port))
+            self._server = None
+
+class _ControlHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] == "/status":
+            self._send(200, self.server.harvest_daemon.status())
+        else:
+            self._send(404, {"error": "unknown path " + self.path})
+
+    def do_POST(self):
+        daemon = self.server.harvest_daemon
+        command = self.path.split("?")[0].strip("/")
+        if command == "pause":
+            daemon.pause()
+        elif command == "resume":
+            daemon.resume()
+        elif command == "drain":
+            daemon.drain()
+        elif command == "harvest":
+            daemon.request_harvest()
+        else:
+            self._send(404, {"error": "unknown command " + command})
+            return
+        self._send(200, daemon.status())
+
+    def _send(self, code, content):
+        body = json.dumps(content).encode("UTF-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def control(config, command):
+    '''
+    Send a command (status, pause, resume, drain or harvest) to the daemon running with the given
+    config, return its status
+    '''
+    url = "http://" + config.get("daemon_host", "127.0.0.1") + ":" + str(config.get("daemon_port", 8079)) + "/" + command
+    if command == "status":
+        response = requests.get(url, timeout=10)
+    else:
+        response = requests.post(url, timeout=10)
+    response.raise_for_status()
+    return response.json()
+
+def _signature(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+def _load_state(path):
+    state = None
+    if os.path.isfile(path):
+        try:
+            with open(path) as the_file:
+                state = json.load(the_file)
+        except (IOError, ValueError):
+            logging.exception("Could not read the daemon state " + path + ", starting from an empty state")
+    if state is None:
+        state = {}
+    state.setdefault('files', {})
+    return state
+
+def _save_state(path, state):
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "w") as the_file:
+            json.dump(state, the_file, indent=2)
+        os.replace(tmp_path, path)
+    except (IOError, OSError):
+        logging.exception("Could not write the daemon state " + path)
@@ -8,16 +8,43 @@ import uuid
 import subprocess
 import argparse
 import time
+import itertools
+import functools
+import threading
+import queue
 from concurrent.futures import ThreadPoolExecutor
 from random import randint, choices
 from tqdm import tqdm
 from zipfile import ZipFile
 
-# support for S3
-import arxiv_harvester.S3 as S3
+# storage backends (S3, SWIFT, HuggingFace, local file system), imported on demand
+import arxiv_harvester.backends as backends
 
-# support for SWIFT object storage
-import arxiv_harvester.swift as swift
+# parallel listing of the storage backends
+import arxiv_harvester.listing as listing
+from arxiv_harvester.batching import CallbackGroup
+
+# bounded local resources
+import arxiv_harvester.budget as budget
+
+# bandwidth limits shared by the harvesting processes
+import arxiv_harvester.bandwidth as bandwidth
+
+# lease-based partitioning of the work between several nodes
+import arxiv_harvester.coordination as coordination
+
+# deadlines of the entries and hedged downloads
+import arxiv_harvester.stragglers as stragglers
+
+# priority order of the entries
+import arxiv_harvester.scheduler as scheduler
+
+# validation of the downloaded content
+import arxiv_harvester.integrity as integrity
+
+# metrics of the harvesting stages
+from arxiv_harvester.metrics import metrics, MetricsReporter
+import arxiv_harvester.profiling as profiling
 
 # for accessing google cloud import storage
 import urllib3
@@ -33,9 +60,11 @@ logging.getLogger("swiftclient").setLevel(logging.ERROR)
 # public access base for google cloud storage
 gcs_base = "https://storage.googleapis.com/arxiv-dataset/arxiv/"
 
+# size of the chunks of the downloaded files written on the disk
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
 import pickle
 import lmdb
-from huggingface_hub import HfApi
 
 # init LMDB
 map_size = 200 * 1024 * 1024 * 1024 
@@ -47,18 +76,55 @@ class ArXivHarvester(object):
 
         self._init_lmdb()
 
-        self.s3 = None
-        if "bucket_name" in self.config and len(self.config["bucket_name"].strip()) > 0:
-            self.s3 = S3.S3(self.config)
+        self.s3 = backends.get_backend("s3", self.config)
+        self.swift = backends.get_backend("swift", self.config)
+        self.hf = backends.get_backend("hf", self.config)
+        self.local = backends.load("local", self.config)
+
+        # base url of the PDF files, which can be changed for mirrors or for benchmarking
+        self.gcs_base = self.config.get("gcs_base", gcs_base)
+
+        # label of the storage backend in the metrics
+        self.backend_name = _backend_name(self)
+
+        # local disk space used by the files of the entries being harvested, until they are stored, 
+        # with an estimated size reserved for each new entry before its download
+        self.disk_budget = budget.ByteBudget(self.config.get("disk_budget", 10 * 1024 * 1024 * 1024), name="disk")
+        self.entry_size_estimate = self.config.get("entry_size_estimate", 2 * 1024 * 1024)
+
+        # ingress and egress bandwidth limits, shared with the other harvesting processes
+        bandwidth.configure(self.config)
 
-        self.swift = None
-        if "swift" in self.config and len(self.config["swift"])>0 and "swift_container" in self.config and len(self.config["swift_container"])>0:
-            self.swift = swift.Swift(self.config)
+        # an entry still running after entry_timeout seconds is cancelled, so that a hung download
+        # cannot stall its batch
+        self.entry_timeout = self.config.get("entry_timeout", 600)
+        self.watchdog = stragglers.DeadlineWatchdog()
 
-        self.hf = None
-        if "hf_repo_id" in self.config and len(self.config["hf_repo_id"].strip())>0:
-            self.hf = HfApi()
-            self.hf_token = None
+        # pending entries ordered by priority (fresh entries first), instead of the file order
+        self.scheduler = None
+        if self.config.get("schedule", False):
+            self.scheduler = scheduler.HarvestScheduler(self.config)
+
+        # a download slower than the p95 of the observed download latencies is duplicated, within
+        # the budget of hedged requests
+        self.hedge_budget = stragglers.HedgeBudget(self.config.get("hedge_budget", 0.05), self.config.get("hedge_max_in_flight", 4))
+        self.hedge_min_samples = self.config.get("hedge_min_samples", 50)
+        self.hedge_min_delay = self.config.get("hedge_min_delay", 1.0)
+
+        # downloaded files are validated while streamed, an invalid file is downloaded again up to 
+        # integrity_retries times, then recorded as failed and not stored
+        self.integrity_checks = self.config.get("integrity_checks", True)
+        self.integrity_retries = self.config.get("integrity_retries", 1)
+
+        # daemon mode: admission of the new entries (pause and drain), and HTTP session kept 
+        # between the harvests
+        self.gate = None
+        self.session = None
+
+        # distributed harvesting, the metadata file is split into shards leased by the nodes
+        self.coordinator = coordination.get_coordinator(self.config, "entries", s3=self.s3)
+        # entries committed in the shard being processed, published when the shard is done
+        self._shard_profiles = None
 
     def _init_lmdb(self):
         # create the data path if it does not exist 
@@ -74,6 +140,13 @@ class ArXivHarvester(object):
         envFilePath = os.path.join(self.config["data_path"], 'entries')
         self.env = lmdb.open(envFilePath, map_size=map_size)
 
+        # entries whose download failed the integrity checks, to be harvested again
+        envFilePath = os.path.join(self.config["data_path"], 'failures')
+        self.env_failures = lmdb.open(envFilePath, map_size=map_size)
+        # identifiers of the recorded failures, so that a commit does not write to the failures if not needed
+        with self.env_failures.begin() as txn:
+            self._failed_ids = set(key.decode(encoding='UTF-8') for key, value in txn.cursor())
+
     def harvest(self, metadata_file):
         if 'batch_size' in self.config:
             batch_size_pdf = self.config['batch_size']
@@ -99,21 +172,120 @@ class ArXivHarvester(object):
         logging.info("total entries found: " + str(count))
         file_in.close()
 
+        reporter = MetricsReporter(self.config, "stats.json").start()
+        profiler = profiling.start(self.config, "harvester")
+        try:
+            if self.coordinator is not None:
+                self._harvest_shards(metadata_file, count, batch_size_pdf)
+            else:
+                self._harvest_entries(metadata_file, count, batch_size_pdf)
+        finally:
+            profiling.stop(profiler)
+            reporter.stop()
+
+    def _harvest_entries(self, metadata_file, count, batch_size_pdf):
         # iterate through the jsonl file
         file_in = _get_json_file_reader(metadata_file, 'r')
-        i = 0
-        entries = []
-        for line in tqdm(file_in, total=count):
+        self._harvest_lines(tqdm(file_in, total=count), batch_size_pdf)
+        file_in.close()
 
-            if i == batch_size_pdf:
-                result = self.processBatch(entries)
-                entries = []
-                i = 0
+        self._flush_storage()
 
-            entry = json.loads(line)
+        dump_destination = os.path.join(self.config["data_path"], "arxiv_list.json")
+        self.dump_map(dump_destination)
+
+    def _harvest_shards(self, metadata_file, count, batch_size_pdf):
+        """
+        Distributed harvesting: the lines of the metadata file are split into shards of
+        coordination_shard_size entries, and only the shards leased by this node are harvested.
+        All the nodes must use the same metadata file and shard size.
+        """
+        shard_size = self.config.get("coordination_shard_size", 5000)
+        nb_shards = (count + shard_size - 1) // shard_size
+        units = [ "shard-%06d" % shard for shard in range(nb_shards) ]
+        print("node " + self.coordinator.node_id + ", " + str(nb_shards) + " shards of " + str(shard_size) + " entries")
+
+        self.coordinator.start()
+        file_in = None
+        line_number = 0
+        try:
+            with tqdm(total=nb_shards) as pbar:
+                for unit in self.coordinator.iter_units(units):
+                    if self.gate is not None and not self.gate.is_open():
+                        # drained daemon, the shard is left to the other nodes
+                        self.coordinator.release(unit)
+                        break
+                    start = int(unit.split("-")[-1]) * shard_size
+                    if file_in is None or line_number > start:
+                        # shards are leased in increasing order in every pass over the units
+                        if file_in is not None:
+                            file_in.close()
+                        file_in = _get_json_file_reader(metadata_file, 'r')
+                        line_number = 0
+                    # skip the lines up to the beginning of the shard, without parsing them
+                    for line in itertools.islice(file_in, start - line_number):
+                        pass
+
+                    self._shard_profiles = []
+                    try:
+                        self._harvest_lines(itertools.islice(file_in, shard_size), batch_size_pdf)
+                        self._flush_storage()
+                        if self.gate is not None and not self.gate.is_open():
+                            # interrupted shard, not complete
+                            self.coordinator.release(unit)
+                            break
+                        state = {}
+                        state['entries'] = self._shard_profiles
+                        self.coordinator.complete(unit, state)
+                        line_number = start + shard_size
+                    except Exception:
+                        logging.exception("Harvesting failed for the metadata " + unit)
+                        self.coordinator.release(unit)
+                        # the position in the file is unknown, it will be opened again
+                        file_in.close()
+                        file_in = None
+                    finally:
+                        self._shard_profiles = None
+                    pbar.update(1)
+        finally:
+            if file_in is not None:
+                file_in.close()
+            self.coordinator.stop()
+
+        dump_destination = os.path.join(self.config["data_path"], "arxiv_list.json")
+        self.dump_map(dump_destination)
+
+    def _harvest_lines(self, lines, batch_size_pdf):
+        # harvest the entries of the given jsonl lines not already harvested, by batches, in the 
+        # order of the lines or in the order of the scheduler
+        entries = self._iter_pending(lines)
+        if self.scheduler is not None:
+            entries = self.scheduler.schedule(entries)
+
+        batch = []
+        for entry in entries:
+            # paused or drained daemon
+            if self.gate is not None and not self.gate.admit():
+                break
+            batch.append(entry)
+            if len(batch) == batch_size_pdf:
+                result = self.processBatch(batch)
+                batch = []
+
+        # we need to process the latest incomplete batch (if not empty)
+        if len(batch) >0:
+            result = self.processBatch(batch)
+
+    def _iter_pending(self, lines, skip_harvested=True):
+        # iterate over the entries of the given jsonl lines (or metadata dicts) not already harvested
+        for line in lines:
+            entry = line if isinstance(line, dict) else json.loads(line)
             if 'id' not in entry:
                 logging.info("entry without arxiv id, skipping...")
                 continue
+            if not skip_harvested:
+                yield entry
+                continue
 
             arxiv_id = entry['id']
             versions = _get_versions(entry)
@@ -134,22 +306,181 @@ class ArXivHarvester(object):
             if found:
                 continue
 
-            entries.append(entry)
-            i += 1
-
-        # we need to process the latest incomplete batch (if not empty)
-        if len(entries) >0:
-            result = self.processBatch(entries)
+            yield entry
 
-        dump_destination = os.path.join(self.config["data_path"], "arxiv_list.json")
-        self.dump_map(dump_destination)
+    def _flush_storage(self):
+        # upload the files still queued for the batched storages
+        if self.swift is not None:
+            self.swift.flush()
+        if self.hf is not None:
+            self.hf.flush()
 
     def processBatch(self, entries):
+        # the batch always ends, as every entry is cancelled once its deadline is exceeded
         with ThreadPoolExecutor(max_workers=12) as executor:
-            results = executor.map(self.process_entry, entries, timeout=60)
+            for entry in entries:
+                # admission control: an entry is started only when there is enough disk space for 
+                # its files, otherwise the harvesting waits for the pending uploads
+                reservation = budget.Reservation(self.disk_budget, self.entry_size_estimate)
+                executor.submit(self.process_entry, entry, reservation)
         return "success"
 
-    def process_entry(self, entry):
+    def iter_harvest(self, entries, store=True, skip_harvested=None, keep_files=False, with_content=False, max_workers=12, max_pending=None):
+        """
+        Harvest the given entries and yield the result of every entry as soon as it is completed,
+        in the order of completion, to process the harvested articles in the same process: 
+
+            for result in harvester.iter_harvest(entries, store=False):
+                if result['status'] == "downloaded":
+                    parse(result['path'])
+
+        entries are metadata dicts or jsonl lines. A result is a dict with the keys:
+        - id, version (None if not found) and metadata (the metadata dict of the entry),
+        - status: "harvested" (stored and recorded as harvested), "downloaded" (with store=False),
+          "not_found", "failed" or "cancelled" (deadline exceeded),
+        - path: local path of the PDF file (gzipped if compression is set in the config), or None,
+        - size: size in bytes of this file,
+        - storage_key: path of the PDF file in the storage if stored, e.g. arxiv/1501/1501.00001/1501.00001.pdf.gz,
+        - content: the bytes of the PDF (decompressed), only with with_content=True.
+
+        The local files of an entry are removed when the next result is requested, unless 
+        keep_files is True: the files then belong to the caller. With store=False, the files are 
+        not stored and the entries are not recorded as harvested. The already harvested entries 
+        are skipped if skip_harvested is True, by default when store is True. At most max_pending
+        entries (default 2 x max_workers) are in progress or waiting to be consumed, so that a
+        slow consumer slows down the harvesting.
+        """
+        if skip_harvested is None:
+            skip_harvested = store
+        if max_pending is None:
+            max_pending = 2 * max_workers
+
+        pending = self._iter_pending(entries, skip_harvested=skip_harvested)
+
+        results = queue.Queue()
+        # number of entries in progress or not yet consumed
+        slots = threading.Semaphore(max_pending)
+        stop = threading.Event()
+
+        def listener(result, resources, reservation):
+            results.put((result, resources, reservation))
+
+        def feed():
+            try:
+                with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    for entry in pending:
+                        while not slots.acquire(timeout=1):
+                            if stop.is_set():
+                                return
+                        if stop.is_set():
+                            slots.release()
+                            return
+                        reservation = budget.Reservation(self.disk_budget, self.entry_size_estimate)
+                        executor.submit(self.process_entry, entry, reservation, listener, store)
+            except Exception:
+                logging.exception("Reading the entries to harvest failed")
+            finally:
+                # the files still queued for the batched storages are uploaded, so that all the
+                # results are delivered
+                self._flush_storage()
+                results.put(None)
+
+        feeder = threading.Thread(target=feed, name="harvest-feeder", daemon=True)
+        feeder.start()
+        try:
+            while True:
+                item = results.get()
+                if item is None:
+                    break
+                result, resources, reservation = item
+                try:
+                    if with_content and result['path'] is not None:
+                        result['content'] = _read_pdf(result['path'])
+                    yield result
+                finally:
+                    if not keep_files:
+                        for resource in resources:
+                            _remove_file(resource)
+                    reservation.release()
+                    slots.release()
+        finally:
+            # the caller stopped early: the entries in progress are completed and their files removed
+            stop.set()
+            while feeder.is_alive() or not results.empty():
+                try:
+                    item = results.get(timeout=1)
+                except queue.Empty:
+                    continue
+                if item is None:
+                    continue
+                result, resources, reservation = item
+                if not keep_files:
+                    for resource in resources:
+                        _remove_file(resource)
+                reservation.release()
+                slots.release()
+            feeder.join()
+
+    async def aiter_harvest(self, entries, **kwargs):
+        """
+        Asynchronous version of iter_harvest(), with the same parameters, for asyncio pipelines:
+
+            async for result in harvester.aiter_harvest(entries, store=False):
+                ...
+
+        The harvesting runs in threads, the event loop is never blocked.
+        """
+        # not imported with the module, as it is only needed by this method
+        import asyncio
+        loop = asyncio.get_running_loop()
+        results = self.iter_harvest(entries, **kwargs)
+        try:
+            while True:
+                result = await loop.run_in_executor(None, next, results, None)
+                if result is None:
+                    break
+                yield result
+        finally:
+            await loop.run_in_executor(None, results.close)
+
+    def process_entry(self, entry, reservation=None, listener=None, store=True):
+        """
+        Harvest one entry. listener, if not None, is called with the result of the entry (see 
+        iter_harvest()), the local files of the entry and its disk reservation, the files being 
+        then kept until the listener releases the reservation. If store is False, the files are 
+        not stored and the entry is not recorded as harvested.
+        """
+        if reservation is None:
+            reservation = budget.Reservation(self.disk_budget)
+        # the deadline starts when the entry starts, not when it is queued
+        deadline = self.watchdog.track("entry " + entry['id'], self.entry_timeout)
+        status = None
+        try:
+            with profiling.entry(entry['id']):
+                return self._process_entry(entry, reservation, deadline, listener, store)
+        except stragglers.Cancelled as e:
+            # not committed, the entry will be harvested again by the next run
+            logging.warning("Processing cancelled for entry " + entry['id'] + ": " + str(e))
+            metrics.inc("entries", status="cancelled")
+            reservation.release()
+            status = "cancelled"
+        except integrity.IntegrityError as e:
+            # not committed either, the failure is recorded and the entry will be harvested again
+            logging.error("Invalid download for entry " + entry['id'] + ": " + str(e))
+            metrics.inc("entries", status="invalid")
+            self.record_failure(entry['id'], e)
+            reservation.release()
+            status = "failed"
+        except Exception:
+            logging.exception("Processing failed for entry " + entry['id'])
+            reservation.release()
+            status = "failed"
+        finally:
+            self.watchdog.untrack(deadline)
+            if status is not None and listener is not None:
+                listener(_entry_result(entry, None, None, status), [], reservation)
+
+    def _process_entry(self, entry, reservation, deadline=None, listener=None, store=True):
         arxiv_id = entry['id']
         versions =  _get_versions(entry)
     
@@ -167,11 +498,11 @@ class ArXivHarvester(object):
 
         latest_version = None
         for version in versions:
-            pdf_location = gcs_base + collection + '/pdf/' + prefix + "/" + full_number + version + ".pdf"   
+            pdf_location = self.gcs_base + collection + '/pdf/' + prefix + "/" + full_number + version + ".pdf"   
             destination_pdf = os.path.join(self.config["data_path"], full_number + ".pdf")        
             # note: destination file nanme can change if compression is true in config
             #print(pdf_location)
-            destination_pdf = self.download_file(pdf_location, destination_pdf, compression=self.config["compression"])
+            destination_pdf = self.download_file(pdf_location, destination_pdf, compression=self.config["compression"], collection=collection, deadline=deadline)
             if destination_pdf is not None:
                 latest_version = version
                 break
@@ -179,9 +510,9 @@ class ArXivHarvester(object):
         if destination_pdf is None:    
             # if PDF not found, look for a ps file
             version = versions[0]
-            ps_location = gcs_base + collection + '/ps/' + prefix + "/" + full_number + version + ".ps.gz"
+            ps_location = self.gcs_base + collection + '/ps/' + prefix + "/" + full_number + version + ".ps.gz"
             destination_ps = os.path.join(self.config["data_path"], full_number + ".ps.gz")
-            destination_ps = self.download_file(ps_location, destination_ps, compression=False)
+            destination_ps = self.download_file(ps_location, destination_ps, compression=False, collection=collection, deadline=deadline)
 
             if destination_ps is None:
                 # if still not found, they are 44 articles in html only 
@@ -191,10 +522,11 @@ class ArXivHarvester(object):
                 latest_version = version
                 # for convenience, convert .ps.gz into PDF
                 destination_pdf = os.path.join(self.config["data_path"], arxiv_id + ".pdf")
-                # first gunzip the ps file
-                subprocess.check_call(['gunzip', '-f', destination_ps])
-                destination_ps = destination_ps.replace(".ps.gz", ".ps")
-                subprocess.check_call(['ps2pdf', destination_ps, destination_pdf])
+                with metrics.stage("conversion", collection=collection):
+                    # first gunzip the ps file
+                    subprocess.check_call(['gunzip', '-f', destination_ps])
+                    destination_ps = destination_ps.replace(".ps.gz", ".ps")
+                    subprocess.check_call(['ps2pdf', destination_ps, destination_pdf])
                 # clean ps file
                 try:
                     if os.path.isfile(destination_ps):
@@ -204,73 +536,266 @@ class ArXivHarvester(object):
 
                 if destination_pdf is not None:
                     if self.config["compression"]:
-                        compression_suffix = ".gz"
-                        try:
-                            if os.path.isfile(destination_pdf):
-                                subprocess.check_call(['gzip', '-f', destination_pdf])
-                                destination_pdf += compression_suffix
-                        except:
-                            logging.error("Error compressing resource files for " + destination_pdf)   
+                        destination_pdf = _compress_file(destination_pdf, collection)
 
-        if destination_pdf is not None:
-            # store the pdf file in the selected storage
-            self.store_file(destination_pdf, arxiv_id)
+        # an entry cancelled by its deadline is not stored
+        if deadline is not None and deadline.cancelled():
+            if destination_pdf is not None:
+                _remove_file(destination_pdf)
+            deadline.check()
 
-            # update advancement status map
+        profile = None
+        if destination_pdf is not None:
+            # advancement status for the entry
             profile = {}
             profile['id'] = arxiv_id
             profile['version'] = latest_version
+            profile['size'] = os.path.getsize(destination_pdf)
             if 'doi' in entry and entry['doi'] != None:
                 profile['doi'] = entry['doi']
-            with self.env.begin(write=True) as txn:
-                txn.put(arxiv_id.encode(encoding='UTF-8'), _serialize_pickle(profile))
 
-        # store the metadata file
+        # the metadata file
         destination_json = os.path.join(self.config["data_path"], arxiv_id+".json")
         with open(destination_json, 'w', encoding='utf-8') as outfile:
             json.dump(entry, outfile, ensure_ascii=False)
         if self.config["compression"]:
-            compression_suffix = ".gz"
-            try:
-                if os.path.isfile(destination_json):
-                    subprocess.check_call(['gzip', '-f', destination_json])
-                    destination_json += compression_suffix
-            except:
-                logging.error("Error compressing resource files for " + destination_json)   
-        self.store_file(destination_json, arxiv_id)
+            destination_json = _compress_file(destination_json, collection)
+
+        if destination_pdf is not None:
+            metrics.inc("entries", status="harvested", collection=collection)
+        else:
+            metrics.inc("entries", status="not_found", collection=collection)
+
+        resources = [destination_json]
+        if destination_pdf is not None:
+            resources.insert(0, destination_pdf)
+        # the estimated disk space of the entry is replaced by the actual size of its files
+        reservation.resize(sum(os.path.getsize(resource) for resource in resources if os.path.isfile(resource)))
+
+        # store the pdf and metadata files in the selected storage, the advancement status map 
+        # is updated only once the upload is confirmed
+        def on_stored(success):
+            if store and success and profile is not None:
+                self.commit_entry(profile)
+            if listener is None:
+                reservation.release()
+                return
+            if profile is None:
+                status = "not_found"
+            elif not store:
+                status = "downloaded"
+            elif success:
+                status = "harvested"
+            else:
+                status = "failed"
+            listener(_entry_result(entry, profile, destination_pdf, status, stored=(store and success)), resources, reservation)
+
+        if store:
+            # with a listener, the files are kept for the listener after their storage
+            self.store_files(resources, arxiv_id, callback=on_stored, clean=(listener is None))
+        else:
+            on_stored(True)
 
         return "success"
 
-    def download_file(self, source_url, destination, compression=False, rolling_user_agent=True):
+    def commit_entry(self, profile):
+        """
+        Update advancement status map with a successfully harvested entry
+        """
+        with metrics.stage("commit", backend=self.backend_name):
+            with self.env.begin(write=True) as txn:
+                txn.put(profile['id'].encode(encoding='UTF-8'), _serialize_pickle(profile))
+            if profile['id'] in self._failed_ids:
+                with self.env_failures.begin(write=True) as txn:
+                    txn.delete(profile['id'].encode(encoding='UTF-8'))
+                self._failed_ids.discard(profile['id'])
+        if self._shard_profiles is not None:
+            self._shard_profiles.append(profile)
+
+    def record_failure(self, identifier, error):
+        """
+        Record an entry whose download failed the integrity checks, with the number of failed 
+        harvesting attempts, the entry is harvested again by the next run
+        """
+        key = identifier.encode(encoding='UTF-8')
+        with self.env_failures.begin(write=True) as txn:
+            local_object = txn.get(key)
+            failure = _deserialize_pickle(local_object) if local_object is not None else {'id': identifier, 'attempts': 0}
+            failure['attempts'] += 1
+            failure['reason'] = getattr(error, "reason", None)
+            failure['error'] = str(error)
+            failure['time'] = time.time()
+            txn.put(key, _serialize_pickle(failure))
+        self._failed_ids.add(identifier)
+
+    def get_failures(self):
+        """
+        Return the recorded integrity failures of the entries not harvested since
+        """
+        failures = []
+        with self.env_failures.begin() as txn:
+            for key, value in txn.cursor():
+                failures.append(_deserialize_pickle(value))
+        return failures
+
+    def download_file(self, source_url, destination, compression=False, rolling_user_agent=True, collection=None, deadline=None):
+        """
+        Download a file to destination, return the path of the file (compressed if requested) or 
+        None if the download failed. If the deadline is exceeded during the download, the partial 
+        file is removed and stragglers.Cancelled is raised. A file failing the integrity checks is 
+        downloaded again, then integrity.IntegrityError is raised if it is still invalid.
+        """
         result = "fail"
-        try:
-            if rolling_user_agent:
-                HEADERS = {"""User-Agent""": _get_random_user_agent()}
-                file_data = requests.get(source_url, allow_redirects=True, headers=HEADERS, verify=False, timeout=30)
-            else:
-                file_data = requests.get(source_url, allow_redirects=True, verify=False, timeout=30)
-            if file_data.status_code == 200:
-                with open(destination, 'wb') as f_out:
-                    f_out.write(file_data.content)
-                result = "success"
-        except Exception:
-            logging.exception("Download failed for {0} with requests".format(source_url))
+        attempt = 0
+        while result == "fail":
+            with metrics.stage("download", collection=collection) as stage:
+                try:
+                    hedge_delay = self._hedge_delay(collection)
+                    if hedge_delay is None:
+                        status, nb_bytes = self._fetch(source_url, destination, rolling_user_agent, collection, deadline)
+                    else:
+                        status, nb_bytes = self._fetch_hedged(source_url, destination, rolling_user_agent, collection, deadline, hedge_delay)
+                    stage.bytes = nb_bytes
+                    if status == 200:
+                        result = "success"
+                    else:
+                        result = "not_found"
+                except stragglers.Cancelled:
+                    stage.error = True
+                    raise
+                except integrity.IntegrityError as e:
+                    stage.error = True
+                    metrics.inc("integrity_failures", reason=e.reason, collection=collection)
+                    attempt += 1
+                    if attempt > self.integrity_retries:
+                        raise
+                    logging.warning("Invalid download for {0}, downloading again: {1}".format(source_url, e))
+                except Exception:
+                    logging.exception("Download failed for {0} with requests".format(source_url))
+                    stage.error = True
+                    result = "error"
 
         if result != "success":
             return None
 
         if compression:
-            compression_suffix = ".gz"
-            try:
-                if os.path.isfile(destination):
-                    subprocess.check_call(['gzip', '-f', destination])
-                    destination += compression_suffix
-            except:
-                logging.error("Error compressing resource files for " + destination)   
+            destination = _compress_file(destination, collection)
 
         return destination
 
+    def _hedge_delay(self, collection):
+        # time after which a download is hedged, None if hedging is disabled or there are not 
+        # enough observed downloads yet
+        if self.hedge_budget.ratio <= 0 or metrics.count("download", collection=collection) < self.hedge_min_samples:
+            return None
+        p95 = metrics.quantile("download", 0.95, collection=collection)
+        if p95 is None or p95 == float("inf"):
+            return None
+        return max(p95, self.hedge_min_delay)
+
+    def _fetch(self, source_url, destination, rolling_user_agent, collection, cancellation=None):
+        """
+        GET a file and write it to destination by chunks, so that a large file is not held in
+        memory. Return the HTTP status and the number of bytes written. The download can be 
+        interrupted through the cancellation, raising stragglers.Cancelled after removing the 
+        partial file. The content is validated as it is written, integrity.IntegrityError is raised
+        after removing the file if it is invalid.
+        """
+        headers = None
+        if rolling_user_agent:
+            headers = {"""User-Agent""": _get_random_user_agent()}
+        http = self.session if self.session is not None else requests
+        file_data = http.get(source_url, allow_redirects=True, headers=headers, verify=False, timeout=30, stream=True)
+        interrupt = functools.partial(stragglers.interrupt_response, file_data)
+        if cancellation is not None:
+            cancellation.register(interrupt)
+        nb_bytes = 0
+        try:
+            with file_data:
+                metrics.inc("http_responses", status=file_data.status_code, collection=collection)
+                if file_data.status_code != 200:
+                    return file_data.status_code, 0
+                validator = None
+                if self.integrity_checks:
+                    expected_length, md5 = integrity.response_checks(file_data.headers)
+                    validator = integrity.StreamValidator(integrity.content_kind(source_url), expected_length=expected_length, md5=md5)
+                with open(destination, 'wb') as f_out:
+                    try:
+                        for chunk in file_data.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                            if cancellation is not None:
+                                cancellation.check()
+                            f_out.write(chunk)
+                            nb_bytes += len(chunk)
+                            if validator is not None:
+                                validator.update(chunk)
+                            bandwidth.throttle("ingress", len(chunk))
+                    except requests.exceptions.ChunkedEncodingError as e:
+                        # connection closed before the end of the content
+                        if cancellation is not None:
+                            cancellation.check()
+                        if validator is None:
+                            raise
+                        raise integrity.IntegrityError("length", "incomplete content after " + str(nb_bytes) + " bytes: " + str(e))
+                # an interrupted read can end as a truncated content without error
+                if cancellation is not None:
+                    cancellation.check()
+                if validator is not None:
+                    validator.finish()
+        except BaseException:
+            _remove_file(destination)
+            raise
+        finally:
+            if cancellation is not None:
+                cancellation.unregister(interrupt)
+        return 200, nb_bytes
+
+    def _fetch_hedged(self, source_url, destination, rolling_user_agent, collection, deadline, delay):
+        """
+        Same as _fetch(), with a duplicate request if the download takes more than delay seconds.
+        Each request writes its own part file, the part of the first request to finish is kept.
+        """
+        parts = [ destination + ".part0", destination + ".part1" ]
+        def attempt(i, cancellation):
+            return self._fetch(source_url, parts[i], rolling_user_agent, collection, cancellation)
+        try:
+            winner, (status, nb_bytes) = stragglers.hedged_call(attempt, delay, self.hedge_budget, parent=deadline, name=source_url)
+            if status == 200:
+                os.replace(parts[winner], destination)
+        finally:
+            for part in parts:
+                _remove_file(part)
+        return status, nb_bytes
+
+    def store_files(self, sources, identifier, callback=None, clean=True):
+        """
+        Store the resource files of an entry in the selected storage. 
+
+        callback, if not None, is called with True once all the files are stored, or with False if 
+        the storage failed. With SWIFT and HuggingFace storage, the files are uploaded asynchronously 
+        by batches and the callback is called from the background upload thread. 
+        """
+        sources = [source for source in sources if os.path.isfile(source)]
+
+        if self.swift is not None:
+            # to SWIFT object storage, the files of the entry are uploaded together with the next batch
+            self.swift.add_files(sources, _get_storage_path(identifier), callback=callback, clean=clean)
+
+        elif self.hf is not None:
+            group = CallbackGroup(len(sources), callback)
+            for source in sources:
+                self.hf.add_file(source, _get_storage_path(identifier), callback=group, clean=clean)
+
+        else:
+            results = [ self.store_file(source, identifier, clean=clean) for source in sources ]
+            if callback is not None:
+                callback(all(results))
+
     def store_file(self, source, identifier, clean=True):
+        """
+        Store one resource file of an entry in the selected storage, return True if the file is 
+        stored (or queued for a batched storage)
+        """
+        success = False
         file_name = os.path.basename(source)
         collection, prefix, number = _generate_storage_components(identifier)
 
@@ -280,40 +805,56 @@ class ArXivHarvester(object):
             full_number = prefix+number
 
         if self.s3 is not None:
-            try:
-                if os.path.isfile(source):
-                    dest_path = os.path.join(collection, prefix, full_number)
-                    self.s3.upload_file_to_s3(source, dest_path, storage_class='ONEZONE_IA')
-            except:
-                logging.error("Error writing on S3 bucket")
+            with metrics.stage("upload", backend="s3", collection=collection) as stage:
+                try:
+                    if os.path.isfile(source):
+                        stage.bytes = os.path.getsize(source)
+                        dest_path = os.path.join(collection, prefix, full_number)
+                        success = self.s3.upload_file_to_s3(source, dest_path, storage_class='ONEZONE_IA')
+                        if not success:
+                            stage.error = True
+                except:
+                    logging.error("Error writing on S3 bucket")
+                    stage.error = True
 
         elif self.swift is not None:
             # to SWIFT object storage, we can do a bulk upload for all the resources associated to the entry
-            try:
-                if os.path.isfile(source):
-                    dest_path = os.path.join(collection, prefix, full_number)
-                    self.swift.upload_file_to_swift(source, dest_path)
-            except:
-                logging.error("Error writing on SWIFT object storage")
+            with metrics.stage("upload", backend="swift", collection=collection) as stage:
+                try:
+                    if os.path.isfile(source):
+                        stage.bytes = os.path.getsize(source)
+                        dest_path = os.path.join(collection, prefix, full_number)
+                        success = self.swift.upload_file_to_swift(source, dest_path)
+                        if not success:
+                            stage.error = True
+                except:
+                    logging.error("Error writing on SWIFT object storage")
+                    stage.error = True
 
         elif self.hf is not None:
-            # to HuggingFace dataset, no bulk upload afaik
+            # to HuggingFace dataset, files are staged and committed in batch, the staging queue 
+            # takes care of cleaning the file after the commit
             try:
                 if os.path.isfile(source):
                     dest_path = os.path.join(collection, prefix, full_number)
-                    self.upload_file_to_hf(source, dest_path)
+                    self.hf.add_file(source, dest_path, clean=clean)
+                    return True
             except:
                 logging.error("Error writing on HuggingFace dataset storage")
 
         else:
-            # save under local storate indicated by data_path in the config json
-            try:
-                local_dest_path = os.path.join(self.config["data_path"], collection, prefix, full_number)
-                os.makedirs(local_dest_path, exist_ok=True)
-                if os.path.isfile(source):
-                    shutil.copyfile(source, os.path.join(local_dest_path, file_name))
-            except IOError:
-                logging.exception("invalid path")    
+            # save under local storate indicated by data_path in the config json, the file is 
+            # moved (atomic rename) rather than copied when it has to be cleaned
+            with metrics.stage("upload", backend="local", collection=collection) as stage:
+                try:
+                    if os.path.isfile(source):
+                        stage.bytes = os.path.getsize(source)
+                        dest_path = os.path.join(collection, prefix, full_number)
+                        self.local.store_file(source, dest_path, file_name, move=clean)
+                        return True
+                except (IOError, OSError):
+                    logging.exception("invalid path")    
+                    stage.error = True
 
         # clean stored files
         if clean:
@@ -322,6 +863,7 @@ class ArXivHarvester(object):
                     os.remove(source)
             except IOError:
                 logging.exception("temporary file cleaning failed")   
+        return success
 
     def dump_map(self, destination):
         # init lmdb transactions
@@ -357,12 +899,145 @@ class ArXivHarvester(object):
             except:
                 logging.error("Error writing on SWIFT object storage")
 
+        elif self.hf is not None:
+            try:
+                if os.path.isfile(destination):
+                    self.hf.upload_file_to_hf(destination)
+            except:
+                logging.error("Error writing on HuggingFace dataset storage")
+
         return destination
 
+    def get_storage_backend(self):
+        """
+        Return the storage backend selected in the config
+        """
+        if self.s3 is not None:
+            return self.s3
+        elif self.swift is not None:
+            return self.swift
+        elif self.hf is not None:
+            return self.hf
+        else:
+            return self.local
+
+    def reconcile(self, metadata_file=None, report_file=None):
+        """
+        Rebuild the state of advancement of the harvesting from the listing of the storage backend, 
+        which is the reference for what has been harvested. 
+
+        Harvested entries present in the storage but not in the lmdb are bulk-loaded in the lmdb, 
+        and the entries present in the lmdb but missing in the storage are reported. The storage only 
+        gives identifiers and sizes, the version of the stored PDF is taken as the latest version 
+        in the metadata file if provided (without version, the entry will be harvested again). 
+        """
+        nb_threads = self.config.get("listing_threads", 16)
+        txn_size = self.config.get("reconcile_txn_size", 10000)
+
+        # latest versions as given in the metadata file
+        metadata_profiles = {}
+        if metadata_file is not None:
+            print("\nreading versions from metadata file...")
+            file_in = _get_json_file_reader(metadata_file, 'r')
+            for line in file_in:
+                entry = json.loads(line)
+                if 'id' not in entry:
+                    continue
+                metadata_profile = {}
+                metadata_profile['version'] = _get_versions(entry)[0]
+                if 'doi' in entry and entry['doi'] != None:
+                    metadata_profile['doi'] = entry['doi']
+                metadata_profiles[entry['id']] = metadata_profile
+            file_in.close()
+        else:
+            print("\nno metadata file provided, reconciled entries will have no version information")
+
+        # list the storage backend, an entry is harvested if a PDF is stored for it
+        print("\nlisting storage...")
+        stored = {}
+        for key, size, etag in tqdm(listing.iter_storage_objects(self.get_storage_backend(), nb_threads=nb_threads)):
+            arxiv_id, file_name = listing.key_to_identifier(key)
+            if arxiv_id is None:
+                continue
+            if file_name.endswith(".pdf") or file_name.endswith(".pdf.gz"):
+                stored[arxiv_id] = size
+        print("entries found in storage:", len(stored))
+
+        # entries recorded in lmdb but not in storage
+        missing_in_storage = []
+        with self.env.begin() as txn:
+            cursor = txn.cursor()
+            for key, value in cursor:
+                arxiv_id = key.decode(encoding='UTF-8')
+                if arxiv_id not in stored:
+                    missing_in_storage.append(arxiv_id)
+
+        # entries stored but not recorded in lmdb, loaded in large write transactions
+        missing_in_lmdb = []
+        txn = self.env.begin(write=True)
+        try:
+            for arxiv_id in stored:
+                key = arxiv_id.encode(encoding='UTF-8')
+                if txn.get(key) is not None:
+                    continue
+                missing_in_lmdb.append(arxiv_id)
+                profile = {}
+                profile['id'] = arxiv_id
+                profile['size'] = stored[arxiv_id]
+                if arxiv_id in metadata_profiles:
+                    profile.update(metadata_profiles[arxiv_id])
+                txn.put(key, _serialize_pickle(profile))
+                if len(missing_in_lmdb) % txn_size == 0:
+                    txn.commit()
+                    txn = self.env.begin(write=True)
+            txn.commit()
+        except:
+            txn.abort()
+            raise
+
+        print("entries recorded but missing in storage:", len(missing_in_storage))
+        print("entries stored but not recorded, now loaded:", len(missing_in_lmdb))
+
+        if report_file is None:
+            report_file = os.path.join(self.config["data_path"], "reconcile_report.json")
+        with open(report_file, 'w') as file_out:
+            report = {}
+            report['stored'] = len(stored)
+            report['missing_in_storage'] = missing_in_storage
+            report['missing_in_lmdb'] = missing_in_lmdb
+            json.dump(report, file_out, indent=2)
+        print("reconciliation report written in", report_file)
+
+        return missing_in_storage, missing_in_lmdb
+
     def diagnostic(self):
         with self.env.begin(write=True) as txn:
             nb_total = txn.stat()['entries']
             print("\nnumber of successfully harvested entries:", nb_total)            
+        with self.env_failures.begin() as txn:
+            nb_failures = txn.stat()['entries']
+            print("number of entries with invalid downloads, to be harvested again:", nb_failures)
+
+        if self.coordinator is not None:
+            _print_global_view(self.coordinator)
+
+    def merge_state(self):
+        """
+        Distributed harvesting: import in the local lmdb the entries published by all the nodes for
+        their done shards, so that the local state gives the global view of the harvesting
+        """
+        if self.coordinator is None:
+            print("no coordination set in the config, nothing to merge")
+            return
+        nb_shards = 0
+        nb_entries = 0
+        for unit, node, state in self.coordinator.iter_states():
+            with self.env.begin(write=True) as txn:
+                for profile in state['entries']:
+                    txn.put(profile['id'].encode(encoding='UTF-8'), _serialize_pickle(profile))
+            nb_shards += 1
+            nb_entries += len(state['entries'])
+        print("merged " + str(nb_entries) + " entries from " + str(nb_shards) + " shards")
 
     def reset(self):
         """
@@ -371,88 +1046,88 @@ class ArXivHarvester(object):
         """
         # close environments
         self.env.close()
+        self.env_failures.close()
 
         envFilePath = os.path.join(self.config["data_path"], 'entries')
         shutil.rmtree(envFilePath)
+        envFilePath = os.path.join(self.config["data_path"], 'failures')
+        shutil.rmtree(envFilePath, ignore_errors=True)
 
         # re-init the environments
         self._init_lmdb()
 
-    def upload_file_to_hf(self, file_path, dest_path=None):
-        """
-        Upload the given file to HuggingFace dataset
-        """
-        MAX_ATTEMPTS = 20
-        SLEEP_TIME_SECONDS = 30
+def _print_global_view(coordinator):
+    view = coordinator.global_view()
+    print("units of all the nodes:", ", ".join(status + ": " + str(nb) for status, nb in sorted(view['units'].items())))
+    for node, statuses in sorted(view['nodes'].items()):
+        print("   node " + node + ":", ", ".join(status + ": " + str(nb) for status, nb in sorted(statuses.items())))
 
-        attempt = 0
-        while attempt < MAX_ATTEMPTS:
-            try:
-                self.upload_file(file_path, dest_path=dest_path)
-                attempt = MAX_ATTEMPTS
-                print("upload success", file_path)
-            except Exception as e:
-                attempt += 1
-                print("Failed to upload file", file_path, str(e))
-                if attempt < MAX_ATTEMPTS:
-                    print("New attempt...")
-                    time.sleep(SLEEP_TIME_SECONDS)
-                else:
-                    print(str(MAX_ATTEMPTS), "failed attempts, move to the next resource file...")
-
-    def upload_file(self, file_path, dest_path=None):
-        # note POSIX only below
-        file_name = os.path.basename(file_path)
-
-        token = self._get_hf_token()
-        repo_id = None
-        
-        if self.config != None:
-            if "hf_repo_id" in self.config:
-                if self.config["hf_repo_id"] != None and len(self.config["hf_repo_id"]) > 1:
-                    repo_id = self.config["hf_repo_id"]
-
-        if repo_id == None:
-            repo_id = "scilons/test_dataset"
-
-        dest_path = os.path.join(dest_path, file_name)
-
-        if token == None:
-            self.hf.upload_file(
-                path_or_fileobj=file_path,
-                path_in_repo=dest_path,
-                repo_id=repo_id,
-                repo_type="dataset",
-            )
-        else: 
-            self.hf.upload_file(
-                path_or_fileobj=file_path,
-                path_in_repo=dest_path,
-                repo_id=repo_id,
-                repo_type="dataset",
-                token=token
-            )
-
-    def _get_hf_token(self):
-        if self.hf_token != None:
-            return self.hf_token
-
-        the_token = None 
-
-        # check config
-        if self.config != None:
-            if "HUGGINGFACE_TOKEN" in self.config:
-                if self.config["HUGGINGFACE_TOKEN"] != None and len(self.config["HUGGINGFACE_TOKEN"]) > 1:
-                    the_token = self.config["HUGGINGFACE_TOKEN"]
-
-        # check environment variable
-        if the_token == None:
-            the_token = os.getenv('HUGGINGFACE_TOKEN')
-
-        if the_token != None:
-            self.hf_token = the_token
-
-        return the_token
+def _compress_file(path, collection=None):
+    '''
+    gzip a resource file, return the path of the compressed file, or the initial path if the 
+    compression failed
+    '''
+    with metrics.stage("compression", collection=collection) as stage:
+        try:
+            if os.path.isfile(path):
+                stage.bytes = os.path.getsize(path)
+                subprocess.check_call(['gzip', '-f', path])
+                path += ".gz"
+        except:
+            logging.error("Error compressing resource files for " + path)
+            stage.error = True
+    return path
+
+def _entry_result(entry, profile, path, status, stored=False):
+    '''
+    Result of the harvesting of an entry, as yielded by ArXivHarvester.iter_harvest()
+    '''
+    result = {}
+    result['id'] = entry['id']
+    result['version'] = profile['version'] if profile is not None else None
+    result['status'] = status
+    result['path'] = path if profile is not None else None
+    result['size'] = profile['size'] if profile is not None else None
+    result['storage_key'] = None
+    if stored and result['path'] is not None:
+        result['storage_key'] = _get_storage_path(entry['id']) + "/" + os.path.basename(path)
+    result['metadata'] = entry
+    return result
+
+def _read_pdf(path):
+    if path.endswith(".gz"):
+        with gzip.open(path, 'rb') as the_file:
+            return the_file.read()
+    with open(path, 'rb') as the_file:
+        return the_file.read()
+
+def _remove_file(path):
+    try:
+        if os.path.isfile(path):
+            os.remove(path)
+    except OSError:
+        logging.exception("temporary file cleaning failed for " + path)
+
+def _backend_name(harvester):
+    '''
+    Name of the storage backend selected for a harvester, as used in the metrics labels
+    '''
+    if harvester.s3 is not None:
+        return "s3"
+    elif harvester.swift is not None:
+        return "swift"
+    elif getattr(harvester, "hf", None) is not None:
+        return "hf"
+    else:
+        return "local"
+
+def _init_logging(config):
+    '''
+    Configure the logging of the command line tools, once for all the modules 
+    '''
+    level = getattr(logging, str(config.get("log_level", "ERROR")).upper(), logging.ERROR)
+    logging.basicConfig(filename=config.get("log_file", "harvester.log"), filemode='a', level=level,
+        format="%(asctime)s %(levelname)s %(threadName)s %(name)s: %(message)s")
 
 def _get_json_file_reader(filename, mode):
     file_in = None
@@ -530,6 +1205,18 @@ def _generate_storage_components(identifier):
 
     return collection, prefix, number
 
+def _get_storage_path(identifier):
+    '''
+    Return the storage path for the resources of an arxiv identifier, 
+    e.g. 1501.00001v1 -> arxiv/1501/1501.00001, math.GT/0309136 -> math.GT/0309/0309136
+    '''
+    collection, prefix, number = _generate_storage_components(identifier)
+    if collection == 'arxiv':
+        full_number = prefix+"."+number
+    else:
+        full_number = prefix+number
+    return os.path.join(collection, prefix, full_number)
+
 def _serialize_pickle(a):
     return pickle.dumps(a)
 
@@ -563,6 +1250,13 @@ if __name__ == "__main__":
     parser.add_argument("--reset", action="store_true", help="ignore previous processing states and re-init the harvesting process from the beginning") 
     parser.add_argument("--metadata", help="arXiv metadata json file") 
     parser.add_argument("--diagnostic", action="store_true", help="produce a summary of the harvesting") 
+    parser.add_argument("--reconcile", action="store_true", help="rebuild the harvesting state from the listing of the storage, versions are taken from the metadata file if provided") 
+    parser.add_argument("--profile", action="store_true", help="profile the harvesting stages, profiles and slowest entries are written under data_path/profiles") 
+    parser.add_argument("--schedule", action="store_true", help="harvest the pending entries by priority (fresh entries first) instead of the order of the metadata file") 
+    parser.add_argument("--node-id", default=None, help="identifier of this node for distributed harvesting, default is hostname-pid") 
+    parser.add_argument("--merge-state", action="store_true", help="distributed harvesting: import the state published by all the nodes into the local state") 
+    parser.add_argument("--daemon", action="store_true", help="run as a service, harvesting incrementally the new metadata files (daemon_watch, or --metadata) and on schedule") 
+    parser.add_argument("--control", choices=["status", "pause", "resume", "drain", "harvest"], help="send a command to the running daemon and print its status") 
 
     args = parser.parse_args()
 
@@ -570,8 +1264,22 @@ if __name__ == "__main__":
     config_path = args.config
     reset = args.reset
     diagnostic = args.diagnostic
+    reconcile = args.reconcile
 
     config = _load_config(config_path)
+    if args.profile:
+        config["profile"] = True
+    if args.schedule:
+        config["schedule"] = True
+    if args.node_id is not None:
+        config["node_id"] = args.node_id
+    _init_logging(config)
+
+    if args.control is not None:
+        # not imported with the module, only needed in daemon mode
+        import arxiv_harvester.daemon as daemon
+        print(json.dumps(daemon.control(config, args.control), indent=2))
+        sys.exit(0)
 
     harvester = ArXivHarvester(config=config)
 
@@ -583,7 +1291,17 @@ if __name__ == "__main__":
 
     start_time = time.time()
 
-    if metadata is not None: 
+    if args.merge_state:
+        harvester.merge_state()
+
+    if args.daemon:
+        import arxiv_harvester.daemon as daemon
+        daemon.HarvestDaemon(harvester, config, metadata_file=metadata).run()
+        harvester.diagnostic()
+    elif reconcile:
+        harvester.reconcile(metadata_file=metadata)
+        harvester.diagnostic()
+    elif metadata is not None: 
         harvester.harvest(metadata)
         harvester.diagnostic()
 
@@ -20,16 +20,40 @@ import uuid
 import subprocess
 import argparse
 import time
-from concurrent.futures import ThreadPoolExecutor
+import threading
+import io
+import functools
+import hashlib
+import multiprocessing
+import re
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from random import randint, choices
 from tqdm import tqdm
 from zipfile import ZipFile
 
-# support for S3
-import arxiv_harvester.S3 as S3
+# storage backends (S3, SWIFT, local file system), imported on demand
+import arxiv_harvester.backends as backends
 
-# support for SWIFT object storage
-import arxiv_harvester.swift as swift
+# bounded local resources
+import arxiv_harvester.budget as budget
+
+# bandwidth limits shared by the harvesting processes
+import arxiv_harvester.bandwidth as bandwidth
+
+# validation of the downloaded content
+import arxiv_harvester.integrity as integrity
+
+# conversion of source members into zip archives
+import arxiv_harvester.transcode as transcode
+
+# byte-range index of the source archive members
+import arxiv_harvester.source_index as source_index
+
+# planning based on the source manifest
+import arxiv_harvester.manifest as manifest
+
+# lease-based partitioning of the work between several nodes
+import arxiv_harvester.coordination as coordination
 
 #from google.cloud import storage
 import urllib3
@@ -42,7 +66,11 @@ logging.getLogger("urllib3").setLevel(logging.ERROR)
 logging.getLogger("keystoneclient").setLevel(logging.ERROR)
 logging.getLogger("swiftclient").setLevel(logging.ERROR)
 
-from arxiv_harvester.harvester import _load_config, _generate_storage_components
+from arxiv_harvester.harvester import _load_config, _generate_storage_components, _get_storage_path, _serialize_pickle, _deserialize_pickle, _backend_name, _init_logging, _print_global_view
+
+# metrics of the harvesting stages
+from arxiv_harvester.metrics import metrics, MetricsReporter
+import arxiv_harvester.profiling as profiling
 
 import pickle
 import lmdb
@@ -60,18 +88,50 @@ class ArXivSourceHarvester(object):
 
         self._init_lmdb()
 
-        self.s3 = None
-        if "bucket_name" in self.config and len(self.config["bucket_name"].strip()) > 0:
-            self.s3 = S3.S3(self.config)
-
-        self.swift = None
-        if "swift" in self.config and len(self.config["swift"])>0 and "swift_container" in self.config and len(self.config["swift_container"])>0:
-            self.swift = swift.Swift(self.config)
+        self.s3 = backends.get_backend("s3", self.config)
+        self.swift = backends.get_backend("swift", self.config)
 
         self.s3_source = None
         if "arxiv-source" in self.config:
-            if "bucket_name" in self.config["arxiv-source"] and len(self.config["arxiv-source"]["bucket_name"].strip()) > 0:
-                self.s3_source = S3.S3(self.config["arxiv-source"])
+            self.s3_source = backends.get_backend("s3", self.config["arxiv-source"])
+
+        self.local = backends.load("local", self.config)
+
+        # pools for converting and uploading archive members, started for a harvesting run
+        self.process_pool = None
+        self.upload_pool = None
+        self.reporter = None
+        self.profiler = None
+
+        # label of the storage backend in the metrics
+        self.backend_name = _backend_name(self)
+
+        # manifest description of the planned archives
+        self.planned_archives = {}
+
+        # "zip" to store the sources of a paper as a zip archive, "original" to store the original 
+        # archive member as it is, with a sidecar json file giving its type
+        self.storage_mode = self.config.get("source_storage_mode", "zip")
+        if self.storage_mode not in ["zip", "original"]:
+            logging.warning("invalid source_storage_mode value " + str(self.storage_mode) + ", using zip")
+            self.storage_mode = "zip"
+
+        # bytes of the archive members held in memory, and of the archives downloaded on the local disk
+        self.memory_budget = budget.ByteBudget(self.config.get("memory_budget", 2 * 1024 * 1024 * 1024), name="memory")
+        self.disk_budget = budget.ByteBudget(self.config.get("disk_budget", self.config.get("source_disk_budget", 10 * 1024 * 1024 * 1024)), name="disk")
+
+        # ingress and egress bandwidth limits, shared with the other harvesting processes
+        bandwidth.configure(self.config)
+
+        # the source archives and their members are validated, an invalid archive is not recorded 
+        # as done and is processed again by the next run
+        self.integrity_checks = self.config.get("integrity_checks", True)
+
+        # distributed harvesting, the source archives are leased by the nodes
+        self.coordinator = coordination.get_coordinator(self.config, "sources", s3=self.s3)
+        # status of the papers of the leased archives, published when an archive is done
+        self._archive_papers = {}
+        self._archive_papers_lock = threading.Lock()
 
     def _init_lmdb(self):
         # create the data path if it does not exist 
@@ -87,155 +147,866 @@ class ArXivSourceHarvester(object):
         envFilePath = os.path.join(self.config["data_path"], 'sources')
         self.env_source = lmdb.open(envFilePath, map_size=map_size)
 
-    def harvest_sources(self, file_list=None):
-        # we download archive one after the other from the S3 bucket
-        # we extract the resources of the current archive, and move the resources according to the 
+        # status of the individual papers
+        envFilePath = os.path.join(self.config["data_path"], 'source_papers')
+        self.env_papers = lmdb.open(envFilePath, map_size=map_size)
+
+        # byte-range index of the archive members, and indexed archives
+        envFilePath = os.path.join(self.config["data_path"], 'source_index')
+        self.env_index = lmdb.open(envFilePath, map_size=map_size)
+
+        # manifest description of the processed archives, to detect changed archives
+        envFilePath = os.path.join(self.config["data_path"], 'source_manifest')
+        self.env_manifest = lmdb.open(envFilePath, map_size=map_size)
+
+    def harvest_sources(self, file_list=None, streaming=False, retry_failed=False, yymm=None, id_range=None):
+        # archives are downloaded from the S3 bucket in advance (prefetching) while the previously 
+        # downloaded ones are processed, several archives being processed concurrently
+        # we extract the resources of an archive, and move the resources according to the 
         # arxiv identifier at the right place
-        # when done the archive is deleted or stored, and we download the next one
+        # when done the archive is deleted and its disk space is available for the next downloads
+        # in streaming mode, archives are not downloaded but read directly from the S3 response 
+        # and their members are processed as they arrive
+        # archive members are converted in a pool of processes and stored by a pool of upload threads
+        # the status of each paper is recorded, so that an interrupted archive resumes by skipping the 
+        # papers already stored, and with retry_failed only the archives with failed papers are 
+        # processed again, restricted to the failed papers
+
+        # without file list, the archives are planned from the source manifest if available, possibly 
+        # restricted to some months (yymm) or a range of identifiers (id_range) 
+
+        archives = None
+        if not retry_failed and file_list == None:
+            archives = self.load_manifest()
+
+        if retry_failed:
+            list_files = self.get_failed_archives()
+            print("Number of source archive files with failed papers:", str(len(list_files)))
+        elif archives != None:
+            list_files = self.plan_sources(archives, yymm=yymm, id_range=id_range)
+        else:
+            list_files = self.set_list_files(file_list=file_list)
+            print("Number of source archive files:", str(len(list_files)))
+
+        # with coordination, the archives are leased to the nodes, a retry of the failed papers 
+        # being local to each node
+        coordinated = self.coordinator is not None and not retry_failed
+        if coordinated:
+            print("node " + self.coordinator.node_id + ", archives leased with the other nodes")
+            self.coordinator.start()
 
-        list_files = self.set_list_files(file_list=file_list)
-        print("Number of source archive files:", str(len(list_files)))
+        self._start_pools()
+        try:
+            if streaming or self.config.get("source_streaming", False):
+                self.stream_sources(list_files, retry_failed=retry_failed, coordinated=coordinated)
+            else:
+                self.download_sources(list_files, retry_failed=retry_failed, coordinated=coordinated)
+        finally:
+            self._stop_pools()
+            if coordinated:
+                self.coordinator.stop()
+
+    def _start_pools(self):
+        # member conversion is CPU bound, so it is done by a pool of processes (0 to convert in the 
+        # archive thread), and uploads are done by a pool of threads
+        nb_processes = self.config.get("source_processes", os.cpu_count())
+        if self.storage_mode == "original":
+            # nothing to convert
+            nb_processes = 0
+        if nb_processes != None and nb_processes > 0:
+            # workers are spawned rather than forked, as forking a process with running threads is unsafe
+            self.process_pool = ProcessPoolExecutor(max_workers=nb_processes, mp_context=multiprocessing.get_context("spawn"))
+        self.upload_pool = ThreadPoolExecutor(max_workers=max(1, self.config.get("source_upload_threads", 8)))
+        self.reporter = MetricsReporter(self.config, "source_stats.json").start()
+        self.profiler = profiling.start(self.config, "sources")
+
+    def _stop_pools(self):
+        if self.process_pool is not None:
+            self.process_pool.shutdown(wait=True)
+            self.process_pool = None
+        if self.upload_pool is not None:
+            self.upload_pool.shutdown(wait=True)
+            self.upload_pool = None
+        profiling.stop(self.profiler)
+        self.profiler = None
+        if self.reporter is not None:
+            self.reporter.stop()
+            self.reporter = None
+
+    def download_sources(self, list_files, retry_failed=False, coordinated=False):
+        """
+        Process the source archives by downloading them first on the local disk, with prefetching
+        """
+        # number of archives downloaded in advance, in addition to the ones being processed
+        nb_prefetch = self.config.get("source_prefetch", 2)
+        # number of archives processed concurrently
+        nb_workers = self.config.get("source_workers", 2)
+        # max local disk space used by downloaded archives
+        disk_budget = self.disk_budget
+
+        slots = threading.Semaphore(nb_prefetch + nb_workers)
+        download_executor = ThreadPoolExecutor(max_workers=max(1, nb_prefetch))
+        process_executor = ThreadPoolExecutor(max_workers=max(1, nb_workers))
 
         pbar = tqdm(total=len(list_files))
-        for file in list_files:
-            # already processed? 
-            with self.env_source.begin() as txn:
-                local_object = txn.get(file.encode(encoding='UTF-8'))
-                if local_object != None:
+        futures = []
+
+        def download(file, head, size):
+            dest_path = os.path.join(self.config["data_path"], os.path.basename(file))
+            with metrics.stage("archive_download") as stage:
+                try:
+                    dest_path = self.s3_source.download_file(file, dest_path)
+                    if dest_path != None and self.integrity_checks and head != None:
+                        integrity.check_file(dest_path, expected_length=head['size'], md5=integrity.etag_md5(head['etag'], head['encryption']))
+                except integrity.IntegrityError as e:
+                    logging.error("Invalid download of archive " + file + ", to be processed again: " + str(e))
+                    metrics.inc("integrity_failures", reason=e.reason, collection="archive")
+                    if os.path.isfile(dest_path):
+                        os.remove(dest_path)
+                    dest_path = None
+                except Exception:
+                    logging.exception("S3 download failed for " + file)
+                    dest_path = None
+                if dest_path == None:
+                    stage.error = True
+                else:
+                    stage.bytes = size
+            return process_executor.submit(process, file, dest_path, size)
+
+        def process(file, dest_path, size):
+            try:
+                if dest_path == None:
+                    logging.error("S3 download failed for " + file)
+                else:
+                    nb_files = self.process_archive(file, dest_path, only_failed=retry_failed)
+                    if not retry_failed:
+                        self._commit_archive(file, nb_files)
+            except Exception:
+                logging.exception("Processing failed for archive " + file)
+            finally:
+                # delete the large locally downloaded archive
+                if dest_path != None and os.path.isfile(dest_path):
+                    os.remove(dest_path)
+                disk_budget.release(size)
+                slots.release()
+                self._release_archive(file)
+                pbar.update(1)
+
+        try:
+            for file in self._iter_archives(list_files, coordinated):
+                # already processed? 
+                if not retry_failed and self._is_archive_done(file):
+                    self._complete_archive(file)
                     pbar.update(1)
                     continue
 
-            # download the archive file, these are tar files
-            dest_path = os.path.join(self.config["data_path"], file)
-            dest_path = self.s3_source.download_file(file, dest_path)
-            if dest_path == None:
-                logging.error("S3 download failed for " + file)
-            else:
-                with tarfile.open(dest_path) as tar:
-                    nb_files = 0
-
-                    #for member in tqdm(tar.getmembers(), total=len(tar.getmembers())):
-                    for member in tar.getmembers():
-                        # get gzip files and ignore PDF files, the gzip files are actually tar gzip files with the sources inside
-                        if not member.name.endswith(".gz"):
-                            continue
-                        # we have to put the identifier into a correct format (as it is at this stage simply the file name)
-                        identifier = os.path.basename(member.name)
-                        identifier = identifier.replace(".gz", "")
-                        #print("identifier:", identifier)
-                        
-                        extraction_path = self.config["data_path"]
-                        extracted_path = None
-                        try:
-                            tar.extract(member=member, path=extraction_path)
-                            extracted_path = os.path.join(extraction_path, member.name)
-                        finally:
-                            # withdrawn papers are not tar files (just gzip) and starts with "%auto-ignore"
-                            # single tex file article are not tar files (just gzip), they normally starts with \documentclass
-                            # or \documentstyle
-                            is_auto_ignore = False
-                            is_single_latex = False
-                            try:
-                                with gzip.open(extracted_path,'rt') as f:
-                                    for line in f:
-                                        line = line.strip()
-                                        if line.startswith("%auto-ignore"):
-                                            is_auto_ignore = True
-                                        elif line.startswith("\\document"):
-                                            is_single_latex = True
-                                        break
-                            except:
-                                logging.debug("Error opening extracted file: " + extracted_path)
-
-                            if is_auto_ignore:
-                                # skip withdrawn file
-                                continue
-
-                            # otherwise we have likely gzip tar archive
-                            if not is_auto_ignore and not is_single_latex: 
-                                try:
-                                    local_zip_file = self.harvest_source(extracted_path, identifier)
-                                    #print(local_zip_file)
-
-                                    # upload zip file if not empty
-                                    if local_zip_file != None:
-                                        zip_dest_path = os.path.join(self.config["data_path"], identifier + ".zip")
-                                        identifier = _format_identifier(identifier)
-                                        #print("identifier (reformatted):", identifier)
-                                        self.store_file(zip_dest_path, identifier)
-                                    else:
-                                        # ok it was single latex file too
-                                        is_single_latex = True
-                                except:
-                                    logging.debug("Error opening extracted file: " + extracted_path)
-                            
-                            if is_single_latex:
-                                # not tar, but gzip plain latex file to be zipped
-                                extracted_path_tmp = None
-                                try:
-                                    zip_file = os.path.join(self.config["data_path"], identifier)
-                                    extracted_path_tmp = os.path.join(self.config["data_path"], identifier+"_tmp")
-                                    os.mkdir(extracted_path_tmp)
-                                    with gzip.open(extracted_path, 'rb') as f_in:
-                                        with open(os.path.join(extracted_path_tmp, identifier+".tex"), 'wb') as f_out:
-                                            shutil.copyfileobj(f_in, f_out)
-
-                                    shutil.make_archive(zip_file, "zip", extracted_path_tmp)
-                                    zip_dest_path = os.path.join(self.config["data_path"], identifier + ".zip")
-                                    identifier = _format_identifier(identifier)
-                                    self.store_file(zip_dest_path, identifier)
-                                finally:
-                                    if extracted_path_tmp != None and os.path.isdir(extracted_path_tmp):
-                                        shutil.rmtree(extracted_path_tmp)
-
-                            if extracted_path != None and os.path.isfile(extracted_path):
-                                ind = member.name.find("/")
-                                if ind != -1:
-                                    member_root = member.name[:ind]
-                                    shutil.rmtree(os.path.join(extraction_path, member_root))
-                                else:
-                                    os.remove(extracted_path)
+                # wait for a free slot and enough disk space before downloading the next archive
+                head = self.s3_source.get_object_head(file)
+                size = self._archive_size(file, head)
+                if size == None:
+                    # not downloaded without accounting it in the disk budget
+                    logging.error("Unknown size of archive " + file + ", skipped, set archive_size_estimate to download it anyway")
+                    self._release_archive(file)
+                    pbar.update(1)
+                    continue
+                slots.acquire()
+                disk_budget.acquire(size)
+                futures.append(download_executor.submit(download, file, head, size))
 
-                        nb_files += 1
+            # wait for all archives to be downloaded, then processed
+            for future in futures:
+                future.result().result()
+        finally:
+            download_executor.shutdown(wait=True)
+            process_executor.shutdown(wait=True)
+            pbar.close()
 
-                # update lmdb to keep track of the process
-                with self.env_source.begin(write=True) as txn:
-                    txn.put(file.encode(encoding='UTF-8'), str(nb_files).encode(encoding='UTF-8'))
+    def stream_sources(self, list_files, retry_failed=False, coordinated=False):
+        """
+        Process the source archives by reading them as a stream from the S3 bucket, without staging 
+        the archives on the local disk
+        """
+        nb_workers = self.config.get("source_workers", 2)
+        process_executor = ThreadPoolExecutor(max_workers=max(1, nb_workers))
 
-                # delete the large locally downloaded arxiv
-                if dest_path != None and os.path.isfile(dest_path):
-                    os.remove(dest_path)
+        pbar = tqdm(total=len(list_files))
+        futures = []
 
-            pbar.update(1)
-            #break
-        pbar.close()
+        def stream(file):
+            try:
+                head = None
+                if self.integrity_checks:
+                    head = self.s3_source.get_object_head(file)
+                body = self.s3_source.get_object_stream(file)
+                if body == None:
+                    logging.error("S3 download failed for " + file)
+                    return
+                if head != None:
+                    # the archive is validated as it is read, the remaining bytes after the end of 
+                    # the tar archive are read before it is recorded as done
+                    body = integrity.ValidatingReader(body, integrity.StreamValidator(expected_length=head['size'], md5=integrity.etag_md5(head['etag'], head['encryption'])))
+                try:
+                    with metrics.stage("archive_stream"):
+                        nb_files = self.process_archive(file, fileobj=body, only_failed=retry_failed)
+                        if head != None:
+                            body.finish()
+                finally:
+                    body.close()
+                if not retry_failed:
+                    self._commit_archive(file, nb_files)
+            except integrity.IntegrityError as e:
+                logging.error("Invalid stream of archive " + file + ", to be processed again: " + str(e))
+                metrics.inc("integrity_failures", reason=e.reason, collection="archive")
+            except Exception:
+                logging.exception("Processing failed for archive " + file)
+            finally:
+                self._release_archive(file)
+                pbar.update(1)
 
-    def harvest_source(self, tar_file, identifier):
-        '''
-        Get the tar file and create a zip file from the source files
-        '''
-        zip_file_empty = True
-        zip_file = os.path.join(self.config["data_path"], identifier)
-        extraction_path = os.path.join(self.config["data_path"], identifier+"_tmp")
         try:
-            # normally compression is handled transparently when opening the tar (according to tarfile documentation)
-            # but we can force "r:gz" as we are sure about the encoding
-            with tarfile.open(tar_file, "r") as the_tar_file:
-                # this file is a tar file again
-                the_tar_file.extractall(path=extraction_path)
-                shutil.make_archive(zip_file, "zip", extraction_path)
-                zip_file_empty = False
-        except Exception as e: 
-            logging.debug('Could extract/re-archive: ' + tar_file)
+            for file in self._iter_archives(list_files, coordinated):
+                # already processed? 
+                if not retry_failed and self._is_archive_done(file):
+                    self._complete_archive(file)
+                    pbar.update(1)
+                    continue
+                futures.append(process_executor.submit(stream, file))
+
+            for future in futures:
+                future.result()
         finally:
-            # deleting tmp dir
-            if os.path.isdir(extraction_path):
-                shutil.rmtree(extraction_path)
+            process_executor.shutdown(wait=True)
+            pbar.close()
+
+    def _archive_size(self, file, head):
+        # size of an archive to be reserved in the disk budget: from its S3 metadata, or from the 
+        # manifest, or the configured estimate, None if not known
+        if head != None:
+            return head['size']
+        if file in self.planned_archives and self.planned_archives[file]['size'] != None:
+            return self.planned_archives[file]['size']
+        return self.config.get("archive_size_estimate", None)
+
+    def _iter_archives(self, list_files, coordinated):
+        # with coordination, only the archives leased by this node
+        if coordinated:
+            return self.coordinator.iter_units(list_files)
+        return list_files
+
+    def _complete_archive(self, file, nb_files=None):
+        # with coordination, mark a leased archive as done and publish the status of its papers
+        if self.coordinator is None or not self.coordinator.is_held(file):
+            return
+        with self._archive_papers_lock:
+            papers = self._archive_papers.pop(file, [])
+        state = {}
+        state['archive'] = file
+        state['nb_files'] = nb_files
+        state['papers'] = papers
+        self.coordinator.complete(file, state)
+
+    def _release_archive(self, file):
+        # with coordination, give up the lease of an archive which could not be completed
+        if self.coordinator is None or not self.coordinator.is_held(file):
+            return
+        with self._archive_papers_lock:
+            self._archive_papers.pop(file, None)
+        self.coordinator.release(file)
 
-        if zip_file_empty:
+    def merge_state(self):
+        """
+        Distributed harvesting: import in the local lmdb the archives and the status of the papers
+        published by all the nodes for their done archives, so that the local state gives the global 
+        view of the harvesting
+        """
+        if self.coordinator is None:
+            print("no coordination set in the config, nothing to merge")
+            return
+        nb_archives = 0
+        nb_papers = 0
+        for unit, node, state in self.coordinator.iter_states():
+            if state['nb_files'] is not None:
+                with self.env_source.begin(write=True) as txn:
+                    txn.put(state['archive'].encode(encoding='UTF-8'), str(state['nb_files']).encode(encoding='UTF-8'))
+            with self.env_papers.begin(write=True) as txn:
+                for profile in state['papers']:
+                    txn.put(profile['id'].encode(encoding='UTF-8'), _serialize_pickle(profile))
+            nb_archives += 1
+            nb_papers += len(state['papers'])
+        print("merged " + str(nb_papers) + " papers from " + str(nb_archives) + " archives")
+
+    def _is_archive_done(self, file):
+        with self.env_source.begin() as txn:
+            return txn.get(file.encode(encoding='UTF-8')) != None
+
+    def _commit_archive(self, file, nb_files):
+        # update lmdb to keep track of the process
+        with metrics.stage("commit", backend=self.backend_name):
+            with self.env_source.begin(write=True) as txn:
+                txn.put(file.encode(encoding='UTF-8'), str(nb_files).encode(encoding='UTF-8'))
+        metrics.inc("archives")
+        # keep the manifest description of the processed version of the archive
+        if file in self.planned_archives:
+            with self.env_manifest.begin(write=True) as txn:
+                txn.put(file.encode(encoding='UTF-8'), _serialize_pickle(self.planned_archives[file]))
+        self._complete_archive(file, nb_files)
+
+    def load_manifest(self):
+        """
+        Return the list of archive descriptions of the arXiv source manifest, or None if no manifest is 
+        available. The manifest is cached under data_path and downloaded again only when it has changed 
+        on the source bucket. 
+        """
+        manifest_key = self.config.get("source_manifest", "src/arXiv_src_manifest.xml")
+        if self.s3_source == None or manifest_key == None or len(manifest_key) == 0:
+            return None
+
+        cache_path = os.path.join(self.config["data_path"], os.path.basename(manifest_key))
+        etag_path = cache_path + ".etag"
+
+        etag = self.s3_source.get_object_etag(manifest_key)
+        cached_etag = None
+        if os.path.isfile(etag_path):
+            with open(etag_path, "r") as the_file:
+                cached_etag = the_file.read().strip()
+
+        if etag != None and (etag != cached_etag or not os.path.isfile(cache_path)):
+            # new or changed manifest
+            if self.s3_source.download_file(manifest_key, cache_path) == None:
+                return None
+            with open(etag_path, "w") as the_file:
+                the_file.write(etag)
+        elif etag == None and not os.path.isfile(cache_path):
+            return None
+
+        # archives are in the same directory as the manifest 
+        prefix = os.path.dirname(manifest_key)
+        if len(prefix) > 0:
+            prefix += "/"
+        try:
+            return manifest.parse_manifest(cache_path, prefix=prefix)
+        except Exception:
+            logging.exception("Invalid source manifest " + cache_path)
             return None
+
+    def plan_sources(self, archives=None, yymm=None, id_range=None):
+        """
+        Return the list of source archives to process, selected from the manifest by month and/or range 
+        of identifiers, with only the archives not yet processed or changed since they were processed. 
+        archives is the manifest as returned by load_manifest(), loaded if not given. 
+        """
+        if archives == None:
+            archives = self.load_manifest()
+        archives = manifest.select_archives(archives, yymm=yymm, id_range=id_range)
+
+        list_files = []
+        changed = []
+        total_bytes = 0
+        for archive in archives:
+            file = archive['archive']
+            self.planned_archives[file] = archive
+            if self._is_archive_done(file):
+                with self.env_manifest.begin() as txn:
+                    local_object = txn.get(file.encode(encoding='UTF-8'))
+                previous = _deserialize_pickle(local_object) if local_object != None else None
+                if previous == None or previous['md5'] == archive['md5']:
+                    continue
+                # the archive has changed since it was processed, it is processed again entirely
+                changed.append(file)
+            list_files.append(file)
+            if archive['size'] != None:
+                total_bytes += archive['size']
+        if len(changed) > 0:
+            self._forget_archives(changed)
+
+        print("Number of selected source archive files:", str(len(archives)), "- to process:", str(len(list_files)), "(" + str(len(changed)) + " changed)")
+        print("Total size of the source archive files to fetch:", _format_bytes(total_bytes))
+        return list_files
+
+    def _forget_archives(self, files):
+        # remove the processing state of the given archives and of their papers, the papers of all 
+        # the archives being found in a single pass over the paper status lmdb
+        files = set(files)
+        with self.env_source.begin(write=True) as txn:
+            for file in files:
+                txn.delete(file.encode(encoding='UTF-8'))
+        with self.env_papers.begin(write=True) as txn:
+            cursor = txn.cursor()
+            keys = [ key for key, value in cursor if _deserialize_pickle(value)['archive'] in files ]
+            for key in keys:
+                txn.delete(key)
+
+    def get_paper_status(self, identifier):
+        """
+        Return the recorded status of a paper given its arXiv identifier, as a dict with the status 
+        ("stored", "withdrawn" or "failed"), the source archive, and for stored papers the size and 
+        md5 hash of the zip archive, or None if the paper has not been processed
+        """
+        with self.env_papers.begin() as txn:
+            local_object = txn.get(identifier.encode(encoding='UTF-8'))
+            if local_object == None:
+                return None
+            return _deserialize_pickle(local_object)
+
+    def set_paper_status(self, identifier, archive, status, size=None, md5=None):
+        profile = {}
+        profile['id'] = identifier
+        profile['archive'] = archive
+        profile['status'] = status
+        if size != None:
+            profile['size'] = size
+        if md5 != None:
+            profile['md5'] = md5
+        with metrics.stage("commit", backend=self.backend_name):
+            with self.env_papers.begin(write=True) as txn:
+                txn.put(identifier.encode(encoding='UTF-8'), _serialize_pickle(profile))
+        metrics.inc("papers", status=status, collection=_collection(identifier))
+        if self.coordinator is not None and self.coordinator.is_held(archive):
+            with self._archive_papers_lock:
+                self._archive_papers.setdefault(archive, []).append(profile)
+
+    def _skip_member(self, file, identifier, only_failed):
+        """
+        Return (skip, processed): whether the paper must be skipped given its recorded status, and 
+        if skipped, whether it counts as processed 
+        """
+        profile = self.get_paper_status(_format_identifier(identifier))
+        if only_failed:
+            return (profile == None or profile['status'] != "failed"), False
+        if profile != None and profile['archive'] == file and profile['status'] in ["stored", "withdrawn"]:
+            # already done for this archive, e.g. before an interruption
+            return True, (profile['status'] == "stored")
+        return False, False
+
+    def get_failed_archives(self):
+        """
+        Return the list of source archives containing papers which failed to be processed 
+        """
+        archives = set()
+        with self.env_papers.begin() as txn:
+            cursor = txn.cursor()
+            for key, value in cursor:
+                profile = _deserialize_pickle(value)
+                if profile['status'] == "failed":
+                    archives.add(profile['archive'])
+        return sorted(archives)
+
+    def process_archive(self, file, archive_path=None, fileobj=None, only_failed=False):
+        """
+        Process all the members of a source archive file, return the number of processed members.
+        The archive is either a downloaded file (archive_path) or a file object read sequentially 
+        as a stream (fileobj), for instance the body of a S3 response.
+        Papers already stored from this archive are skipped, and with only_failed, only the papers 
+        which previously failed are processed.
+        """
+        nb_files = 0
+        if fileobj is not None:
+            # stream mode, members can only be accessed in sequence 
+            tar = tarfile.open(fileobj=fileobj, mode="r|")
         else:
-            return zip_file
+            tar = tarfile.open(archive_path)
+        with tar:
+            if self.storage_mode == "original":
+                nb_files = self._process_members_original(file, tar, only_failed)
+                self.index_members(file, tar.members)
+                return nb_files
+
+            if self.process_pool is not None and self.upload_pool is not None:
+                nb_files = self._process_members_parallel(file, tar, only_failed)
+                self.index_members(file, tar.members)
+                return nb_files
+
+            for member in tar:
+                # get gzip files and ignore PDF files, the gzip files are actually tar gzip files with the sources inside
+                if not member.name.endswith(".gz"):
+                    continue
+                identifier = os.path.basename(member.name).replace(".gz", "")
+                skip, processed = self._skip_member(file, identifier, only_failed)
+                if skip:
+                    if processed:
+                        nb_files += 1
+                    continue
+                try:
+                    if self.process_member(tar, member, archive=file):
+                        nb_files += 1
+                except Exception:
+                    logging.exception("Processing failed for archive member " + member.name)
+                    self.set_paper_status(_format_identifier(identifier), file, "failed")
+
+            # all the members have been read, their byte ranges are known
+            self.index_members(file, tar.members)
+
+        return nb_files
+
+    def _process_members_original(self, file, tar, only_failed=False):
+        """
+        Read the members of an archive and store them as they are, without any conversion, by the 
+        upload pool if started. Return the number of stored members once all of them are done. 
+        """
+        max_in_flight = self.config.get("source_max_in_flight", 64)
+        tracker = _MemberTracker(max_in_flight, memory_budget=self.memory_budget)
+
+        for member in tar:
+            # PDF files are kept too, as the only available source of some papers
+            if not (member.name.endswith(".gz") or member.name.endswith(".pdf")):
+                continue
+            identifier = _member_identifier(member.name)
+            skip, processed = self._skip_member(file, identifier, only_failed)
+            if skip:
+                if processed:
+                    tracker.count()
+                continue
+
+            tracker.start(identifier, member.size)
+            try:
+                data = tar.extractfile(member).read()
+                if self.upload_pool is not None:
+                    self.upload_pool.submit(self._store_original_member, tracker, file, identifier, data)
+                else:
+                    self._store_original_member(tracker, file, identifier, data)
+            except Exception:
+                logging.exception("Processing failed for archive member " + member.name)
+                self.set_paper_status(_format_identifier(identifier), file, "failed")
+                tracker.done(False, identifier)
+
+        tracker.wait()
+        return tracker.nb_files
+
+    def _store_original_member(self, tracker, file, identifier, data):
+        success = False
+        try:
+            with profiling.entry(_format_identifier(identifier)):
+                success = self._store_original(file, identifier, data)
+        except Exception:
+            logging.exception("Storing failed for source " + identifier)
+            self.set_paper_status(_format_identifier(identifier), file, "failed")
+        finally:
+            tracker.done(success, identifier)
+
+    def _store_original(self, file, identifier, data):
+        """
+        Store the original content of an archive member with a sidecar json file giving its detected 
+        type (tar.gz, tex, withdrawn or pdf) and record the status of the paper. Return True if the 
+        paper is stored and not withdrawn.
+        """
+        kind = transcode.detect_source_type(data)
+        if kind == None:
+            logging.error("Unknown type of source " + identifier + " in " + file)
+            self.set_paper_status(_format_identifier(identifier), file, "failed")
+            return False
+        if self.integrity_checks and kind != "withdrawn":
+            # stored as it is, the content is not checked by a conversion
+            try:
+                integrity.check_source_member(data, kind)
+            except integrity.IntegrityError as e:
+                logging.error("Invalid source " + identifier + " in " + file + ": " + str(e))
+                metrics.inc("integrity_failures", reason=e.reason, collection=_collection(_format_identifier(identifier)))
+                self.set_paper_status(_format_identifier(identifier), file, "failed")
+                return False
+
+        file_name = _storage_file_name(identifier)
+        if kind == "pdf":
+            original_name = file_name + ".src.pdf"
+        else:
+            original_name = file_name + ".src.gz"
+        md5 = hashlib.md5(data).hexdigest()
+
+        sidecar = {}
+        sidecar['id'] = _format_identifier(identifier)
+        sidecar['type'] = kind
+        sidecar['file_name'] = original_name
+        sidecar['size'] = len(data)
+        sidecar['md5'] = md5
+        sidecar['archive'] = file
+        sidecar_data = json.dumps(sidecar).encode(encoding='UTF-8')
+
+        success = self.store_buffer(io.BytesIO(data), original_name, _format_identifier(identifier))
+        if success:
+            success = self.store_buffer(io.BytesIO(sidecar_data), file_name + ".src.json", _format_identifier(identifier))
+
+        if not success:
+            self.set_paper_status(_format_identifier(identifier), file, "failed")
+            return False
+        if kind == "withdrawn":
+            self.set_paper_status(_format_identifier(identifier), file, "withdrawn")
+            return False
+        self.set_paper_status(_format_identifier(identifier), file, "stored", size=len(data), md5=md5)
+        return True
+
+    def _process_members_parallel(self, file, tar, only_failed=False):
+        """
+        Read the members of an archive and dispatch them to the process pool for conversion, the 
+        converted members being then stored by the upload pool. Members complete in any order, 
+        return the number of processed members once all of them are done. 
+        """
+        spool_max_size = self.config.get("source_spool_size", transcode.SPOOL_MAX_SIZE)
+        # bound the number and the size of the members in memory, read but not yet stored
+        max_in_flight = self.config.get("source_max_in_flight", 64)
+        tracker = _MemberTracker(max_in_flight, memory_budget=self.memory_budget)
+
+        for member in tar:
+            # get gzip files and ignore PDF files, the gzip files are actually tar gzip files with the sources inside
+            if not member.name.endswith(".gz"):
+                continue
+            identifier = os.path.basename(member.name)
+            identifier = identifier.replace(".gz", "")
+            skip, processed = self._skip_member(file, identifier, only_failed)
+            if skip:
+                if processed:
+                    tracker.count()
+                continue
+
+            tracker.start(identifier, member.size)
+            try:
+                data = tar.extractfile(member).read()
+                future = self.process_pool.submit(transcode.timed_transcode_to_bytes, data, identifier, spool_max_size)
+                future.add_done_callback(functools.partial(self._on_member_converted, tracker, file, identifier))
+            except Exception:
+                logging.exception("Processing failed for archive member " + member.name)
+                self.set_paper_status(_format_identifier(identifier), file, "failed")
+                tracker.done(False, identifier)
+
+        tracker.wait()
+        return tracker.nb_files
+
+    def _on_member_converted(self, tracker, file, identifier, future):
+        try:
+            kind, content, seconds = future.result()
+            metrics.observe_stage("conversion", seconds, nb_bytes=(len(content) if content is not None else 0), collection=_collection(_format_identifier(identifier)))
+        except Exception:
+            metrics.observe_stage("conversion", 0, error=True, collection=_collection(_format_identifier(identifier)))
+            logging.exception("Conversion failed for source " + identifier)
+            self.set_paper_status(_format_identifier(identifier), file, "failed")
+            tracker.done(False, identifier)
+            return
+
+        if kind == "withdrawn":
+            # skip withdrawn file
+            self.set_paper_status(_format_identifier(identifier), file, "withdrawn")
+            tracker.done(False, identifier)
+            return
+
+        # the converted member is now held in memory instead of the original one
+        tracker.resize(identifier, len(content))
+        try:
+            self.upload_pool.submit(self._store_converted_member, tracker, file, identifier, content, seconds)
+        except Exception:
+            logging.exception("Upload failed for source " + identifier)
+            self.set_paper_status(_format_identifier(identifier), file, "failed")
+            tracker.done(False, identifier)
+
+    def _store_converted_member(self, tracker, file, identifier, content, seconds=0):
+        success = False
+        try:
+            with profiling.entry(_format_identifier(identifier)):
+                # the conversion was done in a worker process
+                profiling.add_stage_time("conversion", seconds)
+                success = self._store_content(file, identifier, content)
+        finally:
+            tracker.done(success, identifier)
+
+    def _store_content(self, file, identifier, content):
+        # store the zip archive of a converted member given as bytes and record the status of the paper
+        success = False
+        try:
+            success = self.store_buffer(io.BytesIO(content), _storage_file_name(identifier) + ".zip", _format_identifier(identifier))
+        finally:
+            if success:
+                self.set_paper_status(_format_identifier(identifier), file, "stored", size=len(content), md5=hashlib.md5(content).hexdigest())
+            else:
+                self.set_paper_status(_format_identifier(identifier), file, "failed")
+        return success
+
+    def process_member(self, tar, member, archive=None):
+        """
+        Convert the sources of one archive member into a zip archive in memory and store it, return 
+        True if the paper is stored, False otherwise (e.g. withdrawn paper). The status of the paper 
+        is recorded if the source archive is given.
+        """
+        # we have to put the identifier into a correct format (as it is at this stage simply the file name)
+        identifier = os.path.basename(member.name)
+        identifier = identifier.replace(".gz", "")
+
+        with profiling.entry(_format_identifier(identifier)):
+            return self._process_member(tar, member, identifier, archive)
+
+    def _process_member(self, tar, member, identifier, archive):
+        spool_max_size = self.config.get("source_spool_size", transcode.SPOOL_MAX_SIZE)
+        with metrics.stage("conversion", collection=_collection(_format_identifier(identifier))):
+            kind, buffer = transcode.transcode_source(tar.extractfile(member), identifier, spool_max_size=spool_max_size)
+
+        if kind == "withdrawn":
+            # skip withdrawn file
+            if archive != None:
+                self.set_paper_status(_format_identifier(identifier), archive, "withdrawn")
+            return False
+
+        try:
+            size, md5 = _size_and_md5(buffer)
+            success = self.store_buffer(buffer, _storage_file_name(identifier) + ".zip", _format_identifier(identifier))
+        finally:
+            buffer.close()
+
+        if archive != None:
+            if success:
+                self.set_paper_status(_format_identifier(identifier), archive, "stored", size=size, md5=md5)
+            else:
+                self.set_paper_status(_format_identifier(identifier), archive, "failed")
+        return success
+
+    def index_members(self, file, members):
+        """
+        Record the byte range of the source members of an archive in the index, with the archive 
+        itself marked as indexed 
+        """
+        locations = source_index.member_locations(file, members)
+        with self.env_index.begin(write=True) as txn:
+            for identifier, location in locations:
+                txn.put(_format_identifier(identifier).encode(encoding='UTF-8'), _serialize_pickle(location))
+            txn.put(file.encode(encoding='UTF-8'), str(len(locations)).encode(encoding='UTF-8'))
+        return len(locations)
+
+    def get_member_location(self, identifier):
+        """
+        Return the location of the source member of a paper given its arXiv identifier, as a dict 
+        with archive, member, offset and size, or None if the paper is not indexed
+        """
+        with self.env_index.begin() as txn:
+            local_object = txn.get(identifier.encode(encoding='UTF-8'))
+            if local_object == None:
+                return None
+            return _deserialize_pickle(local_object)
+
+    def is_archive_indexed(self, file):
+        with self.env_index.begin() as txn:
+            return txn.get(file.encode(encoding='UTF-8')) != None
+
+    def index_sources(self, file_list=None, yymm=None, id_range=None):
+        """
+        Build the byte-range index of the source archives not yet indexed, by scanning only the tar 
+        headers of the archives on S3 with small ranged GETs. Without file list, the archives are 
+        taken from the source manifest, possibly restricted to some months (yymm) or a range of 
+        identifiers (id_range), the source bucket being listed only if no manifest is available.
+        """
+        list_files = None
+        if file_list == None:
+            archives = self.load_manifest()
+            if archives != None:
+                list_files = [ archive['archive'] for archive in manifest.select_archives(archives, yymm=yymm, id_range=id_range) ]
+            elif yymm != None or id_range != None:
+                logging.warning("No source manifest available, the archives to index cannot be selected by month or identifier range")
+        if list_files == None:
+            list_files = self.set_list_files(file_list=file_list)
+        list_files = [ file for file in list_files if not self.is_archive_indexed(file) ]
+        print("Number of source archive files to index:", str(len(list_files)))
+
+        block_size = self.config.get("source_index_block_size", source_index.SCAN_BLOCK_SIZE)
+
+        def index(file):
+            members = source_index.scan_archive(self.s3_source, file, block_size=block_size)
+            if members is None:
+                logging.error("Could not index archive " + file)
+                return
+            self.index_members(file, members)
+
+        nb_threads = self.config.get("source_range_threads", 16)
+        with tqdm(total=len(list_files)) as pbar:
+            with ThreadPoolExecutor(max_workers=nb_threads) as executor:
+                futures = [ executor.submit(index, file) for file in list_files ]
+                for future in futures:
+                    try:
+                        future.result()
+                    except Exception:
+                        logging.exception("Indexing of a source archive failed")
+                    pbar.update(1)
+
+    def harvest_ids(self, ids):
+        """
+        Harvest the sources of the given papers only, fetching each source member from its archive 
+        with a S3 ranged GET, based on the byte-range index. Return the list of identifiers which 
+        could not be found in the index.
+        """
+        locations = []
+        missing = []
+        for identifier in ids:
+            identifier = _strip_version(identifier.strip())
+            if len(identifier) == 0:
+                continue
+            location = self.get_member_location(identifier)
+            if location is None:
+                missing.append(identifier)
+            else:
+                locations.append(location)
+
+        total_bytes = sum(location['size'] for location in locations)
+        print("Number of indexed papers:", str(len(locations)), "-", str(total_bytes), "bytes to fetch")
+        if len(missing) > 0:
+            print("Number of papers not found in the index:", str(len(missing)))
+
+        spool_max_size = self.config.get("source_spool_size", transcode.SPOOL_MAX_SIZE)
+
+        def fetch(location):
+            # the member is held in memory until stored
+            reservation = budget.Reservation(self.memory_budget, location['size'])
+            try:
+                with profiling.entry(_format_identifier(_member_identifier(location['member']))):
+                    return fetch_member(location)
+            finally:
+                reservation.release()
+
+        def fetch_member(location):
+            file = location['archive']
+            identifier = _member_identifier(location['member'])
+            if self.storage_mode == "zip" and location['member'].endswith(".pdf"):
+                logging.info("No source to convert for " + identifier + ", only a PDF file")
+                return False
+
+            start = location['offset']
+            with metrics.stage("range_download") as stage:
+                data = self.s3_source.get_object_range(file, start, start + location['size'] - 1)
+                stage.bytes = len(data) if data is not None else 0
+                stage.error = (data is None)
+            if data is None or len(data) != location['size']:
+                logging.error("Could not fetch source member " + location['member'] + " from " + file)
+                self.set_paper_status(_format_identifier(identifier), file, "failed")
+                return False
+
+            if self.storage_mode == "original":
+                return self._store_original(file, identifier, data)
+
+            try:
+                if self.process_pool is not None:
+                    kind, content, seconds = self.process_pool.submit(transcode.timed_transcode_to_bytes, data, identifier, spool_max_size).result()
+                else:
+                    kind, content, seconds = transcode.timed_transcode_to_bytes(data, identifier, spool_max_size)
+                metrics.observe_stage("conversion", seconds, collection=_collection(_format_identifier(identifier)))
+                profiling.add_stage_time("conversion", seconds)
+            except Exception:
+                logging.exception("Conversion failed for source " + identifier)
+                self.set_paper_status(_format_identifier(identifier), file, "failed")
+                return False
+
+            if kind == "withdrawn":
+                self.set_paper_status(_format_identifier(identifier), file, "withdrawn")
+                return False
+            return self._store_content(file, identifier, content)
+
+        self._start_pools()
+        try:
+            nb_threads = self.config.get("source_range_threads", 16)
+            with tqdm(total=len(locations)) as pbar:
+                with ThreadPoolExecutor(max_workers=nb_threads) as executor:
+                    futures = [ executor.submit(fetch, location) for location in locations ]
+                    for future in futures:
+                        try:
+                            future.result()
+                        except Exception:
+                            logging.exception("Unexpected error fetching a source member")
+                        pbar.update(1)
+        finally:
+            self._stop_pools()
+
+        return missing
 
     def get_list_source_files(self):
         list_files = None
@@ -243,6 +1014,95 @@ class ArXivSourceHarvester(object):
             list_files = self.s3_source.get_s3_list("")
         return list_files
 
+    def read_stored_file(self, identifier, file_name):
+        """
+        Return the content of a file stored for a paper given its arXiv identifier, or None if the 
+        file is not available 
+        """
+        dest_path = _get_storage_path(identifier)
+        if self.s3 is None and self.swift is None:
+            local_path = os.path.join(self.config["data_path"], dest_path, file_name)
+            if not os.path.isfile(local_path):
+                return None
+            with open(local_path, "rb") as the_file:
+                return the_file.read()
+
+        tmp_path = os.path.join(self.config["data_path"], "." + file_name + "." + str(uuid.uuid4()) + ".tmp")
+        try:
+            if self.s3 is not None:
+                self.s3.download_file(dest_path + "/" + file_name, tmp_path)
+            else:
+                self.swift.download_file(dest_path + "/" + file_name, tmp_path)
+            if not os.path.isfile(tmp_path):
+                return None
+            with open(tmp_path, "rb") as the_file:
+                return the_file.read()
+        finally:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+
+    def get_source_zip(self, identifier):
+        """
+        Return the sources of a paper as a zip archive (bytes) given its arXiv identifier, or None if 
+        no source is available (not harvested, withdrawn paper or only PDF). Sources stored in 
+        original mode are converted to zip at this stage. 
+        """
+        identifier = _strip_version(identifier)
+        file_name = _storage_file_name(identifier.replace("/", ""))
+
+        sidecar_data = self.read_stored_file(identifier, file_name + ".src.json")
+        if sidecar_data == None:
+            # stored as zip archive, or not available
+            return self.read_stored_file(identifier, file_name + ".zip")
+
+        sidecar = json.loads(sidecar_data)
+        if sidecar['type'] not in ["tar.gz", "tex"]:
+            return None
+        data = self.read_stored_file(identifier, sidecar['file_name'])
+        if data == None:
+            return None
+        spool_max_size = self.config.get("source_spool_size", transcode.SPOOL_MAX_SIZE)
+        kind, content = transcode.transcode_to_bytes(data, identifier.replace("/", ""), spool_max_size)
+        return content
+
+    def store_buffer(self, buffer, file_name, identifier):
+        """
+        Store the content of a file object (e.g. a zip archive built in memory) in the selected 
+        storage, under the storage path of the identifier, return True if successfully stored
+        """
+        with metrics.stage("upload", backend=self.backend_name, collection=_collection(identifier)) as stage:
+            buffer.seek(0, io.SEEK_END)
+            stage.bytes = buffer.tell()
+            buffer.seek(0)
+            success = self._store_buffer(buffer, file_name, identifier)
+            stage.error = not success
+        return success
+
+    def _store_buffer(self, buffer, file_name, identifier):
+        dest_path = _get_storage_path(identifier)
+
+        if self.s3 is not None:
+            try:
+                return self.s3.upload_fileobj_to_s3(buffer, file_name, dest_path, storage_class='ONEZONE_IA')
+            except:
+                logging.error("Error writing on S3 bucket")
+
+        elif self.swift is not None:
+            try:
+                return self.swift.upload_fileobj_to_swift(buffer, file_name, dest_path)
+            except:
+                logging.error("Error writing on SWIFT object storage")
+
+        else:
+            # save under local storate indicated by data_path in the config json
+            try:
+                self.local.store_fileobj(buffer, dest_path, file_name)
+                return True
+            except (IOError, OSError):
+                logging.exception("invalid path")    
+
+        return False
+
     def store_file(self, source, identifier, clean=True):
 
         if not os.path.isfile(source):
@@ -274,7 +1134,7 @@ class ArXivSourceHarvester(object):
             source = os.path.join(os.path.dirname(source), new_file_name)
             file_name = new_file_name
 
-        if original_source != source:
+        if original_source != source and (self.s3 is not None or self.swift is not None):
             shutil.copyfile(original_source, source)
 
         if self.s3 is not None:
@@ -295,13 +1155,12 @@ class ArXivSourceHarvester(object):
                 logging.error("Error writing on SWIFT object storage")
 
         else:
-            # save under local storate indicated by data_path in the config json
+            # save under local storate indicated by data_path in the config json, no need to rename 
+            # the source file first as the file name is given at placement
             try:
-                local_dest_path = os.path.join(self.config["data_path"], collection, prefix, full_number)
-                os.makedirs(local_dest_path, exist_ok=True)
-                if os.path.isfile(source):
-                    shutil.copyfile(source, os.path.join(local_dest_path, file_name))
-            except IOError:
+                dest_path = os.path.join(collection, prefix, full_number)
+                self.local.store_file(original_source, dest_path, file_name, move=clean)
+            except (IOError, OSError):
                 logging.exception("invalid path")    
 
         # clean stored files
@@ -322,10 +1181,22 @@ class ArXivSourceHarvester(object):
         """
         # close environments
         self.env_source.close()
+        self.env_papers.close()
+        self.env_index.close()
+        self.env_manifest.close()
 
         envFilePath = os.path.join(self.config["data_path"], 'sources')
         shutil.rmtree(envFilePath)
 
+        envFilePath = os.path.join(self.config["data_path"], 'source_papers')
+        shutil.rmtree(envFilePath)
+
+        envFilePath = os.path.join(self.config["data_path"], 'source_index')
+        shutil.rmtree(envFilePath)
+
+        envFilePath = os.path.join(self.config["data_path"], 'source_manifest')
+        shutil.rmtree(envFilePath)
+
         # re-init the environments
         self._init_lmdb()
 
@@ -360,7 +1231,13 @@ class ArXivSourceHarvester(object):
         and number of individual documents covered
         '''
 
-        list_files = self.set_list_files(file_list=file_list)
+        archives = None
+        if file_list == None:
+            archives = self.load_manifest()
+        if archives != None:
+            list_files = [ archive['archive'] for archive in archives ]
+        else:
+            list_files = self.set_list_files(file_list=file_list)
 
         with self.env_source.begin(write=False) as txn:
             nb_archives = txn.stat()['entries']
@@ -380,6 +1257,133 @@ class ArXivSourceHarvester(object):
 
             print("number of processed individual arxiv source archives:", total_files)
 
+        # status of the individual papers
+        statuses = {}
+        with self.env_papers.begin(write=False) as txn:
+            cursor = txn.cursor()
+            for key, value in cursor:
+                status = _deserialize_pickle(value)['status']
+                statuses[status] = statuses.get(status, 0) + 1
+        for status in ["stored", "withdrawn", "failed"]:
+            print("number of " + status + " papers:", statuses.get(status, 0))
+
+        nb_indexed = 0
+        with self.env_index.begin(write=False) as txn:
+            cursor = txn.cursor()
+            for key, value in cursor:
+                if b"arXiv_src_" in key:
+                    nb_indexed += 1
+        print("number of indexed arxiv source archives:", nb_indexed)
+
+        if self.coordinator is not None:
+            _print_global_view(self.coordinator)
+
+
+class _MemberTracker(object):
+    '''
+    Keep track of the archive members being processed concurrently, limiting their number and 
+    their size in memory (if a memory budget is given), and counting the processed ones
+    '''
+
+    def __init__(self, max_in_flight, memory_budget=None):
+        self.slots = threading.Semaphore(max_in_flight)
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.nb_files = 0
+        self.memory_budget = memory_budget
+        # identifier -> memory reservation of the members in flight
+        self.reservations = {}
+
+    def count(self):
+        # a member processed without going through the pools, e.g. already stored
+        with self.condition:
+            self.nb_files += 1
+
+    def start(self, identifier=None, size=0):
+        # blocks until the member can be read, stopping the reading of the archive
+        self.slots.acquire()
+        reservation = None
+        if self.memory_budget is not None and identifier is not None:
+            reservation = budget.Reservation(self.memory_budget, size)
+        with self.condition:
+            self.in_flight += 1
+            if reservation is not None:
+                self.reservations[identifier] = reservation
+
+    def resize(self, identifier, size):
+        with self.condition:
+            reservation = self.reservations.get(identifier)
+        if reservation is not None:
+            reservation.resize(size)
+
+    def done(self, processed, identifier=None):
+        with self.condition:
+            self.in_flight -= 1
+            if processed:
+                self.nb_files += 1
+            reservation = self.reservations.pop(identifier, None)
+            self.condition.notify_all()
+        if reservation is not None:
+            reservation.release()
+        self.slots.release()
+
+    def wait(self):
+        with self.condition:
+            while self.in_flight > 0:
+                self.condition.wait()
+
+def _size_and_md5(buffer):
+    '''
+    Return the size and md5 hash of the content of a file object, which is rewinded for further reading
+    '''
+    md5 = hashlib.md5()
+    size = 0
+    buffer.seek(0)
+    while True:
+        chunk = buffer.read(1024 * 1024)
+        if not chunk:
+            break
+        md5.update(chunk)
+        size += len(chunk)
+    buffer.seek(0)
+    return size, md5.hexdigest()
+
+def _format_bytes(nb_bytes):
+    for unit in ["bytes", "KB", "MB", "GB"]:
+        if nb_bytes < 1024:
+            return str(round(nb_bytes, 1)) + " " + unit
+        nb_bytes /= 1024
+    return str(round(nb_bytes, 1)) + " TB"
+
+def _collection(identifier):
+    '''
+    arXiv collection of an identifier, e.g. astro-ph/0001001 -> astro-ph, 2208.00127 -> arxiv
+    '''
+    return _generate_storage_components(identifier)[0]
+
+def _member_identifier(member_name):
+    '''
+    Source file identifier of an archive member, e.g. 0001/astro-ph0001001.gz -> astro-ph0001001
+    '''
+    return os.path.splitext(os.path.basename(member_name))[0]
+
+def _strip_version(identifier):
+    '''
+    Remove a possible version from an arXiv identifier, e.g. 1501.00001v2 -> 1501.00001
+    '''
+    return re.sub(r"v[0-9]+$", "", identifier)
+
+def _storage_file_name(identifier):
+    '''
+    File name used to store a resource given the source file identifier, 
+    e.g. quant-ph0001001 -> 0001001, 2208.00127 -> 2208.00127
+    '''
+    if identifier[0].isdigit():
+        return identifier
+    for i in range(0, len(identifier)):
+        if identifier[i].isdigit():
+            return identifier[i:]
+    return identifier
 
 def _format_identifier(identifier):
     '''
@@ -409,6 +1413,16 @@ if __name__ == "__main__":
     parser.add_argument("--reset", action="store_true", help="ignore previous processing states and re-init the harvesting process from the beginning") 
     parser.add_argument("--file-list", default=None, help="list of arXiv source archive files to process, default is to process all available on arxiv S3") 
     parser.add_argument("--diagnostic", action="store_true", help="produce a summary of the source harvesting") 
+    parser.add_argument("--stream", action="store_true", help="read the source archives as a stream from S3 instead of downloading them first") 
+    parser.add_argument("--retry-failed", action="store_true", help="process again only the papers which failed in previous runs") 
+    parser.add_argument("--yymm", default=None, help="months of the source archives to process or index, e.g. 2101 or 2101-2112, based on the source manifest") 
+    parser.add_argument("--id-range", default=None, help="range of arXiv identifiers of the source archives to process or index, e.g. 2101.00001:2101.05000, based on the source manifest") 
+    parser.add_argument("--zip", default=None, help="arXiv identifier of a paper to get its sources as a zip archive in the current directory") 
+    parser.add_argument("--index", action="store_true", help="build the byte-range index of the source archives by scanning only their headers") 
+    parser.add_argument("--ids", default=None, help="file with a list of arXiv identifiers, one per line, to fetch only the sources of these papers based on the index") 
+    parser.add_argument("--profile", action="store_true", help="profile the harvesting stages, profiles and slowest entries are written under data_path/profiles") 
+    parser.add_argument("--node-id", default=None, help="identifier of this node for distributed harvesting, default is hostname-pid") 
+    parser.add_argument("--merge-state", action="store_true", help="distributed harvesting: import the state published by all the nodes into the local state") 
 
     args = parser.parse_args()
 
@@ -416,8 +1430,20 @@ if __name__ == "__main__":
     file_list = args.file_list
     reset = args.reset
     diagnostic = args.diagnostic
+    stream = args.stream
+    retry_failed = args.retry_failed
+    index = args.index
+    ids_file = args.ids
+    yymm = args.yymm
+    zip_identifier = args.zip
+    id_range = args.id_range
 
     config = _load_config(config_path)
+    if args.profile:
+        config["profile"] = True
+    if args.node_id is not None:
+        config["node_id"] = args.node_id
+    _init_logging(config)
 
     harvester = ArXivSourceHarvester(config=config)
 
@@ -429,10 +1455,32 @@ if __name__ == "__main__":
 
     start_time = time.time()
 
+    if args.merge_state:
+        harvester.merge_state()
+
     if diagnostic:
         harvester.diagnostic()
+    elif args.merge_state:
+        harvester.diagnostic()
+    elif zip_identifier is not None:
+        content = harvester.get_source_zip(zip_identifier)
+        if content is None:
+            print("no source available for", zip_identifier)
+        else:
+            zip_path = _storage_file_name(_strip_version(zip_identifier).replace("/", "")) + ".zip"
+            with open(zip_path, "wb") as the_file:
+                the_file.write(content)
+            print("sources written in", zip_path)
+    elif index:
+        harvester.index_sources(file_list=file_list, yymm=yymm, id_range=id_range)
+    elif ids_file is not None:
+        with open(ids_file, "r") as the_file:
+            ids = [ line.strip() for line in the_file.readlines() ]
+        missing = harvester.harvest_ids(ids)
+        if len(missing) > 0:
+            print("papers not found in the index, run first with --index:", ", ".join(missing[:10]) + (" ..." if len(missing) > 10 else ""))
     else:
-        harvester.harvest_sources(file_list=file_list)
+        harvester.harvest_sources(file_list=file_list, streaming=stream, retry_failed=retry_failed, yymm=yymm, id_range=id_range)
         harvester.diagnostic(file_list=file_list)
 
     runtime = round(time.time() - start_time, 3)
@@ -0,0 +1,233 @@
+import os
+import time
+
+# support for HuggingFace dataset storage
+from huggingface_hub import HfApi, CommitOperationAdd
+
+# staging queue processed by batches
+from arxiv_harvester.batching import BatchQueue
+
+# metrics of the harvesting stages
+from arxiv_harvester.metrics import metrics
+
+# bandwidth limits shared by the harvesting processes
+from arxiv_harvester import bandwidth
+
+# logging
+import logging
+import logging.handlers
+
+class HuggingFace(object):
+    """
+    Upload files to a HuggingFace dataset repository.
+
+    Every call to HfApi.upload_file creates a commit on the Hub, and commits are rate limited.
+    Files are therefore staged in a queue and pushed together as a single multi-operation commit
+    when the number of staged files or their total size reaches a threshold. Commits and their
+    retries are performed by a background thread, so that download workers are never blocked
+    waiting for the Hub.
+
+    An HfApi instance can be passed to the constructor, for instance a mocked one for testing.
+    """
+
+    def __init__(self, config, api=None):
+        self.config = config
+        if api is None:
+            api = HfApi()
+        self.api = api
+        self.token = None
+
+        # flush thresholds, in number of files and in bytes
+        self.max_files = self.config.get("hf_commit_max_files", 1000)
+        self.max_bytes = self.config.get("hf_commit_max_bytes", 1024 * 1024 * 1024)
+        # max time in seconds a file can wait in the staging queue
+        self.max_delay = self.config.get("hf_commit_max_delay", 300)
+        self.max_attempts = self.config.get("hf_commit_max_attempts", 20)
+        self.retry_delay = self.config.get("hf_commit_retry_delay", 5)
+
+        self._queue = BatchQueue(self._commit_batch, 
+                                 max_items=self.max_files, 
+                                 max_bytes=self.max_bytes, 
+                                 max_delay=self.max_delay, 
+                                 name="hf-commit")
+
+    def _get_repo_id(self):
+        repo_id = None
+        if self.config != None:
+            if "hf_repo_id" in self.config:
+                if self.config["hf_repo_id"] != None and len(self.config["hf_repo_id"]) > 1:
+                    repo_id = self.config["hf_repo_id"]
+
+        if repo_id == None:
+            repo_id = "scilons/test_dataset"
+        return repo_id
+
+    def _get_hf_token(self):
+        if self.token != None:
+            return self.token
+
+        the_token = None
+
+        # check config
+        if self.config != None:
+            if "HUGGINGFACE_TOKEN" in self.config:
+                if self.config["HUGGINGFACE_TOKEN"] != None and len(self.config["HUGGINGFACE_TOKEN"]) > 1:
+                    the_token = self.config["HUGGINGFACE_TOKEN"]
+
+        # check environment variable
+        if the_token == None:
+            the_token = os.getenv('HUGGINGFACE_TOKEN')
+
+        if the_token != None:
+            self.token = the_token
+
+        return the_token
+
+    def add_file(self, file_path, dest_path=None, callback=None, clean=False):
+        """
+        Stage a file to be uploaded with the next commit.
+
+        callback, if not None, is called with True or False once the commit including the file
+        has succeeded or definitely failed. If clean is True, the local file is removed after a
+        successful commit.
+        """
+        file_name = os.path.basename(file_path)
+        if dest_path != None:
+            path_in_repo = os.path.join(dest_path, file_name)
+        else:
+            path_in_repo = file_name
+
+        self._queue.add((file_path, path_in_repo, callback, clean), size=os.path.getsize(file_path))
+
+    def flush(self):
+        """
+        Commit all the currently staged files and wait until all pending commits are done
+        """
+        self._queue.flush()
+
+    def close(self):
+        self._queue.close()
+
+    def _commit_batch(self, batch):
+        # every callback of the batch is called exactly once, with False if the batch failed 
+        # unexpectedly, so that no entry stays pending
+        notified = set()
+        try:
+            self._commit_files(batch, notified)
+        except Exception:
+            logging.exception("Unexpected error committing " + str(len(batch)) + " files to HuggingFace dataset")
+            for i in range(len(batch)):
+                if i not in notified:
+                    self._notify(batch[i], False, notified, i)
+
+    def _notify(self, item, success, notified, i):
+        file_path, path_in_repo, callback, clean = item
+        notified.add(i)
+        if callback is not None:
+            try:
+                callback(success)
+            except Exception:
+                logging.exception("HuggingFace upload callback failed for " + file_path)
+
+    def _commit_files(self, batch, notified):
+        # the files which disappeared since they were staged cannot be committed, they are reported 
+        # as failed and the rest of the batch is committed
+        staged = []
+        for i in range(len(batch)):
+            file_path = batch[i][0]
+            if os.path.isfile(file_path):
+                staged.append(i)
+            else:
+                logging.error("Staged file " + file_path + " not found, not uploaded to HuggingFace dataset")
+                self._notify(batch[i], False, notified, i)
+        if len(staged) == 0:
+            return
+
+        operations = []
+        batch_size = 0
+        for i in staged:
+            file_path, path_in_repo, callback, clean = batch[i]
+            operations.append(CommitOperationAdd(path_in_repo=path_in_repo, path_or_fileobj=file_path))
+            batch_size += os.path.getsize(file_path)
+
+        success = False
+        attempt = 0
+        delay = self.retry_delay
+        start_time = time.time()
+        while attempt < self.max_attempts:
+            # the Hub client does not report the progress of the transfers, the bytes of the batch
+            # are accounted before each attempt
+            bandwidth.throttle("egress", batch_size)
+            try:
+                self.create_commit(operations, "Add " + str(len(operations)) + " files")
+                success = True
+                break
+            except Exception as e:
+                attempt += 1
+                logging.warning("Failed to commit " + str(len(operations)) + " files to HuggingFace dataset: " + str(e))
+                if attempt < self.max_attempts:
+                    time.sleep(delay)
+                    # exponential backoff, capped to 10 minutes
+                    delay = min(delay * 2, 600)
+
+        if not success:
+            logging.error(str(self.max_attempts) + " failed commit attempts to HuggingFace dataset, " +
+                str(len(operations)) + " files not uploaded and kept locally")
+
+        nb_bytes = 0
+        if success:
+            nb_bytes = batch_size
+            metrics.inc("uploaded_objects", len(operations), backend="hf")
+        metrics.observe_stage("upload_batch", time.time() - start_time, nb_bytes=nb_bytes, error=(not success), backend="hf")
+
+        for i in staged:
+            file_path, path_in_repo, callback, clean = batch[i]
+            if success and clean:
+                try:
+                    if os.path.isfile(file_path):
+                        os.remove(file_path)
+                except IOError:
+                    logging.exception("temporary file cleaning failed")
+            self._notify(batch[i], success, notified, i)
+
+    def create_commit(self, operations, commit_message):
+        token = self._get_hf_token()
+        if token == None:
+            self.api.create_commit(
+                repo_id=self._get_repo_id(),
+                operations=operations,
+                commit_message=commit_message,
+                repo_type="dataset",
+            )
+        else:
+            self.api.create_commit(
+                repo_id=self._get_repo_id(),
+                operations=operations,
+                commit_message=commit_message,
+                repo_type="dataset",
+                token=token
+            )
+
+    def upload_file_to_hf(self, file_path, dest_path=None):
+        """
+        Upload immediately the given file to HuggingFace dataset as a single commit
+        """
+        self.add_file(file_path, dest_path=dest_path)
+        self.flush()
+
+    def list_dirs(self, dir_name=None):
+        """
+        Non-recursive listing is not available with the Hub API, return None so that the caller 
+        falls back to a global recursive listing
+        """
+        return None
+
+    def iter_objects(self, dir_name=None):
+        """
+        Iterate over all the files under a given dir of the dataset, yielding (full path, size, git blob id)
+        """
+        paths = None
+        if dir_name != None and len(dir_name) > 0:
+            paths = dir_name.rstrip("/")
+        for repo_file in self.api.list_files_info(self._get_repo_id(), paths=paths, repo_type="dataset", token=self._get_hf_token()):
+            yield repo_file.rfilename, repo_file.size, repo_file.blob_id
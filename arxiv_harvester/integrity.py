@@ -0,0 +1,237 @@
+"""
+Integrity validation of the downloaded content.
+
+A HTTP 200 response is not enough to trust a download: a connection closed early gives a truncated
+file without error, and some proxies or mirrors answer with an HTML error page. The content is
+therefore validated as it is streamed, without reading it again:
+
+- the number of received bytes against the Content-Length of the response,
+- the MD5 hash of the content against the hash given by the server, when available (x-goog-hash
+  header of Google Cloud Storage, ETag of a S3 object uploaded in one part),
+- for a PDF file, the %PDF header at the beginning and the %%EOF marker at the end,
+- for a gzip file (PostScript files, source members), the complete decompression of the stream,
+  which checks the CRC of the content, and for a source member which is a tar archive, the
+  reading of all the tar headers.
+
+A content failing a check raises IntegrityError, the content is then not stored and the error is
+recorded so that the download is tried again.
+"""
+
+import io
+import base64
+import hashlib
+import tarfile
+import zlib
+
+# size of the beginning and of the end of a PDF file where the header and the %%EOF marker are looked for
+PDF_MARKER_WINDOW = 1024
+
+# max size of the decompressed data held at a time when checking a gzip stream
+DECOMPRESS_CHUNK_SIZE = 1024 * 1024
+
+class IntegrityError(Exception):
+    """
+    Raised when a downloaded content fails a check, reason being a short label of the check
+    ("length", "md5", "pdf_header", "pdf_eof", "gzip" or "tar")
+    """
+
+    def __init__(self, reason, message):
+        Exception.__init__(self, message)
+        self.reason = reason
+
+class StreamValidator(object):
+    """
+    Validation of a content given chunk by chunk with update(), the checks being completed by
+    finish() once the whole content is received. kind is "pdf", "gzip" or None for no check of
+    the format.
+    """
+
+    def __init__(self, kind=None, expected_length=None, md5=None):
+        self.kind = kind
+        self.expected_length = expected_length
+        self.expected_md5 = md5
+        self.nb_bytes = 0
+        self._md5 = hashlib.md5() if md5 is not None else None
+        self._head = b""
+        self._tail = b""
+        self._gzip = _GzipChecker() if kind == "gzip" else None
+
+    def update(self, chunk):
+        self.nb_bytes += len(chunk)
+        if self._md5 is not None:
+            self._md5.update(chunk)
+        if self.kind == "pdf":
+            if len(self._head) < PDF_MARKER_WINDOW:
+                self._head += chunk[:PDF_MARKER_WINDOW - len(self._head)]
+                # an HTML error page is detected at the first chunk
+                if len(self._head) >= 5 and b"%PDF-" not in self._head and self._head.lstrip()[:1] == b"<":
+                    raise IntegrityError("pdf_header", "not a PDF file, starting with " + repr(self._head[:64]))
+            self._tail = (self._tail + chunk)[-PDF_MARKER_WINDOW:]
+        elif self._gzip is not None:
+            self._gzip.update(chunk)
+
+    def finish(self):
+        if self.expected_length is not None and self.nb_bytes != self.expected_length:
+            raise IntegrityError("length", "received " + str(self.nb_bytes) + " bytes, expected " + str(self.expected_length))
+        if self._md5 is not None and self._md5.hexdigest() != self.expected_md5:
+            raise IntegrityError("md5", "MD5 " + self._md5.hexdigest() + " of the content, expected " + self.expected_md5)
+        if self.kind == "pdf":
+            if b"%PDF-" not in self._head:
+                raise IntegrityError("pdf_header", "no %PDF header in the first " + str(PDF_MARKER_WINDOW) + " bytes")
+            if b"%%EOF" not in self._tail:
+                raise IntegrityError("pdf_eof", "no %%EOF marker in the last " + str(PDF_MARKER_WINDOW) + " bytes, truncated PDF file")
+        elif self._gzip is not None:
+            self._gzip.finish()
+
+class ValidatingReader(object):
+    """
+    File-like object wrapper validating the bytes read, e.g. a source archive read as a stream.
+    finish() reads what remains of the content, if the consumer stopped before the end, and
+    completes the checks.
+    """
+
+    def __init__(self, fileobj, validator):
+        self.fileobj = fileobj
+        self.validator = validator
+
+    def read(self, *args, **kwargs):
+        data = self.fileobj.read(*args, **kwargs)
+        self.validator.update(data)
+        return data
+
+    def finish(self):
+        while True:
+            data = self.read(DECOMPRESS_CHUNK_SIZE)
+            if len(data) == 0:
+                break
+        self.validator.finish()
+
+    def close(self):
+        self.fileobj.close()
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+class _GzipChecker(object):
+    # decompress a gzip stream, possibly with several members, and discard the decompressed data
+
+    def __init__(self):
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._started = False
+
+    def update(self, chunk):
+        try:
+            while len(chunk) > 0:
+                self._started = True
+                self._decompressor.decompress(chunk, DECOMPRESS_CHUNK_SIZE)
+                chunk = self._decompressor.unconsumed_tail
+                if self._decompressor.eof:
+                    # next gzip member, if any
+                    chunk = self._decompressor.unused_data + chunk
+                    self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    self._started = False
+        except zlib.error as e:
+            raise IntegrityError("gzip", "invalid gzip content: " + str(e))
+
+    def finish(self):
+        if self._started:
+            raise IntegrityError("gzip", "truncated gzip content")
+
+def check_pdf(data):
+    '''
+    Check the header and the end marker of a PDF file given as bytes
+    '''
+    validator = StreamValidator("pdf")
+    validator.update(data)
+    validator.finish()
+
+def check_source_member(data, kind):
+    '''
+    Check a source archive member given as bytes, with its type as given by
+    transcode.detect_source_type(): the complete gzip content, and for a tar archive, all its
+    headers and members
+    '''
+    if kind == "pdf":
+        check_pdf(data)
+        return
+    validator = StreamValidator("gzip")
+    validator.update(data)
+    validator.finish()
+    if kind == "tar.gz":
+        try:
+            with tarfile.open(fileobj=io.BytesIO(data), mode="r|gz") as tar:
+                for member in tar:
+                    pass
+        except (tarfile.TarError, EOFError, OSError) as e:
+            raise IntegrityError("tar", "invalid tar archive: " + str(e))
+
+def check_file(path, expected_length=None, md5=None, kind=None):
+    '''
+    Validate a downloaded file, reading it by chunks
+    '''
+    validator = StreamValidator(kind, expected_length=expected_length, md5=md5)
+    with open(path, "rb") as the_file:
+        while True:
+            chunk = the_file.read(DECOMPRESS_CHUNK_SIZE)
+            if len(chunk) == 0:
+                break
+            validator.update(chunk)
+    validator.finish()
+
+def content_kind(name):
+    '''
+    Format of a file to be checked given its name or url, None if not checked
+    '''
+    if name.endswith(".pdf"):
+        return "pdf"
+    if name.endswith(".gz"):
+        return "gzip"
+    return None
+
+def response_checks(headers):
+    '''
+    Expected length and MD5 hash of the content of a HTTP response, from its headers (None when
+    not available). A content transformed by a Content-Encoding is not checked, as the length and
+    the hash then apply to the encoded content.
+    '''
+    if headers.get("Content-Encoding", "identity") != "identity":
+        return None, None
+    expected_length = None
+    if headers.get("Content-Length") is not None:
+        try:
+            expected_length = int(headers["Content-Length"])
+        except ValueError:
+            pass
+    return expected_length, goog_hash_md5(headers.get("x-goog-hash"))
+
+def goog_hash_md5(header):
+    '''
+    MD5 hash in hexadecimal of a x-goog-hash header, e.g. "crc32c=n03x6A==,md5=Ojk9c3dhfxgoKVVHYwFbHQ==",
+    or None if not present
+    '''
+    if header is None:
+        return None
+    for value in header.split(","):
+        name, _, digest = value.strip().partition("=")
+        if name == "md5":
+            try:
+                return base64.b64decode(digest).hex()
+            except ValueError:
+                return None
+    return None
+
+def etag_md5(etag, encryption=None):
+    '''
+    MD5 hash of the content of a S3 object given its ETag and its server side encryption, or None
+    if the ETag is not a MD5 (object uploaded in several parts, or encrypted with KMS)
+    '''
+    if etag is None or encryption == "aws:kms":
+        return None
+    etag = etag.strip('"')
+    if len(etag) != 32 or "-" in etag:
+        return None
+    try:
+        int(etag, 16)
+    except ValueError:
+        return None
+    return etag
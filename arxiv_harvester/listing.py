@@ -0,0 +1,117 @@
+"""
+Parallel listing of the harvested resources on the storage backend.
+
+The resources are organized as collection/prefix/full_number/file_name, with prefix being the YYMM
+of the arXiv identifier. Listing is partitioned by collection/prefix and the partitions are
+listed concurrently, so that listing time scales with the number of threads and not with the
+size of the bucket or container.
+"""
+
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# logging
+import logging
+import logging.handlers
+
+def list_partitions(backend):
+    '''
+    Return the list of collection/prefix partitions (e.g. "arxiv/1501/", "math/0309/") present
+    on the storage backend, or None if the backend cannot list directories
+    '''
+    collections = backend.list_dirs("")
+    if collections is None:
+        return None
+
+    partitions = []
+    for collection in collections:
+        for partition in backend.list_dirs(collection):
+            # prefixes are always YYMM, this also ignores non-collection dirs like lmdb ones for local storage
+            prefix = partition.rstrip("/").split("/")[-1]
+            if len(prefix) == 4 and prefix.isdigit():
+                partitions.append(partition)
+    return partitions
+
+def iter_storage_objects(backend, nb_threads=16):
+    '''
+    Iterate over all the harvested objects on the storage backend, yielding (full key, size, etag).
+    Partitions are listed in parallel, results are yielded as soon as they are available.
+    '''
+    partitions = list_partitions(backend)
+    if partitions is None:
+        # no partitioned listing possible, single global listing
+        for key, size, etag in backend.iter_objects(""):
+            yield key, size, etag
+        return
+
+    for result in iter_parallel(backend, partitions, nb_threads=nb_threads):
+        yield result
+
+def iter_parallel(backend, partitions, nb_threads=16):
+    '''
+    Iterate over all the objects under the given partitions (dir names) of the storage backend, 
+    yielding (full key, size, etag). Partitions are listed concurrently by a pool of threads and 
+    results are yielded as soon as they are available, in no particular order.
+    '''
+    if len(partitions) == 0:
+        return
+
+    results = queue.Queue(maxsize=10000)
+    done = object()
+    # set when the consumer stops iterating, so that listing threads do not stay blocked
+    stop = threading.Event()
+
+    def put(result):
+        while not stop.is_set():
+            try:
+                results.put(result, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def list_partition(partition):
+        try:
+            for result in backend.iter_objects(partition):
+                if not put(result):
+                    return
+        except Exception:
+            logging.exception("listing failed for partition " + partition)
+        finally:
+            put(done)
+
+    executor = ThreadPoolExecutor(max_workers=nb_threads)
+    for partition in partitions:
+        executor.submit(list_partition, partition)
+
+    remaining = len(partitions)
+    try:
+        while remaining > 0:
+            result = results.get()
+            if result is done:
+                remaining -= 1
+            else:
+                yield result
+    finally:
+        stop.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def key_to_identifier(key):
+    '''
+    Convert a storage key into (arxiv identifier, file name), or (None, None) if the key does not
+    follow the collection/prefix/full_number/file_name organization
+
+    arxiv/1501/1501.00001/1501.00001.pdf.gz -> 1501.00001, 1501.00001.pdf.gz
+    math/0309/0309136/0309136.json -> math/0309136, 0309136.json
+    '''
+    pieces = key.split("/")
+    if len(pieces) != 4:
+        return None, None
+    collection, prefix, full_number, file_name = pieces
+    if not full_number.startswith(prefix):
+        return None, None
+    if collection == "arxiv":
+        return full_number, file_name
+    else:
+        return collection + "/" + full_number, file_name
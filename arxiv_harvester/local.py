@@ -0,0 +1,199 @@
+import os
+import errno
+import shutil
+import threading
+import uuid
+import fcntl
+
+# logging
+import logging
+import logging.handlers
+
+# ioctl request to clone a file (reflink) on Linux file systems supporting it (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+class Local(object):
+    """
+    Store files on the local file system under data_path.
+
+    Files are never written in place: a file is published in the corpus with an atomic rename,
+    either directly from the temporary file when it is on the same file system, or from a
+    staging file created next to the destination. A crash can therefore never leave a
+    half-written file under the final path.
+
+    The fsync policy is given by the config parameter "local_fsync":
+    - "none" (default): rely on the OS to write data to disk
+    - "file": fsync the file content before publishing it
+    - "full": fsync the file content and the destination directory after publishing
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.data_path = self.config["data_path"]
+        self.fsync = self.config.get("local_fsync", "none")
+        if self.fsync not in ["none", "file", "full"]:
+            logging.warning("invalid local_fsync value " + str(self.fsync) + ", using none")
+            self.fsync = "none"
+
+        # directories already created, to avoid repeating makedirs syscalls
+        self._dirs = set()
+        self._lock = threading.Lock()
+
+    def _makedirs(self, path):
+        if path in self._dirs:
+            return
+        os.makedirs(path, exist_ok=True)
+        with self._lock:
+            self._dirs.add(path)
+
+    def store_file(self, source, dest_path, file_name=None, move=True):
+        """
+        Store a file under data_path/dest_path and return the final path of the stored file.
+        If move is True, the source file is moved (and so removed from its original place),
+        otherwise it is copied.
+        """
+        if file_name is None:
+            file_name = os.path.basename(source)
+        local_dest_path = os.path.join(self.data_path, dest_path)
+        self._makedirs(local_dest_path)
+        destination = os.path.join(local_dest_path, file_name)
+
+        if move:
+            if self.fsync != "none":
+                _fsync_path(source)
+            try:
+                os.replace(source, destination)
+                if self.fsync == "full":
+                    _fsync_path(local_dest_path)
+                return destination
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                # different devices, we need to copy the data
+
+        staging = os.path.join(local_dest_path, "." + file_name + "." + uuid.uuid4().hex + ".tmp")
+        try:
+            with open(source, 'rb') as f_in:
+                with open(staging, 'wb') as f_out:
+                    _copy_file_data(f_in, f_out)
+                    if self.fsync != "none":
+                        f_out.flush()
+                        os.fsync(f_out.fileno())
+            os.replace(staging, destination)
+        except:
+            if os.path.isfile(staging):
+                os.remove(staging)
+            raise
+
+        if self.fsync == "full":
+            _fsync_path(local_dest_path)
+
+        if move:
+            os.remove(source)
+
+        return destination
+
+    def store_fileobj(self, fileobj, dest_path, file_name):
+        """
+        Store the content of a file object under data_path/dest_path/file_name, via a staging file 
+        published with an atomic rename, and return the final path of the stored file
+        """
+        local_dest_path = os.path.join(self.data_path, dest_path)
+        self._makedirs(local_dest_path)
+        destination = os.path.join(local_dest_path, file_name)
+
+        staging = os.path.join(local_dest_path, "." + file_name + "." + uuid.uuid4().hex + ".tmp")
+        try:
+            with open(staging, 'wb') as f_out:
+                shutil.copyfileobj(fileobj, f_out, 1024 * 1024)
+                if self.fsync != "none":
+                    f_out.flush()
+                    os.fsync(f_out.fileno())
+            os.replace(staging, destination)
+        except:
+            if os.path.isfile(staging):
+                os.remove(staging)
+            raise
+
+        if self.fsync == "full":
+            _fsync_path(local_dest_path)
+
+        return destination
+
+    def list_dirs(self, dir_name=None):
+        """
+        Return the sub-directories directly under a given dir relative to data_path, 
+        e.g. "arxiv/" -> ["arxiv/0704/", "arxiv/0705/", ...]
+        """
+        if dir_name == None:
+            dir_name = ""
+        dirs = []
+        try:
+            with os.scandir(os.path.join(self.data_path, dir_name)) as it:
+                for dir_entry in it:
+                    if dir_entry.is_dir(follow_symlinks=False):
+                        dirs.append(dir_name + dir_entry.name + "/")
+        except FileNotFoundError:
+            pass
+        return dirs
+
+    def iter_objects(self, dir_name=None):
+        """
+        Iterate over all the files under a given dir relative to data_path, yielding (relative path, size, None),
+        no etag being available for local files
+        """
+        if dir_name == None:
+            dir_name = ""
+        stack = [dir_name]
+        while len(stack) > 0:
+            current = stack.pop()
+            try:
+                with os.scandir(os.path.join(self.data_path, current)) as it:
+                    for dir_entry in it:
+                        if dir_entry.is_dir(follow_symlinks=False):
+                            stack.append(current + dir_entry.name + "/")
+                        elif dir_entry.is_file(follow_symlinks=False) and not dir_entry.name.startswith("."):
+                            # hidden files are staging files not yet published 
+                            yield current + dir_entry.name, dir_entry.stat().st_size, None
+            except FileNotFoundError:
+                pass
+
+def _fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _copy_file_data(f_in, f_out):
+    '''
+    Copy the content of a file into another one, trying first to clone it (reflink, no data copy),
+    then an in-kernel copy with copy_file_range, and finally a usual buffered copy
+    '''
+    try:
+        fcntl.ioctl(f_out.fileno(), FICLONE, f_in.fileno())
+        return
+    except (OSError, IOError):
+        pass
+
+    if hasattr(os, "copy_file_range"):
+        try:
+            size = os.fstat(f_in.fileno()).st_size
+            copied = 0
+            while copied < size:
+                n = os.copy_file_range(f_in.fileno(), f_out.fileno(), size - copied)
+                if n == 0:
+                    break
+                copied += n
+            if copied == size:
+                return
+            # unexpected short copy, restart with a usual copy
+            f_in.seek(0)
+            f_out.seek(0)
+            f_out.truncate()
+        except OSError:
+            f_in.seek(0)
+            f_out.seek(0)
+            f_out.truncate()
+
+    shutil.copyfileobj(f_in, f_out, 1024 * 1024)
@@ -0,0 +1,120 @@
+"""
+Planning of the source harvesting based on the arXiv source manifest.
+
+The manifest (arXiv_src_manifest.xml, in the same directory as the source archives of the arXiv
+source bucket) describes every source archive:
+
+    <file>
+        <filename>src/arXiv_src_0001_001.tar</filename>
+        <first_item>astro-ph0001001</first_item>
+        <last_item>quant-ph0001119</last_item>
+        <md5sum>949ae880fbaf4649a485a8d9e07f370b</md5sum>
+        <num_items>2365</num_items>
+        <size>225605507</size>
+        <yymm>0001</yymm>
+        ...
+    </file>
+
+Archives can then be selected by month or by identifier range, and compared with the archives
+already processed to plan only new or changed archives, without listing the bucket.
+"""
+
+import os
+import re
+import xml.etree.ElementTree as ET
+
+# logging
+import logging
+import logging.handlers
+
+def parse_manifest(manifest_path, prefix=None):
+    '''
+    Parse a source manifest file and return the list of archive descriptions, as dict with
+    archive (S3 key), yymm, first_item, last_item, num_items, size and md5. If prefix is given,
+    the archive keys are the file names under this prefix, otherwise the file names as in the
+    manifest.
+    '''
+    archives = []
+    root = ET.parse(manifest_path).getroot()
+    for file_element in root.iter("file"):
+        filename = file_element.findtext("filename")
+        if filename is None:
+            continue
+        entry = {}
+        if prefix is None:
+            entry['archive'] = filename
+        else:
+            entry['archive'] = prefix + os.path.basename(filename)
+        entry['yymm'] = file_element.findtext("yymm")
+        entry['first_item'] = file_element.findtext("first_item")
+        entry['last_item'] = file_element.findtext("last_item")
+        entry['num_items'] = _to_int(file_element.findtext("num_items"))
+        entry['size'] = _to_int(file_element.findtext("size"))
+        entry['md5'] = file_element.findtext("md5sum")
+        archives.append(entry)
+    return archives
+
+def select_archives(archives, yymm=None, id_range=None):
+    '''
+    Select the archives of some months and/or covering a range of identifiers.
+
+    yymm is a month ("2101"), a range of months ("2101-2112") or a comma-separated list of both,
+    id_range is a range of arXiv identifiers ("2101.00001:2101.05000" or "hep-th/9901001:9912999"),
+    an archive being selected if its items overlap the range.
+    '''
+    selected = []
+    months = None
+    if yymm is not None:
+        months = []
+        for piece in yymm.split(","):
+            bounds = piece.strip().split("-")
+            months.append((_month_key(bounds[0]), _month_key(bounds[-1])))
+
+    id_bounds = None
+    if id_range is not None:
+        bounds = id_range.split(":")
+        id_bounds = (_identifier_key(bounds[0]), _identifier_key(bounds[-1]))
+
+    for archive in archives:
+        if months is not None:
+            if archive['yymm'] is None:
+                continue
+            month = _month_key(archive['yymm'])
+            if not any(start <= month <= end for start, end in months):
+                continue
+        if id_bounds is not None:
+            if archive['first_item'] is None or archive['last_item'] is None:
+                continue
+            if _identifier_key(archive['last_item']) < id_bounds[0] or _identifier_key(archive['first_item']) > id_bounds[1]:
+                continue
+        selected.append(archive)
+    return selected
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def _month_key(yymm):
+    '''
+    Sortable month from a YYMM string, arXiv starting in 1991: 9108 -> 199108, 0001 -> 200001
+    '''
+    yymm = yymm.strip()
+    year = int(yymm[:2])
+    if year >= 91:
+        year += 1900
+    else:
+        year += 2000
+    return year * 100 + int(yymm[2:4])
+
+def _identifier_key(identifier):
+    '''
+    Sortable key from an arXiv identifier or source item name, (month, number), e.g.
+    2101.00001 -> (202101, 1), hep-th/9901001 or hep-th9901001 -> (199901, 1). For old style
+    identifiers the category is ignored.
+    '''
+    match = re.search(r"([0-9]{4})\.?([0-9]+)(v[0-9]+)?$", identifier.strip())
+    if match is None:
+        return (0, 0)
+    return (_month_key(match.group(1)), int(match.group(2)))
@@ -0,0 +1,306 @@
+"""
+Metrics of the harvesting stages (download, conversion, compression, upload, state commit).
+
+Every stage records its number of operations, errors, bytes and a latency histogram, with labels
+such as the storage backend or the arXiv collection. The metrics of the process are kept in the
+module-level registry `metrics` and can be reported:
+
+- through a Prometheus-style HTTP endpoint (config parameter "metrics_port", disabled by default,
+  bound to "metrics_host", default 127.0.0.1 so that it is only reachable from the machine),
+- in a JSON stats file under data_path, rewritten every "stats_interval" seconds (default 60,
+  0 to disable) and at the end of the harvesting.
+"""
+
+import os
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# stages are also followed by the profiler, when active
+import arxiv_harvester.profiling as profiling
+
+# logging
+import logging
+import logging.handlers
+
+PREFIX = "arxiv_harvester_"
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+
+class Histogram(object):
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        '''
+        Approximate quantile, as the upper bound of the bucket containing it
+        '''
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulated = 0
+        for i in range(len(self.counts)):
+            cumulated += self.counts[i]
+            if cumulated >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+class _Stage(object):
+    # context of a stage operation, see Metrics.stage()
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.bytes = 0
+        self.error = False
+
+    def __enter__(self):
+        profiling.enter_stage(self.name)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.time() - self.start
+        profiling.exit_stage(self.name, seconds)
+        if exc_type is not None:
+            self.error = True
+        self.metrics.observe_stage(self.name, seconds, nb_bytes=self.bytes, error=self.error, **self.labels)
+        return False
+
+class Metrics(object):
+    """
+    Thread-safe registry of stage statistics, counters and gauges
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.start_time = time.time()
+        # (stage, labels) -> [histogram, errors, bytes]
+        self.stages = {}
+        # (name, labels) -> value
+        self.counters = {}
+        self.gauges = {}
+
+    def stage(self, name, **labels):
+        """
+        Context manager timing one operation of a stage, the number of bytes processed can be set
+        with the attribute bytes and a failure flagged with the attribute error (an exception also
+        counts as error):
+
+            with metrics.stage("upload", backend="s3") as stage:
+                stage.bytes = size
+                ...
+        """
+        return _Stage(self, name, labels)
+
+    def observe_stage(self, name, seconds, nb_bytes=0, error=False, **labels):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            entry = self.stages.get(key)
+            if entry is None:
+                entry = [Histogram(), 0, 0]
+                self.stages[key] = entry
+            entry[0].observe(seconds)
+            if error:
+                entry[1] += 1
+            entry[2] += nb_bytes
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self.gauges[key] = value
+
+    def quantile(self, name, q, **labels):
+        """
+        Approximate quantile of the latency of a stage for the given labels, None if not observed
+        """
+        key = (name, _labels_key(labels))
+        with self._lock:
+            entry = self.stages.get(key)
+            if entry is None:
+                return None
+            return entry[0].quantile(q)
+
+    def count(self, name, **labels):
+        """
+        Number of operations of a stage observed for the given labels
+        """
+        key = (name, _labels_key(labels))
+        with self._lock:
+            entry = self.stages.get(key)
+            if entry is None:
+                return 0
+            return entry[0].count
+
+    def reset(self):
+        with self._lock:
+            self.start_time = time.time()
+            self.stages = {}
+            self.counters = {}
+            self.gauges = {}
+
+    def to_dict(self):
+        with self._lock:
+            result = {}
+            result['timestamp'] = time.strftime("%Y-%m-%dT%H:%M:%S")
+            result['uptime_seconds'] = round(time.time() - self.start_time, 3)
+            result['stages'] = []
+            for (name, labels), (histogram, errors, nb_bytes) in sorted(self.stages.items()):
+                stage = {}
+                stage['stage'] = name
+                stage['labels'] = dict(labels)
+                stage['count'] = histogram.count
+                stage['errors'] = errors
+                stage['bytes'] = nb_bytes
+                stage['seconds'] = round(histogram.sum, 3)
+                stage['mean_seconds'] = round(histogram.sum / histogram.count, 4) if histogram.count > 0 else None
+                stage['p50_seconds'] = histogram.quantile(0.5)
+                stage['p95_seconds'] = histogram.quantile(0.95)
+                result['stages'].append(stage)
+            result['counters'] = [ { 'name': name, 'labels': dict(labels), 'value': value } for (name, labels), value in sorted(self.counters.items()) ]
+            result['gauges'] = [ { 'name': name, 'labels': dict(labels), 'value': value } for (name, labels), value in sorted(self.gauges.items()) ]
+        return result
+
+    def render_prometheus(self):
+        """
+        Return the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            lines.append("# TYPE " + PREFIX + "stage_seconds histogram")
+            for (name, labels), (histogram, errors, nb_bytes) in sorted(self.stages.items()):
+                stage_labels = (("stage", name),) + labels
+                cumulated = 0
+                for i in range(len(histogram.buckets)):
+                    cumulated += histogram.counts[i]
+                    lines.append(PREFIX + "stage_seconds_bucket" + _render_labels(stage_labels + (("le", str(histogram.buckets[i])),)) + " " + str(cumulated))
+                lines.append(PREFIX + "stage_seconds_bucket" + _render_labels(stage_labels + (("le", "+Inf"),)) + " " + str(histogram.count))
+                lines.append(PREFIX + "stage_seconds_sum" + _render_labels(stage_labels) + " " + str(histogram.sum))
+                lines.append(PREFIX + "stage_seconds_count" + _render_labels(stage_labels) + " " + str(histogram.count))
+            lines.append("# TYPE " + PREFIX + "stage_errors_total counter")
+            for (name, labels), (histogram, errors, nb_bytes) in sorted(self.stages.items()):
+                lines.append(PREFIX + "stage_errors_total" + _render_labels((("stage", name),) + labels) + " " + str(errors))
+            lines.append("# TYPE " + PREFIX + "stage_bytes_total counter")
+            for (name, labels), (histogram, errors, nb_bytes) in sorted(self.stages.items()):
+                lines.append(PREFIX + "stage_bytes_total" + _render_labels((("stage", name),) + labels) + " " + str(nb_bytes))
+
+            for name in sorted(set(name for name, labels in self.counters)):
+                lines.append("# TYPE " + PREFIX + name + "_total counter")
+                for (counter_name, labels), value in sorted(self.counters.items()):
+                    if counter_name == name:
+                        lines.append(PREFIX + name + "_total" + _render_labels(labels) + " " + str(value))
+            for name in sorted(set(name for name, labels in self.gauges)):
+                lines.append("# TYPE " + PREFIX + name + " gauge")
+                for (gauge_name, labels), value in sorted(self.gauges.items()):
+                    if gauge_name == name:
+                        lines.append(PREFIX + name + _render_labels(labels) + " " + str(value))
+        return "\n".join(lines) + "\n"
+
+def _labels_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items() if value is not None))
+
+def _render_labels(labels):
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(key + '="' + value.replace("\\", "\\\\").replace('"', '\\"') + '"' for key, value in labels) + "}"
+
+# metrics of the current process
+metrics = Metrics()
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] == "/metrics":
+            body = metrics.render_prometheus().encode("UTF-8")
+            content_type = "text/plain; version=0.0.4"
+        elif self.path.split("?")[0] == "/stats":
+            body = json.dumps(metrics.to_dict()).encode("UTF-8")
+            content_type = "application/json"
+        else:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class MetricsReporter(object):
+    """
+    Report the metrics of the process during a harvesting run, through the HTTP endpoint and/or
+    the periodic JSON stats file, as set in the config
+    """
+
+    def __init__(self, config, stats_file_name="stats.json"):
+        self.port = config.get("metrics_port", None)
+        self.host = config.get("metrics_host", "127.0.0.1")
+        self.interval = config.get("stats_interval", 60)
+        self.stats_path = os.path.join(config["data_path"], stats_file_name)
+        self._server = None
+        self._writer = None
+        self._stop = threading.Event()
+
+    def start(self):
+        if self.port is not None and self.port > 0:
+            try:
+                self._server = ThreadingHTTPServer((self.host, self.port), _MetricsHandler)
+                self._server.daemon_threads = True
+                threading.Thread(target=self._server.serve_forever, name="metrics-server", daemon=True).start()
+            except OSError:
+                logging.exception("Could not start the metrics endpoint on " + self.host + ":" + str(self.port))
+                self._server = None
+
+        if self.interval is not None and self.interval > 0:
+            self._writer = threading.Thread(target=self._write_loop, name="stats-writer", daemon=True)
+            self._writer.start()
+        return self
+
+    def _write_loop(self):
+        while not self._stop.wait(self.interval):
+            self.write_stats()
+
+    def write_stats(self):
+        tmp_path = self.stats_path + ".tmp"
+        try:
+            with open(tmp_path, "w") as the_file:
+                json.dump(metrics.to_dict(), the_file, indent=2)
+            os.replace(tmp_path, self.stats_path)
+        except (IOError, OSError):
+            logging.exception("Could not write stats file " + self.stats_path)
+
+    def stop(self):
+        self._stop.set()
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+        if self.interval is not None and self.interval > 0:
+            self.write_stats()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
@@ -0,0 +1,250 @@
+"""
+Low-overhead sampling profiler of the harvesting stages, enabled with --profile.
+
+A background thread samples the Python stacks of all the threads at a regular interval
+(sys._current_frames()). Every sample is attributed to its thread and to the stage the thread is
+currently in (download, compression, upload, commit, etc., as declared with metrics.stage()), so
+that the profiles of the different threads and stages are not mixed.
+
+The profiles are written under data_path/profiles as collapsed stacks (one "frame;frame;... count"
+line per stack, the input format of flame graph tools), per stage and per thread, together with a
+summary of the hottest functions. They are written every "profile_dump_interval" seconds and at
+the end of the harvesting. The slowest entries, with their time per stage, are also logged and
+written in slowest_entries.json.
+
+Conversions done in worker processes are not sampled, their time still appears in the timing
+breakdown of the entries.
+"""
+
+import os
+import sys
+import json
+import time
+import heapq
+import threading
+from collections import Counter
+
+# logging
+import logging
+import logging.handlers
+
+# the active profiler of the process, if any
+_profiler = None
+
+# stage stacks of the threads, by thread id, maintained only when a profiler is active
+_thread_stages = {}
+
+# timing breakdown of the entry being processed in the current thread
+_local = threading.local()
+
+def enter_stage(name):
+    if _profiler is None:
+        return
+    _thread_stages.setdefault(threading.get_ident(), []).append(name)
+
+def exit_stage(name, seconds):
+    if _profiler is None:
+        return
+    stages = _thread_stages.get(threading.get_ident())
+    if stages and stages[-1] == name:
+        stages.pop()
+    add_stage_time(name, seconds)
+
+def add_stage_time(name, seconds):
+    '''
+    Add the time of a stage to the entry processed in the current thread, e.g. a conversion
+    done in a worker process
+    '''
+    timing = getattr(_local, "timing", None)
+    if timing is not None:
+        timing[name] = timing.get(name, 0) + seconds
+
+class _Entry(object):
+    # context of the processing of one entry, see entry()
+
+    def __init__(self, identifier):
+        self.identifier = identifier
+
+    def __enter__(self):
+        if _profiler is not None:
+            self.previous = getattr(_local, "timing", None)
+            _local.timing = {}
+            self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if _profiler is not None:
+            timing = _local.timing
+            _local.timing = self.previous
+            _profiler.record_entry(self.identifier, time.time() - self.start, timing)
+        return False
+
+def entry(identifier):
+    '''
+    Context manager around the processing of one entry (a paper), to keep the timing breakdown
+    of the slowest entries
+    '''
+    return _Entry(identifier)
+
+class Profiler(object):
+
+    def __init__(self, config, name):
+        self.name = name
+        self.interval = config.get("profile_sampling_interval", 0.01)
+        self.dump_interval = config.get("profile_dump_interval", 60)
+        self.nb_slowest = config.get("profile_slowest", 20)
+        self.path = os.path.join(config["data_path"], "profiles")
+
+        self._lock = threading.Lock()
+        self.stage_stacks = {}
+        self.thread_stacks = {}
+        self.nb_samples = 0
+        # min-heap of (duration, counter, identifier, timing)
+        self.slowest = []
+        self._counter = 0
+        self._stop = threading.Event()
+        self._sampler = None
+        self._dumper = None
+
+    def start(self):
+        os.makedirs(self.path, exist_ok=True)
+        self._sampler = threading.Thread(target=self._sample_loop, name="profile-sampler", daemon=True)
+        self._sampler.start()
+        if self.dump_interval is not None and self.dump_interval > 0:
+            self._dumper = threading.Thread(target=self._dump_loop, name="profile-dumper", daemon=True)
+            self._dumper.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        if self._dumper is not None:
+            self._dumper.join()
+        self.dump()
+        self.log_slowest()
+
+    def _sample_loop(self):
+        own_ids = set()
+        while not self._stop.wait(self.interval):
+            own_ids.add(threading.get_ident())
+            if self._dumper is not None and self._dumper.ident is not None:
+                own_ids.add(self._dumper.ident)
+            names = { thread.ident: thread.name for thread in threading.enumerate() }
+            frames = sys._current_frames()
+            with self._lock:
+                self.nb_samples += 1
+                for thread_id, frame in frames.items():
+                    if thread_id in own_ids:
+                        continue
+                    stack = _collapse(frame)
+                    thread_name = names.get(thread_id, str(thread_id))
+                    self.thread_stacks.setdefault(thread_name, Counter())[stack] += 1
+                    stages = _thread_stages.get(thread_id)
+                    if stages:
+                        self.stage_stacks.setdefault(stages[-1], Counter())[stack] += 1
+
+    def _dump_loop(self):
+        while not self._stop.wait(self.dump_interval):
+            self.dump()
+
+    def record_entry(self, identifier, duration, timing):
+        with self._lock:
+            self._counter += 1
+            item = (duration, self._counter, identifier, timing)
+            if len(self.slowest) < self.nb_slowest:
+                heapq.heappush(self.slowest, item)
+            elif duration > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, item)
+
+    def _slowest_entries(self):
+        with self._lock:
+            items = sorted(self.slowest, reverse=True)
+        return [ { 'id': identifier, 'seconds': round(duration, 4), 'stages': { stage: round(seconds, 4) for stage, seconds in timing.items() } }
+            for duration, counter, identifier, timing in items ]
+
+    def dump(self):
+        """
+        Write the collapsed stacks per stage and per thread, the summary of the hottest functions and
+        the slowest entries
+        """
+        with self._lock:
+            stage_stacks = { stage: Counter(stacks) for stage, stacks in self.stage_stacks.items() }
+            thread_stacks = { thread: Counter(stacks) for thread, stacks in self.thread_stacks.items() }
+            nb_samples = self.nb_samples
+
+        try:
+            for stage, stacks in stage_stacks.items():
+                _write_collapsed(os.path.join(self.path, self.name + "-stage-" + _safe_name(stage) + ".folded"), stacks)
+            for thread, stacks in thread_stacks.items():
+                _write_collapsed(os.path.join(self.path, self.name + "-thread-" + _safe_name(thread) + ".folded"), stacks)
+
+            summary = {}
+            summary['samples'] = nb_samples
+            summary['sampling_interval'] = self.interval
+            summary['stages'] = { stage: _hottest(stacks) for stage, stacks in stage_stacks.items() }
+            summary['threads'] = { thread: _hottest(stacks) for thread, stacks in thread_stacks.items() }
+            _write_json(os.path.join(self.path, self.name + "-summary.json"), summary)
+            _write_json(os.path.join(self.path, self.name + "-slowest_entries.json"), self._slowest_entries())
+        except (IOError, OSError):
+            logging.exception("Could not write profiles under " + self.path)
+
+    def log_slowest(self):
+        for item in self._slowest_entries():
+            breakdown = ", ".join(stage + ": " + str(seconds) + "s" for stage, seconds in sorted(item['stages'].items(), key=lambda x: -x[1]))
+            logging.warning("slow entry " + item['id'] + " " + str(item['seconds']) + "s (" + breakdown + ")")
+
+def start(config, name):
+    '''
+    Start profiling the current process if enabled in the config ("profile": true, set by the
+    --profile option), return the profiler to be stopped at the end, or None
+    '''
+    global _profiler
+    if not config.get("profile", False) or _profiler is not None:
+        return None
+    _profiler = Profiler(config, name).start()
+    return _profiler
+
+def stop(profiler):
+    global _profiler
+    if profiler is None:
+        return
+    profiler.stop()
+    _profiler = None
+    _thread_stages.clear()
+
+def _collapse(frame, max_depth=64):
+    names = []
+    while frame is not None and len(names) < max_depth:
+        code = frame.f_code
+        names.append(os.path.basename(code.co_filename) + ":" + code.co_name + ":" + str(code.co_firstlineno))
+        frame = frame.f_back
+    names.reverse()
+    return ";".join(names)
+
+def _hottest(stacks, top=20):
+    # functions with the most samples on top of the stack (self) and anywhere in the stack (total)
+    self_counts = Counter()
+    total_counts = Counter()
+    for stack, count in stacks.items():
+        frames = stack.split(";")
+        self_counts[frames[-1]] += count
+        for frame in set(frames):
+            total_counts[frame] += count
+    return { 'self': self_counts.most_common(top), 'total': total_counts.most_common(top) }
+
+def _write_collapsed(path, stacks):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as the_file:
+        for stack, count in stacks.most_common():
+            the_file.write(stack + " " + str(count) + "\n")
+    os.replace(tmp_path, path)
+
+def _write_json(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as the_file:
+        json.dump(data, the_file, indent=2)
+    os.replace(tmp_path, path)
+
+def _safe_name(name):
+    return "".join(c if c.isalnum() or c in "-_." else "_" for c in name)
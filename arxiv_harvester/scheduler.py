@@ -0,0 +1,179 @@
+"""
+Priority scheduling of the entries to be harvested.
+
+By default, the entries are harvested in the order of the metadata file, which is roughly the
+oldest first. With the scheduler ("schedule": true in the config, or --schedule), the pending
+entries are first spooled in a temporary LMDB under data_path, sorted by priority class and, in
+each class, from the most recent version to the oldest one. The classes are:
+
+- "fresh": the latest version was submitted less than "schedule_fresh_days" days ago (default 30),
+- "category": an entry of one of the "schedule_categories" (e.g. ["cs.CL", "cs.AI"]),
+- "default": the other entries,
+- "large": the entries known to be large, with at least "schedule_large_pages" pages (default 50)
+  according to their metadata comments.
+
+The classes are served by stride scheduling, with the weights "schedule_weights" (default
+{"fresh": 8, "category": 4, "default": 2, "large": 1}): every class progresses in proportion to
+its weight, so that the low priority entries are still harvested while a backlog of fresh entries
+is processed. A class without pending entries gives its share to the others.
+"""
+
+import os
+import re
+import json
+import time
+import shutil
+import struct
+import calendar
+import email.utils
+
+import lmdb
+
+# metrics of the harvesting stages
+from arxiv_harvester.metrics import metrics
+
+# logging
+import logging
+import logging.handlers
+
+CLASSES = ["fresh", "category", "default", "large"]
+
+DEFAULT_WEIGHTS = {"fresh": 8, "category": 4, "default": 2, "large": 1}
+
+# max size of the spool of pending entries
+map_size = 200 * 1024 * 1024 * 1024
+
+_PAGES = re.compile(r"(\d+)\s*pages", re.IGNORECASE)
+
+class HarvestScheduler(object):
+
+    def __init__(self, config):
+        self.fresh_seconds = config.get("schedule_fresh_days", 30) * 24 * 3600
+        self.categories = set(config.get("schedule_categories", []))
+        self.large_pages = config.get("schedule_large_pages", 50)
+        self.weights = dict(DEFAULT_WEIGHTS)
+        self.weights.update(config.get("schedule_weights", {}))
+        self.spool_path = os.path.join(config["data_path"], "schedule")
+
+    def priority(self, entry):
+        '''
+        Return the class of an entry and the timestamp of its latest version (0 if unknown)
+        '''
+        timestamp = _latest_version_time(entry)
+        if timestamp > 0 and time.time() - timestamp < self.fresh_seconds:
+            return "fresh", timestamp
+        if len(self.categories) > 0 and len(self.categories.intersection(_get_categories(entry))) > 0:
+            return "category", timestamp
+        pages = _get_pages(entry)
+        if pages is not None and pages >= self.large_pages:
+            return "large", timestamp
+        return "default", timestamp
+
+    def schedule(self, entries):
+        '''
+        Spool all the given entries, then iterate over them in the scheduled order
+        '''
+        # the spool of a previous run is not reused, the pending entries are computed again
+        shutil.rmtree(self.spool_path, ignore_errors=True)
+        env = lmdb.open(self.spool_path, map_size=map_size)
+        try:
+            counts = self._spool(env, entries)
+            print("scheduled entries:", ", ".join(name + ": " + str(counts[name]) for name in CLASSES))
+            for entry in self._iter_scheduled(env, counts):
+                yield entry
+        finally:
+            env.close()
+            shutil.rmtree(self.spool_path, ignore_errors=True)
+
+    def _spool(self, env, entries):
+        counts = dict((name, 0) for name in CLASSES)
+        sequence = 0
+        txn = env.begin(write=True)
+        try:
+            for entry in entries:
+                name, timestamp = self.priority(entry)
+                # key sorted by class, from the most recent to the oldest, then in file order
+                key = struct.pack(">BQQ", CLASSES.index(name), 0xFFFFFFFFFFFFFFFF - max(0, int(timestamp)), sequence)
+                txn.put(key, json.dumps(entry).encode("UTF-8"))
+                counts[name] += 1
+                sequence += 1
+                if sequence % 10000 == 0:
+                    txn.commit()
+                    txn = env.begin(write=True)
+            txn.commit()
+        except BaseException:
+            txn.abort()
+            raise
+        for name in CLASSES:
+            metrics.inc("scheduled_entries", counts[name], priority=name)
+        return counts
+
+    def _iter_scheduled(self, env, counts):
+        # stride scheduling: the next entry is taken from the non-empty class with the smallest
+        # pass, which is then increased by the inverse of the class weight
+        passes = {}
+        for name in CLASSES:
+            if counts[name] > 0 and self.weights.get(name, 0) > 0:
+                passes[name] = 0.0
+        for name in CLASSES:
+            if counts[name] > 0 and name not in passes:
+                logging.warning(str(counts[name]) + " " + name + " entries not harvested, as the weight of the class is 0")
+
+        with env.begin() as txn:
+            cursors = {}
+            for name in passes:
+                cursor = txn.cursor()
+                cursor.set_range(struct.pack(">B", CLASSES.index(name)))
+                cursors[name] = cursor
+            while len(passes) > 0:
+                name = min(passes, key=lambda class_name: (passes[class_name], CLASSES.index(class_name)))
+                cursor = cursors[name]
+                key = cursor.key()
+                if len(key) == 0 or key[0] != CLASSES.index(name):
+                    # no more entries in this class
+                    del passes[name]
+                    continue
+                entry = json.loads(cursor.value().decode("UTF-8"))
+                cursor.next()
+                passes[name] += 1.0 / self.weights[name]
+                yield entry
+
+def _latest_version_time(entry):
+    '''
+    Timestamp of the latest version of an entry, from the version dates of the metadata, or the
+    update date, or the year and month of a new-style arXiv identifier. 0 if not available.
+    '''
+    dates = entry.get("versions_dates")
+    if dates is None and "versions" in entry and len(entry["versions"]) > 0 and isinstance(entry["versions"][-1], dict):
+        # Kaggle metadata format
+        dates = [ version.get("created") for version in entry["versions"] ]
+    if dates is not None and len(dates) > 0 and dates[-1] is not None:
+        try:
+            return email.utils.parsedate_to_datetime(dates[-1]).timestamp()
+        except (TypeError, ValueError):
+            pass
+    if entry.get("update_date") is not None:
+        try:
+            return calendar.timegm(time.strptime(entry["update_date"], "%Y-%m-%d"))
+        except ValueError:
+            pass
+    match = re.match(r"^(\d\d)(\d\d)\.\d+", entry.get("id", ""))
+    if match is not None:
+        return calendar.timegm((2000 + int(match.group(1)), int(match.group(2)), 1, 0, 0, 0))
+    return 0
+
+def _get_categories(entry):
+    categories = entry.get("categories", [])
+    if isinstance(categories, str):
+        # Kaggle metadata format, space separated
+        categories = categories.split()
+    return categories
+
+def _get_pages(entry):
+    comments = entry.get("comments")
+    if comments is None:
+        return None
+    match = _PAGES.search(comments)
+    if match is None:
+        return None
+    return int(match.group(1))
@@ -0,0 +1,118 @@
+"""
+Byte-range index over the arXiv source archives.
+
+An arXiv_src_*.tar archive is an uncompressed tar file, so every member is stored as a contiguous
+range of bytes in the archive. The index records for each member its archive, offset and size,
+so that the source of a given paper can be fetched with a single ranged GET instead of
+downloading the whole archive.
+
+The index is either built during a normal harvest, from the members of the processed archives,
+or from a header-only scan of an archive on S3, reading only the tar headers with small ranged
+GETs.
+"""
+
+import io
+import os
+import tarfile
+
+# logging
+import logging
+import logging.handlers
+
+# size of the ranged GETs used to read tar headers during a scan
+SCAN_BLOCK_SIZE = 16 * 1024
+
+class RangedReader(io.RawIOBase):
+    """
+    Seekable read-only file object over a S3 object, reading it by ranged GETs of block_size bytes.
+    Only the blocks actually read are fetched, so that tarfile can walk the headers of an archive
+    without transferring the content of its members.
+    """
+
+    def __init__(self, s3, file_path, size, block_size=SCAN_BLOCK_SIZE):
+        self.s3 = s3
+        self.file_path = file_path
+        self.size = size
+        self.block_size = block_size
+        self.position = 0
+        self.bytes_fetched = 0
+        self._block_start = None
+        self._block = b""
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        return self.position
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = self.size - self.position
+        n = min(n, self.size - self.position)
+        if n <= 0:
+            return b""
+
+        if self._block_start is None or self.position < self._block_start or self.position + n > self._block_start + len(self._block):
+            # fetch a new block starting at the current position, large enough for the request
+            end = min(self.size, self.position + max(n, self.block_size)) - 1
+            block = self.s3.get_object_range(self.file_path, self.position, end)
+            if block is None:
+                raise IOError("ranged GET failed for " + self.file_path)
+            self.bytes_fetched += len(block)
+            self._block_start = self.position
+            self._block = block
+
+        start = self.position - self._block_start
+        data = self._block[start:start + n]
+        self.position += len(data)
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+def scan_archive(s3, file, block_size=SCAN_BLOCK_SIZE):
+    '''
+    Read only the tar headers of a source archive on S3 and return the list of its members as
+    tarfile.TarInfo, with offset_data and size giving their byte range in the archive
+    '''
+    size = s3.get_object_size(file)
+    if size is None:
+        return None
+    reader = RangedReader(s3, file, size, block_size=block_size)
+    with tarfile.open(fileobj=reader, mode="r:") as tar:
+        members = tar.getmembers()
+    logging.debug("scanned " + file + ", " + str(len(members)) + " members, " + str(reader.bytes_fetched) + " bytes fetched")
+    return members
+
+def member_locations(file, members):
+    '''
+    Return the list of (source identifier, location) for the source members (gzip or PDF files) of
+    an archive, the location being a dict with the archive, the member name, and the offset and
+    size of the member content in the archive
+    '''
+    locations = []
+    for member in members:
+        if not member.isfile() or not (member.name.endswith(".gz") or member.name.endswith(".pdf")):
+            continue
+        identifier = os.path.splitext(os.path.basename(member.name))[0]
+        location = {}
+        location['archive'] = file
+        location['member'] = member.name
+        location['offset'] = member.offset_data
+        location['size'] = member.size
+        locations.append((identifier, location))
+    return locations
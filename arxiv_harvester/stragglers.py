@@ -0,0 +1,292 @@
+"""
+Protection of the harvesting against straggler downloads.
+
+- Every entry is processed under a deadline ("entry_timeout" seconds). A watchdog thread cancels
+  the entries which exceed it: the cancellation is checked between the steps of the entry and
+  between the chunks of a download, and the sockets of the registered HTTP responses are shut
+  down, so that a read blocked on a hung connection returns immediately.
+
+- A download which is still running after the p95 of the download latencies observed so far is
+  hedged: a duplicate request is started, and the first of the two to finish is kept, the other
+  one being cancelled. The number of hedged requests is capped by a budget (a ratio of the
+  requests and a maximum of concurrent hedges), so that hedging cannot double the load when the
+  whole server is slow.
+"""
+
+import time
+import socket
+import threading
+
+# metrics of the harvesting stages
+from arxiv_harvester.metrics import metrics
+
+# logging
+import logging
+import logging.handlers
+
+class Cancelled(Exception):
+    """
+    Raised in an operation which was cancelled from another thread
+    """
+    pass
+
+class Cancellation(object):
+    """
+    Cancellation token of an operation, checked by the operation itself and triggered from any
+    thread. Cancelling a token also cancels its children tokens and calls the registered
+    interrupt functions, e.g. to unblock a pending network read.
+    """
+
+    def __init__(self, parent=None):
+        self.reason = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._interrupts = []
+        self._children = []
+        if parent is not None:
+            parent._add_child(self)
+
+    def _add_child(self, child):
+        with self._lock:
+            if not self._event.is_set():
+                self._children.append(child)
+                return
+        child.cancel(self.reason)
+
+    def cancel(self, reason="cancelled"):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            interrupts = self._interrupts
+            self._interrupts = []
+            children = self._children
+            self._children = []
+        for interrupt in interrupts:
+            try:
+                interrupt()
+            except Exception:
+                logging.debug("interrupt of a cancelled operation failed", exc_info=True)
+        for child in children:
+            child.cancel(reason)
+
+    def cancelled(self):
+        return self._event.is_set()
+
+    def check(self):
+        if self._event.is_set():
+            raise Cancelled(self.reason)
+
+    def register(self, interrupt):
+        '''
+        Register a function called if the operation is cancelled, called immediately if already cancelled
+        '''
+        with self._lock:
+            if not self._event.is_set():
+                self._interrupts.append(interrupt)
+                return
+        interrupt()
+
+    def unregister(self, interrupt):
+        with self._lock:
+            if interrupt in self._interrupts:
+                self._interrupts.remove(interrupt)
+
+class Deadline(Cancellation):
+    """
+    Cancellation token of an operation which must be finished before a given time
+    """
+
+    def __init__(self, name, timeout):
+        Cancellation.__init__(self)
+        self.name = name
+        self.timeout = timeout
+        self.expires = time.time() + timeout
+
+class DeadlineWatchdog(object):
+    """
+    Background thread cancelling the tracked operations when their deadline is exceeded
+    """
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._deadlines = set()
+        self._thread = None
+
+    def track(self, name, timeout):
+        '''
+        Return a new Deadline for an operation starting now, or None if timeout is not set
+        '''
+        if timeout is None or timeout <= 0:
+            return None
+        deadline = Deadline(name, timeout)
+        with self._lock:
+            self._deadlines.add(deadline)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._watch, name="deadline-watchdog", daemon=True)
+                self._thread.start()
+        return deadline
+
+    def untrack(self, deadline):
+        if deadline is None:
+            return
+        with self._lock:
+            self._deadlines.discard(deadline)
+
+    def _watch(self):
+        while True:
+            time.sleep(self.interval)
+            now = time.time()
+            with self._lock:
+                expired = [ deadline for deadline in self._deadlines if deadline.expires <= now ]
+                for deadline in expired:
+                    self._deadlines.discard(deadline)
+            for deadline in expired:
+                logging.warning(deadline.name + " exceeded its deadline of " + str(deadline.timeout) + "s, cancelling")
+                metrics.inc("deadlines_exceeded")
+                deadline.cancel("deadline of " + str(deadline.timeout) + "s exceeded")
+
+class HedgeBudget(object):
+    """
+    Cap of the hedged requests: at most ratio hedges per request (e.g. 0.05 for 5% of additional
+    requests), and at most max_in_flight hedges at the same time
+    """
+
+    def __init__(self, ratio=0.05, max_in_flight=4):
+        self.ratio = ratio
+        self.max_in_flight = max_in_flight
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.hedges = 0
+        self.in_flight = 0
+
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def acquire(self):
+        '''
+        Return True if a new hedge can be started, to be released once finished
+        '''
+        with self._lock:
+            if self.in_flight >= self.max_in_flight or self.hedges + 1 > self.ratio * self.requests:
+                return False
+            self.hedges += 1
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+def hedged_call(func, delay, budget, parent=None, name="request"):
+    '''
+    Call func(attempt, cancellation) in the current thread (attempt 0) and, if it is still running
+    after delay seconds and the budget allows it, a second time concurrently in a new thread
+    (attempt 1). Return (attempt, result) for the first attempt which returns, the other attempt
+    being cancelled. An attempt which raises an exception does not win: the exception is raised
+    only if the other attempt fails too, or was not started.
+
+    The cancellation given to func is cancelled when the other attempt wins, or when the parent
+    cancellation (e.g. the deadline of the entry) is cancelled. As both attempts can return at
+    the same time, the caller must discard the result of the losing attempt.
+    '''
+    budget.record_request()
+    return _HedgedCall(func, budget, parent, name).run(delay)
+
+class _HedgedCall(object):
+
+    def __init__(self, func, budget, parent, name):
+        self.func = func
+        self.budget = budget
+        self.name = name
+        self.primary = Cancellation(parent)
+        self.hedge = Cancellation(parent)
+        self._lock = threading.Lock()
+        # attempt of the first result, None while running
+        self.winner = None
+        self.primary_finished = False
+        self.hedge_started = False
+        self.hedge_done = threading.Event()
+        self.hedge_result = None
+        self.hedge_error = None
+
+    def run(self, delay):
+        timer = threading.Timer(delay, self._start_hedge)
+        timer.daemon = True
+        timer.start()
+        try:
+            result = self.func(0, self.primary)
+        except BaseException:
+            timer.cancel()
+            with self._lock:
+                self.primary_finished = True
+                hedge_started = self.hedge_started
+            if hedge_started:
+                self.hedge_done.wait()
+                if self.winner == 1:
+                    return 1, self.hedge_result
+            raise
+
+        timer.cancel()
+        with self._lock:
+            self.primary_finished = True
+            if self.winner is None:
+                self.winner = 0
+            hedge_started = self.hedge_started
+        if self.winner == 0:
+            if hedge_started:
+                metrics.inc("hedges", event="lost")
+                self.hedge.cancel(self.name + ": the first request finished first")
+            return 0, result
+        # the hedge finished first, at the same time as the first request
+        self.hedge_done.wait()
+        return 1, self.hedge_result
+
+    def _start_hedge(self):
+        with self._lock:
+            if self.primary_finished or self.primary.cancelled():
+                return
+            if not self.budget.acquire():
+                metrics.inc("hedges", event="denied")
+                return
+            self.hedge_started = True
+        metrics.inc("hedges", event="started")
+        threading.Thread(target=self._run_hedge, name="hedge", daemon=True).start()
+
+    def _run_hedge(self):
+        try:
+            result = self.func(1, self.hedge)
+        except BaseException as e:
+            self.hedge_error = e
+        else:
+            self.hedge_result = result
+            with self._lock:
+                if self.winner is None:
+                    self.winner = 1
+            if self.winner == 1:
+                metrics.inc("hedges", event="won")
+                self.primary.cancel(self.name + ": the hedged request finished first")
+        finally:
+            self.budget.release()
+            self.hedge_done.set()
+
+def interrupt_response(response):
+    '''
+    Interrupt a streamed requests response being read in another thread. Closing the response is
+    not enough, as a read blocked on the socket only returns at the read timeout, so the socket of
+    the connection is shut down.
+    '''
+    try:
+        connection = getattr(response.raw, "_connection", None)
+        sock = getattr(connection, "sock", None)
+        if sock is None:
+            # the connection gives up its socket when it is not kept alive, the socket is then only
+            # referenced by the file object of the http.client response
+            sock = response.raw._fp.fp.raw._sock
+        if sock is not None:
+            sock.shutdown(socket.SHUT_RDWR)
+    except (OSError, AttributeError):
+        pass
@@ -1,47 +1,60 @@
 import os
+import json
+import time
 import shutil
+import hashlib
+import threading
+
+# parallel listing by partitions
+import arxiv_harvester.listing as listing
+
+# upload queue processed by batches
+from arxiv_harvester.batching import BatchQueue
+
+# metrics of the harvesting stages
+from arxiv_harvester.metrics import metrics
+
+# bandwidth limits shared by the harvesting processes
+from arxiv_harvester import bandwidth
 
 # support for SWIFT object storage
 from swiftclient.multithreading import OutputManager
-from swiftclient.service import SwiftError, SwiftService, SwiftUploadObject
+from swiftclient.service import SwiftError, SwiftService, SwiftUploadObject, get_conn
 
 # logging
 import logging
 import logging.handlers
-logging.basicConfig(filename='harvester.log', filemode='w', level=logging.DEBUG)
 
 class Swift(object):
     
     def __init__(self, config):
         self.config = config
 
-        options = self._init_swift_options()
-        options['object_uu_threads'] = 20
-        self.swift = SwiftService(options=options)
-        container_names = []
-        try:
-            list_account_part = self.swift.list()
-            for page in list_account_part:
-                if page["success"]:
-                    for item in page["listing"]:
-                        i_name = item["name"]
-                        container_names.append(i_name)
-                        if i_name == self.config["swift_container"]:
-                            print("using SWIFT", self.config["swift_container"], "container:", item)
-                else:
-                    logging.error("error listing SWIFT object storage containers")
+        # the auth token is shared by the connections of all the threads, and between the processes
+        # using the same account through a cache file under data_path, so that every connection
+        # does not authenticate by itself
+        self.token_cache = self.config.get("swift_token_cache", True) and "os_auth_token" not in self.config["swift"]
+        self.token_ttl = self.config.get("swift_token_ttl", 1800)
+        self._token = None
+        if self.token_cache:
+            self._token = _read_token_cache(self._token_cache_path(), self._account_key(), self.token_ttl)
+        self.swift = SwiftService(options=self._service_options(self._token))
 
-        except SwiftError as e:
-            logging.exception("error listing containers")
+        # no request is made before the first upload, where the container is checked (and created 
+        # if missing)
+        self._container_checked = False
+        self._container_lock = threading.Lock()
 
-        if self.config["swift_container"] not in container_names: 
-            # create the container
-            try:
-                self.swift.post(container=self.config["swift_container"])
-            except SwiftError:
-                logging.exception("error creating SWIFT object storage container " + self.config["swift_container"])
-        else:
-            logging.debug("container already exists on SWIFT object storage: " + self.config["swift_container"])
+        # objects larger than the segment size are uploaded as segmented objects (static large objects)
+        self.segment_size = self.config.get("swift_segment_size", 1024 * 1024 * 1024)
+        self.max_attempts = self.config.get("swift_upload_max_attempts", 3)
+
+        # background upload queue, a queue item is a group of files uploaded together, typically
+        # the resources of one entry
+        self._queue = BatchQueue(self._upload_batch, 
+                                 max_items=self.config.get("swift_batch_size", 100), 
+                                 max_delay=self.config.get("swift_batch_max_delay", 10), 
+                                 name="swift-upload")
 
     def _init_swift_options(self):
         options = {}
@@ -50,9 +63,84 @@ class Swift(object):
                 options[key] = self.config["swift"][key]
         return options
 
+    def _service_options(self, token=None):
+        options = self._init_swift_options()
+        options['object_uu_threads'] = 20
+        if token is not None:
+            options['os_storage_url'] = token["storage_url"]
+            options['os_auth_token'] = token["token"]
+        return options
+
+    def _authenticate(self):
+        """
+        Get a new token for the account, cache it and replace the client by one using it
+        """
+        try:
+            service = SwiftService(options=self._service_options())
+            storage_url, token = get_conn(service._options).get_auth()
+        except Exception:
+            logging.exception("SWIFT authentication failed, the client will authenticate by itself")
+            return
+        self._token = { "storage_url": storage_url, "token": token }
+        _write_token_cache(self._token_cache_path(), self._account_key(), self._token)
+        self.swift = SwiftService(options=self._service_options(self._token))
+
+    def _token_cache_path(self):
+        return os.path.join(self.config["data_path"], "swift_token.json")
+
+    def _account_key(self):
+        # the cached token is only used for the same auth url, user and project
+        account = [ self.config["swift"].get(key, "") for key in ["os_auth_url", "os_username", "os_user_id", "os_project_name", "os_project_id", "os_tenant_name", "os_region_name"] ]
+        return hashlib.sha1("|".join(account).encode("UTF-8")).hexdigest()
+
+    def _reauthenticate(self):
+        # the cached token was rejected, typically expired before the end of its ttl
+        if self.token_cache:
+            logging.warning("SWIFT token rejected, authenticating again")
+            self._authenticate()
+
+    def _ensure_container(self):
+        """
+        Check that the container exists, and create it if missing, once before the first upload.
+        Only the container is checked, the other containers of the account are not listed.
+        """
+        if self._container_checked:
+            return
+        with self._container_lock:
+            if self._container_checked:
+                return
+            if self.token_cache and self._token is None:
+                self._authenticate()
+            container = self.config["swift_container"]
+            try:
+                result = self.swift.stat(container=container)
+                if not result['success']:
+                    logging.error("error accessing SWIFT object storage container " + container + ": " + str(result['error']))
+                    if _is_unauthorized(result['error']):
+                        self._reauthenticate()
+                    return
+                logging.debug("container already exists on SWIFT object storage: " + container)
+            except SwiftError as e:
+                # raised by stat for a missing container, but also for other request failures
+                http_status = getattr(e.exception, "http_status", None)
+                if http_status == 401:
+                    logging.error("error accessing SWIFT object storage container " + container + ": " + str(e))
+                    self._reauthenticate()
+                    return
+                if http_status != 404:
+                    logging.error("error accessing SWIFT object storage container " + container + ": " + str(e))
+                    return
+                # not found, create the container
+                try:
+                    self.swift.post(container=container)
+                except SwiftError:
+                    logging.exception("error creating SWIFT object storage container " + container)
+                    return
+            self._container_checked = True
+
     def upload_file_to_swift(self, file_path, dest_path=None):
         """
-        Upload the given file to current SWIFT object storage container
+        Upload the given file to current SWIFT object storage container, return True if the upload succeeded
         """
         objs = []
 
@@ -64,6 +152,37 @@ class Swift(object):
             
         obj = SwiftUploadObject(file_path, object_name=object_name)
         objs.append(obj)
+        self._ensure_container()
+        # SwiftService does not report the progress of the transfers, the bytes are accounted before
+        bandwidth.throttle("egress", _file_size(file_path))
+        success = False
+        try:
+            for result in self.swift.upload(self.config["swift_container"], objs):
+                if not result['success']:
+                    error = result['error']
+                    if result['action'] == "upload_object":
+                        logging.error("Failed to upload object %s to container %s: %s" % (self.config["swift_container"], result['object'], error))
+                    else:
+                        logging.error("%s" % error)
+                elif result['action'] == "upload_object":
+                    success = True
+        except SwiftError:
+            logging.exception("error uploading file to SWIFT container")
+        return success
+
+    def upload_fileobj_to_swift(self, fileobj, file_name, dest_path=None):
+        """
+        Upload the content of a file object to current SWIFT object storage container under the given file name, 
+        return True if the upload succeeded
+        """
+        object_name = file_name
+        if dest_path != None:
+            object_name = dest_path + "/" + file_name
+
+        objs = [ SwiftUploadObject(fileobj, object_name=object_name) ]
+        success = False
+        self._ensure_container()
+        bandwidth.throttle("egress", _fileobj_size(fileobj))
         try:
             for result in self.swift.upload(self.config["swift_container"], objs):
                 if not result['success']:
@@ -72,8 +191,11 @@ class Swift(object):
                         logging.error("Failed to upload object %s to container %s: %s" % (self.config["swift_container"], result['object'], error))
                     else:
                         logging.error("%s" % error)
+                elif result['action'] == "upload_object":
+                    success = True
         except SwiftError:
             logging.exception("error uploading file to SWIFT container")
+        return success
 
     def upload_files_to_swift(self, file_paths, dest_path=None):
         """
@@ -91,6 +213,8 @@ class Swift(object):
             obj = SwiftUploadObject(file_path, object_name=object_name)
             objs.append(obj)
 
+        self._ensure_container()
+        bandwidth.throttle("egress", sum(_file_size(file_path) for file_path in file_paths))
         try:
             for result in self.swift.upload(self.config["swift_container"], objs):
                 if not result['success']:
@@ -102,6 +226,103 @@ class Swift(object):
         except SwiftError:
             logging.exception("error uploading file to SWIFT container")
 
+    def add_files(self, file_paths, dest_path=None, callback=None, clean=False):
+        """
+        Add a group of files to the background upload queue, to be uploaded under the same 
+        destination path. Groups from all the threads are submitted together by batches to 
+        SwiftService, which uploads the objects concurrently.
+
+        callback, if not None, is called with True once all the files of the group are confirmed
+        uploaded, or with False if one of them definitely failed. If clean is True, the local files 
+        are removed after a successful upload.
+        """
+        objects = []
+        for file_path in file_paths:
+            file_name = os.path.basename(file_path)
+            object_name = file_name
+            if dest_path != None:
+                object_name = dest_path + "/" + file_name
+            objects.append((file_path, object_name))
+        self._queue.add((objects, callback, clean))
+
+    def flush(self):
+        """
+        Upload all the queued files and wait until all pending uploads are done
+        """
+        self._queue.flush()
+
+    def close(self):
+        self._queue.close()
+
+    def _upload_batch(self, batch):
+        # status of each object of the batch, by object name
+        status = {}
+        file_paths = {}
+        for objects, callback, clean in batch:
+            for file_path, object_name in objects:
+                status[object_name] = False
+                file_paths[object_name] = file_path
+
+        options = {"segment_size": self.segment_size, "use_slo": True}
+        start_time = time.time()
+        self._ensure_container()
+
+        attempt = 0
+        to_upload = list(status.keys())
+        while len(to_upload) > 0 and attempt < self.max_attempts:
+            attempt += 1
+            objs = []
+            for object_name in to_upload:
+                objs.append(SwiftUploadObject(file_paths[object_name], object_name=object_name))
+            bandwidth.throttle("egress", sum(_file_size(file_paths[object_name]) for object_name in to_upload))
+            unauthorized = False
+            try:
+                for result in self.swift.upload(self.config["swift_container"], objs, options=options):
+                    if not result['success'] and _is_unauthorized(result['error']):
+                        unauthorized = True
+                    if result['action'] != "upload_object":
+                        if not result['success']:
+                            logging.error("%s" % result['error'])
+                        continue
+                    if result['success']:
+                        status[result['object']] = True
+                    else:
+                        logging.error("Failed to upload object %s to container %s: %s" % (result['object'], self.config["swift_container"], result['error']))
+            except SwiftError:
+                logging.exception("error uploading files to SWIFT container")
+            if unauthorized:
+                self._reauthenticate()
+            to_upload = [object_name for object_name in to_upload if not status[object_name]]
+
+        if len(to_upload) > 0:
+            logging.error(str(len(to_upload)) + " objects not uploaded to SWIFT container after " + str(self.max_attempts) + " attempts")
+
+        nb_bytes = 0
+        for object_name in status:
+            if status[object_name] and os.path.isfile(file_paths[object_name]):
+                nb_bytes += os.path.getsize(file_paths[object_name])
+        metrics.observe_stage("upload_batch", time.time() - start_time, nb_bytes=nb_bytes, error=(len(to_upload) > 0), backend="swift")
+        metrics.inc("uploaded_objects", len(status) - len(to_upload), backend="swift")
+        metrics.inc("upload_attempts", attempt, backend="swift")
+
+        for objects, callback, clean in batch:
+            success = True
+            for file_path, object_name in objects:
+                if not status[object_name]:
+                    success = False
+            if success and clean:
+                for file_path, object_name in objects:
+                    try:
+                        if os.path.isfile(file_path):
+                            os.remove(file_path)
+                    except IOError:
+                        logging.exception("temporary file cleaning failed")
+            if callback is not None:
+                try:
+                    callback(success)
+                except Exception:
+                    logging.exception("SWIFT upload callback failed")
+
     def download_file(self, file_path, dest_path):
         """
         Download a file given a path and returns the download destination file path.
@@ -114,6 +335,8 @@ class Swift(object):
                     local_path = down_res['path']
                     #print(local_path)
                     shutil.move(local_path, dest_path)
+                    # accounted once downloaded, the next transfers wait if the limit is exceeded
+                    bandwidth.throttle("ingress", _file_size(dest_path))
                 else:
                     logging.error("'%s' download failed" % down_res['object'])
         except SwiftError:
@@ -121,24 +344,66 @@ class Swift(object):
 
     def get_swift_list(self, dir_name=None):
         """
-        Return all contents of a given dir in SWIFT object storage.
-        Goes through the pagination to obtain all file names.
-
-        afaik, this is terribly inefficient, as we have to go through all the objects of the storage.
+        Return the names of all the contents of a given dir in SWIFT object storage.
+        The dir is used as server-side prefix, so only the relevant objects are listed. For large 
+        containers, prefer the generator iter_swift_list() which lists partitions in parallel.
         """
         result = []
+        for name, size, etag in self.iter_objects(dir_name):
+            result.append(name)
+        return result
+
+    def iter_swift_list(self, prefixes=None, nb_threads=16):
+        """
+        Iterate over the objects of the container, yielding (full name, size, etag).
+        The listing is partitioned by the given prefixes (e.g. ["arxiv/1501/", "arxiv/1502/"]), which 
+        are listed in parallel. By default, the partitions are the collection/YYMM prefixes present in 
+        the container.
+        """
+        if prefixes is None:
+            prefixes = listing.list_partitions(self)
+        return listing.iter_parallel(self, prefixes, nb_threads=nb_threads)
+
+    def list_dirs(self, dir_name=None):
+        """
+        Return the sub-directories directly under a given dir in SWIFT object storage, using 
+        server-side prefix and delimiter, e.g. "arxiv/" -> ["arxiv/0704/", "arxiv/0705/", ...]
+        """
+        options = {"delimiter": "/"}
+        if dir_name != None and len(dir_name) > 0:
+            options["prefix"] = dir_name
+        dirs = []
         try:
-            list_parts_gen = self.swift.list(container=self.config["swift_container"])
+            list_parts_gen = self.swift.list(container=self.config["swift_container"], options=options)
             for page in list_parts_gen:
                 if page["success"]:
                     for item in page["listing"]:
-                        if dir_name == None or item["name"].startswith(dir_name):
-                            result.append(item["name"])    
+                        if "subdir" in item:
+                            dirs.append(item["subdir"])
                 else:
                     logging.error(page["error"])
         except SwiftError as e:
-            logger.error(e.value)
-        return result
+            logging.exception("error listing SWIFT container")
+        return dirs
+
+    def iter_objects(self, dir_name=None):
+        """
+        Iterate over all the objects under a given dir in SWIFT object storage, yielding (full name, size, etag)
+        """
+        options = {}
+        if dir_name != None and len(dir_name) > 0:
+            options["prefix"] = dir_name
+        try:
+            list_parts_gen = self.swift.list(container=self.config["swift_container"], options=options)
+            for page in list_parts_gen:
+                if page["success"]:
+                    for item in page["listing"]:
+                        if "name" in item:
+                            yield item["name"], item["bytes"], item.get("hash")
+                else:
+                    logging.error(page["error"])
+        except SwiftError as e:
+            logging.exception("error listing SWIFT container")
 
     def remove_file(self, file_path):
         """
@@ -176,3 +441,49 @@ class Swift(object):
                                 logging.error("%s" % error)
         except SwiftError:
             logging.exception("error removing all files from SWIFT container")
+
+def _file_size(file_path):
+    try:
+        return os.path.getsize(file_path)
+    except OSError:
+        return 0
+
+def _fileobj_size(fileobj):
+    # remaining bytes of a seekable file object, 0 if unknown
+    try:
+        position = fileobj.tell()
+        size = fileobj.seek(0, os.SEEK_END) - position
+        fileobj.seek(position)
+        return size
+    except (AttributeError, OSError, ValueError):
+        return 0
+
+def _is_unauthorized(error):
+    return getattr(error, "http_status", None) == 401
+
+def _read_token_cache(path, account_key, ttl):
+    '''
+    Return the cached storage url and token of the account, or None if missing or older than ttl seconds
+    '''
+    try:
+        with open(path, "r") as the_file:
+            cached = json.load(the_file)
+    except (IOError, OSError, ValueError):
+        return None
+    if cached.get("account") != account_key or cached.get("created", 0) + ttl < time.time():
+        return None
+    return cached
+
+def _write_token_cache(path, account_key, cached):
+    # written to a temporary file readable only by the user, then renamed, as other processes
+    # can read the cache at any time
+    cached['account'] = account_key
+    cached['created'] = time.time()
+    tmp_path = path + "." + str(os.getpid()) + ".tmp"
+    try:
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as the_file:
+            json.dump(cached, the_file)
+        os.replace(tmp_path, path)
+    except (IOError, OSError):
+        logging.exception("Could not write SWIFT token cache " + path)
@@ -0,0 +1,187 @@
+"""
+In-memory conversion of arXiv source archive members into zip archives.
+
+A member of an arXiv_src_*.tar archive is a gzip file, which is either:
+- a tar.gz archive with the LaTeX sources and other files of the paper,
+- a single gzipped LaTeX file (starting normally with \\documentclass or \\documentstyle),
+- a withdrawn paper (starting with %auto-ignore).
+
+The member is converted into a zip archive written in a spooled buffer (in memory up to a given
+size, then in a temporary file), without extracting anything on the file system.
+"""
+
+import os
+import time
+import shutil
+import gzip
+import zlib
+import tarfile
+import tempfile
+from zipfile import ZipFile, ZIP_DEFLATED
+
+# logging
+import logging
+import logging.handlers
+
+# default max size of buffers kept in memory before spilling to a temporary file
+SPOOL_MAX_SIZE = 64 * 1024 * 1024
+
+def sniff_source(head):
+    '''
+    Return the type of a source member given the beginning of its decompressed content:
+    "withdrawn", "tex" or None if undecided (likely a tar archive)
+    '''
+    first_line = head.split(b"\n", 1)[0].strip()
+    if first_line.startswith(b"%auto-ignore"):
+        return "withdrawn"
+    elif first_line.startswith(b"\\document"):
+        return "tex"
+    return None
+
+def detect_source_type(data):
+    '''
+    Return the type of the original content of a source archive member, given as bytes, without
+    decompressing more than its beginning: "tar.gz", "tex", "withdrawn", "pdf" or None if unknown
+    '''
+    if data.startswith(b"%PDF"):
+        return "pdf"
+    try:
+        head = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(data, 1024)
+    except zlib.error:
+        return None
+
+    kind = sniff_source(head)
+    if kind is not None:
+        return kind
+    try:
+        tarfile.TarInfo.frombuf(head[:tarfile.BLOCKSIZE], tarfile.ENCODING, "surrogateescape")
+        return "tar.gz"
+    except (tarfile.HeaderError, ValueError):
+        # as for the conversion, a gzip file which is not a tar archive is a single latex file
+        return "tex"
+
+def transcode_source(member_file, identifier, spool_max_size=SPOOL_MAX_SIZE):
+    '''
+    Convert the gzip content of a source member, read from the file object member_file, into a zip
+    archive.
+
+    Return (kind, buffer) where kind is "tar", "tex" or "withdrawn" and buffer is a file object
+    positioned at the beginning of the zip archive (None for withdrawn papers). The caller is in
+    charge of closing the buffer.
+    '''
+    # the member content is first copied into a seekable buffer, as the outer tar can be a stream
+    source = tempfile.SpooledTemporaryFile(max_size=spool_max_size)
+    try:
+        shutil.copyfileobj(member_file, source, 1024 * 1024)
+        return transcode_gzip(source, identifier, spool_max_size=spool_max_size)
+    finally:
+        source.close()
+
+def transcode_bytes(data, identifier, spool_max_size=SPOOL_MAX_SIZE):
+    '''
+    Same as transcode_source(), the gzip content of the source member being given as bytes
+    '''
+    source = tempfile.SpooledTemporaryFile(max_size=spool_max_size)
+    try:
+        source.write(data)
+        return transcode_gzip(source, identifier, spool_max_size=spool_max_size)
+    finally:
+        source.close()
+
+def transcode_gzip(source, identifier, spool_max_size=SPOOL_MAX_SIZE):
+    '''
+    Convert the gzip content of a source member available in the seekable file object source
+    into a zip archive, see transcode_source()
+    '''
+    source.seek(0)
+    with gzip.GzipFile(fileobj=source, mode="rb") as gz:
+        head = gz.read(1024)
+
+    kind = sniff_source(head)
+    if kind == "withdrawn":
+        return kind, None
+
+    buffer = tempfile.SpooledTemporaryFile(max_size=spool_max_size)
+    try:
+        if kind is None:
+            # otherwise we have likely a gzip tar archive
+            source.seek(0)
+            try:
+                with tarfile.open(fileobj=source, mode="r:gz") as tar:
+                    with ZipFile(buffer, "w", ZIP_DEFLATED) as zip_file:
+                        _tar_to_zip(tar, zip_file)
+                kind = "tar"
+            except tarfile.TarError:
+                # ok it was single latex file too
+                buffer.seek(0)
+                buffer.truncate()
+                kind = "tex"
+
+        if kind == "tex":
+            # not tar, but gzip plain latex file to be zipped
+            source.seek(0)
+            with gzip.GzipFile(fileobj=source, mode="rb") as gz:
+                with ZipFile(buffer, "w", ZIP_DEFLATED) as zip_file:
+                    with zip_file.open(identifier + ".tex", "w") as f_out:
+                        shutil.copyfileobj(gz, f_out, 1024 * 1024)
+    except:
+        buffer.close()
+        raise
+
+    buffer.seek(0)
+    return kind, buffer
+
+def _tar_to_zip(tar, zip_file):
+    '''
+    Copy the regular files of a tar archive into a zip archive, directly from member to entry
+    '''
+    for member in tar:
+        if not member.isfile():
+            continue
+        name = _safe_member_name(member.name)
+        if name is None:
+            logging.debug("skipping unsafe tar member name: " + member.name)
+            continue
+        f_in = tar.extractfile(member)
+        if f_in is None:
+            continue
+        with zip_file.open(name, "w", force_zip64=(member.size > 0x7fffffff)) as f_out:
+            shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+
+def _safe_member_name(name):
+    '''
+    Normalize a tar member name as relative path, None if it points outside of the archive
+    '''
+    name = name.replace("\\", "/").lstrip("/")
+    while name.startswith("./"):
+        name = name[2:]
+    pieces = name.split("/")
+    if len(name) == 0 or ".." in pieces:
+        return None
+    return name
+
+def transcode_to_bytes(data, identifier, spool_max_size=SPOOL_MAX_SIZE):
+    '''
+    Same as transcode_bytes(), but returning the zip archive as bytes, so that the conversion
+    can be run in a worker process
+
+    Return (kind, zip content as bytes or None for withdrawn papers)
+    '''
+    kind, buffer = transcode_bytes(data, identifier, spool_max_size=spool_max_size)
+    if buffer is None:
+        return kind, None
+    try:
+        return kind, buffer.read()
+    finally:
+        buffer.close()
+
+def timed_transcode_to_bytes(data, identifier, spool_max_size=SPOOL_MAX_SIZE):
+    '''
+    Same as transcode_to_bytes(), also returning the conversion time in seconds measured in the
+    worker process, without the time waiting in the pool
+
+    Return (kind, zip content as bytes or None, seconds)
+    '''
+    start = time.time()
+    kind, content = transcode_to_bytes(data, identifier, spool_max_size=spool_max_size)
+    return kind, content, time.time() - start
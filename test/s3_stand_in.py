@@ -0,0 +1,76 @@
+"""
+Local stand-in of S3 for the tests: a moto server started once per test class, with a new bucket
+for every test
+"""
+
+import uuid
+import socket
+import threading
+import unittest
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def s3_config(port, bucket_name):
+    '''
+    Config of the S3 backend for a bucket of the moto server listening on the given port
+    '''
+    return {"region": "us-east-1", "bucket_name": bucket_name, "aws_access_key_id": "test",
+            "aws_secret_access_key": "test", "aws_end_point": "http://127.0.0.1:" + str(port)}
+
+def _serialized(app):
+    # moto checks the condition of a conditional write and then writes the object without lock, the
+    # requests are handled one at a time so that conditional writes are atomic as on S3
+    lock = threading.Lock()
+    def serialized_app(environ, start_response):
+        with lock:
+            return list(app(environ, start_response))
+    return serialized_app
+
+def start_server(port):
+    '''
+    Start a threaded moto server on the given port, return the server to be stopped with stop()
+    '''
+    from moto.server import ThreadedMotoServer, DomainDispatcherApplication, create_backend_app
+    from werkzeug.serving import make_server
+
+    class _Server(ThreadedMotoServer):
+
+        def _server_entry(self):
+            app = DomainDispatcherApplication(create_backend_app)
+            self._server = make_server(self._ip_address, self._port, _serialized(app), True)
+            self._server_ready_event.set()
+            self._server.serve_forever()
+
+    server = _Server(ip_address="127.0.0.1", port=port, verbose=False)
+    server.start()
+    return server
+
+class S3StandInTestCase(unittest.TestCase):
+    """
+    Test case with a moto server (port), and a new empty bucket for every test (bucket_name, s3)
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            import moto.server
+        except ImportError:
+            raise unittest.SkipTest("moto server not available")
+        cls.port = free_port()
+        cls.server = start_server(cls.port)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        from arxiv_harvester.S3 import S3
+        self.bucket_name = "test-" + uuid.uuid4().hex[:16]
+        self.s3 = S3(self.s3_config())
+        self.s3.conn.create_bucket(Bucket=self.bucket_name)
+
+    def s3_config(self):
+        return s3_config(self.port, self.bucket_name)
@@ -0,0 +1,52 @@
+"""
+Synthetic arXiv source archives for the tests: arXiv_src_*.tar archives of gzip members, a member
+being a tar.gz of the files of a paper or a single gzipped LaTeX file
+"""
+
+import io
+import gzip
+import tarfile
+
+def _add(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+def paper_member(identifier, nb_files=2):
+    '''
+    gzip tar archive of the LaTeX sources of a paper, as a source archive member
+    '''
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        _add(tar, "main.tex", b"\\documentclass{article}\n\\begin{document}\n" + identifier.encode() + b"\n\\end{document}\n")
+        for i in range(1, nb_files):
+            _add(tar, "section" + str(i) + ".tex", (identifier + " section " + str(i) + "\n").encode() * 20)
+    return buffer.getvalue()
+
+def tex_member(identifier):
+    '''
+    single gzipped LaTeX file, as a source archive member
+    '''
+    return gzip.compress(b"\\documentclass{article}\n" + identifier.encode() + b"\n")
+
+def source_archive(members):
+    '''
+    arXiv_src_*.tar archive content given the (member name, content) of its members, e.g.
+    ("2101/2101.00001.gz", paper_member("2101.00001"))
+    '''
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        for name, data in members:
+            _add(tar, name, data)
+    return buffer.getvalue()
+
+def monthly_archive(yymm, numbers):
+    '''
+    (member names, archive content) of a source archive of new style identifiers of a month,
+    e.g. monthly_archive("2101", [1, 2]) with the papers 2101.00001 and 2101.00002
+    '''
+    members = []
+    for number in numbers:
+        identifier = yymm + ".%05d" % number
+        members.append((yymm + "/" + identifier + ".gz", paper_member(identifier)))
+    return [ name for name, data in members ], source_archive(members)
@@ -0,0 +1,121 @@
+"""
+Bandwidth limits shared by the harvesting processes through a token bucket state file
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from arxiv_harvester import bandwidth
+from arxiv_harvester.bandwidth import BandwidthGovernor, _FileBucket
+
+class TestFileBucket(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fd = os.open(os.path.join(self.tmp_dir, "bandwidth.state"), os.O_RDWR | os.O_CREAT, 0o644)
+
+    def tearDown(self):
+        os.close(self.fd)
+        shutil.rmtree(self.tmp_dir)
+
+    def _consume(self, bucket, now, nb_bytes, rate=1000.0, burst=1000.0):
+        with mock.patch.object(bandwidth.time, "time", return_value=now):
+            return bucket.consume(nb_bytes, rate, burst)
+
+    def test_within_burst(self):
+        bucket = _FileBucket(self.fd, 0)
+        self.assertEqual(self._consume(bucket, 1000.0, 600), 0.0)
+        self.assertEqual(self._consume(bucket, 1000.0, 400), 0.0)
+        # empty bucket, refilled at the rate
+        self.assertAlmostEqual(self._consume(bucket, 1000.0, 100), 0.1)
+
+    def test_debt_larger_than_burst(self):
+        bucket = _FileBucket(self.fd, 0)
+        # a chunk of 3 bursts is admitted, with a wait for the 2000 bytes of debt
+        self.assertAlmostEqual(self._consume(bucket, 1000.0, 3000), 2.0)
+        # the debt is paid after 2 seconds
+        self.assertAlmostEqual(self._consume(bucket, 1001.0, 500), 1.5)
+        self.assertEqual(self._consume(bucket, 1003.5, 0), 0.0)
+
+    def test_refill_capped_by_burst(self):
+        bucket = _FileBucket(self.fd, 0)
+        self._consume(bucket, 1000.0, 1000)
+        # idle for a long time, only one burst is available
+        self.assertEqual(self._consume(bucket, 2000.0, 1000), 0.0)
+        self.assertAlmostEqual(self._consume(bucket, 2000.0, 500), 0.5)
+
+    def test_shared_state(self):
+        # two buckets over the same state, as in two processes, and a bucket of the other direction
+        bucket = _FileBucket(self.fd, 0)
+        other_process = _FileBucket(os.open(os.path.join(self.tmp_dir, "bandwidth.state"), os.O_RDWR), 0)
+        egress = _FileBucket(self.fd, 16)
+        try:
+            self.assertEqual(self._consume(bucket, 1000.0, 1000), 0.0)
+            self.assertAlmostEqual(self._consume(other_process, 1000.0, 1000), 1.0)
+            self.assertEqual(self._consume(egress, 1000.0, 1000), 0.0)
+        finally:
+            os.close(other_process.fd)
+
+class TestBandwidthGovernor(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.governor = BandwidthGovernor()
+
+    def tearDown(self):
+        if self.governor._fd is not None:
+            os.close(self.governor._fd)
+        shutil.rmtree(self.tmp_dir)
+
+    def _limit(self, direction, hour):
+        with mock.patch.object(bandwidth.time, "localtime", return_value=time.strptime(hour, "%H:%M")):
+            return self.governor.limit(direction)
+
+    def test_schedule_across_midnight(self):
+        self.governor.configure({"data_path": self.tmp_dir, "bandwidth_ingress": 1000, "bandwidth_egress": 2000,
+                                 "bandwidth_schedule": [{"from": "22:00", "to": "07:00", "ingress": 50000}]})
+        self.assertEqual(self._limit("ingress", "23:00"), 50000)
+        self.assertEqual(self._limit("ingress", "06:00"), 50000)
+        self.assertEqual(self._limit("ingress", "22:00"), 50000)
+        self.assertEqual(self._limit("ingress", "07:00"), 1000)
+        self.assertEqual(self._limit("ingress", "12:00"), 1000)
+        # the direction not given for the period keeps its limit
+        self.assertEqual(self._limit("egress", "23:00"), 2000)
+
+    def test_schedule_without_limit(self):
+        self.governor.configure({"data_path": self.tmp_dir, "bandwidth_ingress": 1000,
+                                 "bandwidth_schedule": [{"from": "08:00", "to": "18:00", "ingress": 500},
+                                                        {"from": "22:00", "to": "07:00", "ingress": None},
+                                                        {"from": "25:00"}]})
+        self.assertEqual(len(self.governor.schedule), 2)
+        self.assertEqual(self._limit("ingress", "09:30"), 500)
+        self.assertIsNone(self._limit("ingress", "23:00"))
+        self.assertEqual(self._limit("ingress", "20:00"), 1000)
+
+    def test_throttle(self):
+        self.governor.configure({"data_path": self.tmp_dir, "bandwidth_ingress": 1000})
+        self.assertEqual(self.governor.path, os.path.join(self.tmp_dir, "bandwidth.state"))
+        with mock.patch.object(bandwidth.time, "sleep") as sleep:
+            self.governor.throttle("ingress", 1000)
+            sleep.assert_not_called()
+            self.governor.throttle("ingress", 2000)
+            self.assertEqual(sleep.call_count, 1)
+            self.assertAlmostEqual(sleep.call_args.args[0], 2.0, delta=0.1)
+            # not limited
+            self.governor.throttle("egress", 10 ** 9)
+            self.assertEqual(sleep.call_count, 1)
+
+    def test_not_limited(self):
+        self.governor.configure({"data_path": self.tmp_dir})
+        self.assertIsNone(self.governor.path)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, "bandwidth.state")))
+        with mock.patch.object(bandwidth.time, "sleep") as sleep:
+            self.governor.throttle("ingress", 10 ** 9)
+        sleep.assert_not_called()
+
+if __name__ == '__main__':
+    unittest.main()
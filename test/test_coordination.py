@@ -0,0 +1,186 @@
+"""
+Lease-based coordination of several harvesting processes, against a local S3 stand-in (moto
+server) and a SQLite file
+"""
+
+import os
+import time
+import tempfile
+import unittest
+import multiprocessing
+
+from arxiv_harvester.coordination import Coordinator, S3LeaseStore, SQLiteLeaseStore
+
+from s3_stand_in import S3StandInTestCase, s3_config
+
+# the workers are forked, the stores are created in each process
+_context = multiprocessing.get_context("fork")
+
+LEASE_DURATION = 2
+
+def _make_store(spec):
+    kind, value = spec
+    if kind == "s3":
+        from arxiv_harvester.S3 import S3
+        port, bucket_name = value
+        return S3LeaseStore(S3(s3_config(port, bucket_name)), "coordination/")
+    return SQLiteLeaseStore(value)
+
+def _make_coordinator(spec, node_id, lease_duration=LEASE_DURATION):
+    config = {"node_id": node_id, "lease_duration": lease_duration, "lease_poll_interval": 0.2}
+    return Coordinator(config, _make_store(spec), "entries")
+
+def _harvest_worker(spec, node_id, units, results):
+    # process every unit leased by this node, recording which node processed it
+    coordinator = _make_coordinator(spec, node_id).start()
+    processed = []
+    try:
+        for unit in coordinator.iter_units(units):
+            time.sleep(0.01)
+            processed.append(unit)
+            coordinator.complete(unit, {"entries": [{"id": unit, "node": node_id}]})
+    finally:
+        coordinator.stop()
+    results.put((node_id, processed))
+
+def _race_worker(spec, node_id, unit, start, results):
+    coordinator = _make_coordinator(spec, node_id)
+    start.wait()
+    results.put((node_id, coordinator.acquire(unit)))
+
+def _crash_worker(spec, node_id, unit, acquired):
+    # take a lease and stop without releasing it, as a crashed or preempted node
+    coordinator = _make_coordinator(spec, node_id)
+    acquired.put(coordinator.acquire(unit))
+    acquired.close()
+    acquired.join_thread()
+    os._exit(0)
+
+class _LeaseStoreTests(object):
+    """
+    Tests shared by the lease stores, spec() giving the store description passed to the workers
+    """
+
+    def _run(self, target, args_list):
+        results = _context.Queue()
+        processes = [ _context.Process(target=target, args=args + (results,)) for args in args_list ]
+        for process in processes:
+            process.start()
+        outputs = [ results.get(timeout=120) for process in processes ]
+        for process in processes:
+            process.join(timeout=30)
+            self.assertEqual(process.exitcode, 0)
+        return outputs
+
+    def test_units_processed_once_by_competing_processes(self):
+        units = [ "shard-%06d" % i for i in range(30) ]
+        outputs = self._run(_harvest_worker, [ (self.spec(), "node-%d" % i, units) for i in range(4) ])
+
+        processed = [ unit for node_id, node_units in outputs for unit in node_units ]
+        self.assertEqual(sorted(processed), units)
+
+        coordinator = _make_coordinator(self.spec(), "observer")
+        for unit in units:
+            self.assertTrue(coordinator.is_done(unit))
+        self.assertEqual(coordinator.global_view()['units'], {"done": len(units)})
+        # the published states give the node of every unit
+        owners = dict((unit, node_id) for node_id, node_units in outputs for unit in node_units)
+        states = list(coordinator.iter_states())
+        self.assertEqual(len(states), len(units))
+        for unit, node_id, state in states:
+            self.assertEqual(owners[unit], node_id)
+            self.assertEqual(state['entries'][0]['node'], node_id)
+
+    def test_single_winner_of_concurrent_acquisitions(self):
+        for i in range(5):
+            unit = "race-%d" % i
+            start = _context.Event()
+            results = _context.Queue()
+            processes = [ _context.Process(target=_race_worker, args=(self.spec(), "node-%d" % n, unit, start, results)) for n in range(6) ]
+            for process in processes:
+                process.start()
+            start.set()
+            outputs = [ results.get(timeout=60) for process in processes ]
+            for process in processes:
+                process.join(timeout=30)
+            winners = [ node_id for node_id, acquired in outputs if acquired ]
+            self.assertEqual(len(winners), 1, unit + " acquired by " + str(winners))
+
+    def test_expired_lease_stolen(self):
+        unit = "shard-000000"
+        acquired = _context.Queue()
+        process = _context.Process(target=_crash_worker, args=(self.spec(), "crashed", unit, acquired))
+        process.start()
+        self.assertTrue(acquired.get(timeout=60))
+        process.join(timeout=30)
+
+        coordinator = _make_coordinator(self.spec(), "survivor")
+        # still leased by the crashed node
+        self.assertFalse(coordinator.acquire(unit))
+        self.assertEqual(coordinator.global_view()['nodes'], {"crashed": {"leased": 1}})
+
+        time.sleep(LEASE_DURATION + 0.5)
+        self.assertEqual(coordinator.global_view()['units'], {"expired": 1})
+        self.assertTrue(coordinator.acquire(unit))
+        record, version = coordinator.store.get(coordinator._key(unit))
+        self.assertEqual(record['owner'], "survivor")
+        self.assertEqual(record['status'], "leased")
+
+        self.assertTrue(coordinator.complete(unit, {"entries": []}))
+        self.assertTrue(coordinator.is_done(unit))
+        # a done unit cannot be leased again
+        self.assertFalse(_make_coordinator(self.spec(), "late").acquire(unit))
+
+    def test_renewed_lease_not_stolen(self):
+        unit = "shard-000001"
+        holder = _make_coordinator(self.spec(), "holder").start()
+        try:
+            self.assertTrue(holder.acquire(unit))
+            time.sleep(LEASE_DURATION * 1.5)
+            # renewed by the heartbeat of the holder
+            self.assertFalse(_make_coordinator(self.spec(), "other").acquire(unit))
+            self.assertTrue(holder.is_held(unit))
+        finally:
+            holder.stop()
+        # released when the holder stops, taken immediately by another node
+        self.assertTrue(_make_coordinator(self.spec(), "other").acquire(unit))
+
+    def test_lost_lease_detected_by_renewal(self):
+        unit = "shard-000002"
+        # the holder renews its leases too late, after their expiration
+        holder = _make_coordinator(self.spec(), "slow", lease_duration=LEASE_DURATION)
+        self.assertTrue(holder.acquire(unit))
+        time.sleep(LEASE_DURATION + 0.5)
+        self.assertTrue(_make_coordinator(self.spec(), "thief").acquire(unit))
+
+        holder.lease_duration = 0.3
+        holder.start()
+        try:
+            deadline = time.time() + 10
+            while holder.is_held(unit) and time.time() < deadline:
+                time.sleep(0.1)
+            self.assertFalse(holder.is_held(unit))
+        finally:
+            holder.stop()
+        record, version = holder.store.get(holder._key(unit))
+        self.assertEqual(record['owner'], "thief")
+
+class TestSQLiteLeaseStore(_LeaseStoreTests, unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "coordination.sqlite")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def spec(self):
+        return ("sqlite", self.path)
+
+class TestS3LeaseStore(_LeaseStoreTests, S3StandInTestCase):
+
+    def spec(self):
+        return ("s3", (self.port, self.bucket_name))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+"""
+Service mode of the PDF harvester: admission of the entries and control API
+"""
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import requests
+
+from arxiv_harvester.daemon import HarvestDaemon
+
+from s3_stand_in import free_port
+
+TIMEOUT = 5
+
+class _StubHarvester(object):
+    # harvester recording the harvested metadata files, without lmdb nor storage
+
+    def __init__(self):
+        self.gate = None
+        self.session = None
+        self.env = mock.Mock()
+        self.env_failures = mock.Mock()
+        self.harvested = []
+
+    def harvest(self, metadata_file):
+        self.harvested.append(metadata_file)
+
+    def _flush_storage(self):
+        pass
+
+class TestHarvestDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.data_path = tempfile.mkdtemp()
+        self.harvester = _StubHarvester()
+        self.port = free_port()
+        self.base_url = "http://127.0.0.1:" + str(self.port) + "/"
+        self.thread = None
+
+    def tearDown(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.daemon.drain()
+            self.thread.join(TIMEOUT)
+        shutil.rmtree(self.data_path)
+
+    def _start(self, **kwargs):
+        config = {"data_path": self.data_path, "daemon_port": self.port, "daemon_poll_interval": 0.05, "daemon_settle_seconds": 0}
+        config.update(kwargs)
+        self.daemon = HarvestDaemon(self.harvester, config)
+        self.thread = threading.Thread(target=self.daemon.run, daemon=True)
+        self.thread.start()
+        # wait for the control API
+        for i in range(int(TIMEOUT / 0.05)):
+            try:
+                return self._status()
+            except requests.exceptions.ConnectionError:
+                time.sleep(0.05)
+        self.fail("control API not started")
+
+    def _status(self):
+        response = requests.get(self.base_url + "status", timeout=TIMEOUT)
+        response.raise_for_status()
+        return response.json()
+
+    def _post(self, command):
+        response = requests.post(self.base_url + command, timeout=TIMEOUT)
+        response.raise_for_status()
+        return response.json()
+
+    def test_pause_and_drain(self):
+        self.assertEqual(self._start()['state'], "idle")
+        self.assertIs(self.harvester.gate, self.daemon.gate)
+        self.assertTrue(self.harvester.gate.admit())
+
+        self.assertEqual(self._post("pause")['state'], "paused")
+        self.assertEqual(self._status()['state'], "paused")
+        # an entry is not admitted while paused
+        admitted = []
+        admission = threading.Thread(target=lambda: admitted.append(self.harvester.gate.admit()), daemon=True)
+        admission.start()
+        admission.join(0.2)
+        self.assertTrue(admission.is_alive())
+
+        # drained, the waiting entry is refused and the daemon stops
+        self.assertEqual(self._post("drain")['state'], "draining")
+        admission.join(TIMEOUT)
+        self.assertEqual(admitted, [False])
+        self.assertFalse(self.harvester.gate.admit())
+        self.thread.join(TIMEOUT)
+        self.assertFalse(self.thread.is_alive())
+        self.harvester.env.sync.assert_called_once_with()
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self._status()
+
+    def test_resume(self):
+        self._start()
+        self._post("pause")
+        admitted = []
+        admission = threading.Thread(target=lambda: admitted.append(self.harvester.gate.admit()), daemon=True)
+        admission.start()
+        self.assertEqual(self._post("resume")['state'], "idle")
+        admission.join(TIMEOUT)
+        self.assertEqual(admitted, [True])
+
+    def test_unknown_command(self):
+        self._start()
+        response = requests.post(self.base_url + "restart", timeout=TIMEOUT)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(requests.get(self.base_url + "metrics", timeout=TIMEOUT).status_code, 404)
+
+    def test_harvest_of_watched_file(self):
+        metadata_file = os.path.join(self.data_path, "arxiv-metadata.json")
+        with open(metadata_file, "w") as the_file:
+            the_file.write(json.dumps({"id": "2101.00001", "versions": ["v1"]}) + "\n")
+        self._start(daemon_watch=metadata_file)
+        for i in range(int(TIMEOUT / 0.05)):
+            if self._status()['last'] is not None:
+                break
+            time.sleep(0.05)
+        status = self._status()
+        self.assertEqual(status['last']['metadata'], metadata_file)
+        self.assertEqual(status['last']['reason'], "new_metadata")
+        # harvested once, until the file changes or a harvest is requested
+        self._post("harvest")
+        for i in range(int(TIMEOUT / 0.05)):
+            if len(self.harvester.harvested) == 2:
+                break
+            time.sleep(0.05)
+        self.assertEqual(self.harvester.harvested, [metadata_file, metadata_file])
+        self.assertEqual(self._status()['last']['reason'], "requested")
+        with open(os.path.join(self.data_path, "daemon_state.json")) as the_file:
+            self.assertIn(os.path.abspath(metadata_file), json.load(the_file)['files'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+"""
+Batched commits of the HuggingFace storage, with a mocked HfApi
+"""
+
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from arxiv_harvester.hf import HuggingFace
+
+class FakeHfApi(object):
+    """
+    Record the commits, the first nb_failures ones raising an error
+    """
+
+    def __init__(self, nb_failures=0):
+        self.nb_failures = nb_failures
+        self.commits = []
+        self.attempts = 0
+        self._lock = threading.Lock()
+
+    def create_commit(self, repo_id, operations, commit_message, repo_type, token=None):
+        with self._lock:
+            self.attempts += 1
+            if self.attempts <= self.nb_failures:
+                raise IOError("Hub unavailable")
+            self.commits.append([ operation.path_in_repo for operation in operations ])
+
+class TestHuggingFaceBatching(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.callbacks = []
+        self._lock = threading.Lock()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _config(self, **kwargs):
+        config = {"hf_repo_id": "test/dataset", "HUGGINGFACE_TOKEN": "token", "hf_commit_max_files": 100,
+                  "hf_commit_max_delay": 300, "hf_commit_max_attempts": 3, "hf_commit_retry_delay": 1}
+        config.update(kwargs)
+        return config
+
+    def _files(self, n):
+        paths = []
+        for i in range(n):
+            path = os.path.join(self.tmp_dir.name, "file%d.pdf" % i)
+            with open(path, "wb") as the_file:
+                the_file.write(b"%PDF-1.5 " + str(i).encode())
+            paths.append(path)
+        return paths
+
+    def _callback(self, path):
+        def callback(success):
+            with self._lock:
+                self.callbacks.append((path, success))
+        return callback
+
+    def test_files_committed_together(self):
+        api = FakeHfApi()
+        hf = HuggingFace(self._config(), api=api)
+        paths = self._files(10)
+        for path in paths:
+            hf.add_file(path, "arxiv/0001", callback=self._callback(path), clean=True)
+        hf.close()
+
+        self.assertEqual(len(api.commits), 1)
+        self.assertEqual(sorted(api.commits[0]), sorted("arxiv/0001/" + os.path.basename(path) for path in paths))
+        self.assertEqual(sorted(self.callbacks), sorted((path, True) for path in paths))
+        # cleaned after the commit
+        for path in paths:
+            self.assertFalse(os.path.exists(path))
+
+    def test_batches_cut_at_max_files(self):
+        api = FakeHfApi()
+        hf = HuggingFace(self._config(hf_commit_max_files=4), api=api)
+        for path in self._files(10):
+            hf.add_file(path, callback=self._callback(path))
+        hf.close()
+
+        self.assertEqual([ len(commit) for commit in api.commits ], [4, 4, 2])
+        self.assertEqual(len(self.callbacks), 10)
+
+    def test_retry_with_backoff(self):
+        api = FakeHfApi(nb_failures=2)
+        hf = HuggingFace(self._config(), api=api)
+        paths = self._files(3)
+        with mock.patch("arxiv_harvester.hf.time.sleep") as sleep:
+            for path in paths:
+                hf.add_file(path, callback=self._callback(path))
+            hf.close()
+
+        self.assertEqual(api.attempts, 3)
+        self.assertEqual(len(api.commits), 1)
+        # exponential backoff between the attempts
+        self.assertEqual([ call.args[0] for call in sleep.call_args_list ], [1, 2])
+        self.assertEqual(sorted(self.callbacks), sorted((path, True) for path in paths))
+
+    def test_failure_callbacks(self):
+        api = FakeHfApi(nb_failures=100)
+        hf = HuggingFace(self._config(), api=api)
+        paths = self._files(3)
+        with mock.patch("arxiv_harvester.hf.time.sleep"):
+            for path in paths:
+                hf.add_file(path, callback=self._callback(path), clean=True)
+            hf.close()
+
+        self.assertEqual(api.attempts, 3)
+        self.assertEqual(len(api.commits), 0)
+        self.assertEqual(sorted(self.callbacks), sorted((path, False) for path in paths))
+        # kept locally for a later attempt
+        for path in paths:
+            self.assertTrue(os.path.exists(path))
+
+    def test_missing_file_reported_as_failed(self):
+        api = FakeHfApi()
+        hf = HuggingFace(self._config(), api=api)
+        paths = self._files(3)
+        for path in paths:
+            hf.add_file(path, "arxiv", callback=self._callback(path))
+        os.remove(paths[1])
+        hf.close()
+
+        self.assertEqual(len(api.commits), 1)
+        self.assertEqual(sorted(api.commits[0]), sorted("arxiv/" + os.path.basename(path) for path in [paths[0], paths[2]]))
+        self.assertEqual(sorted(self.callbacks), sorted([(paths[0], True), (paths[1], False), (paths[2], True)]))
+
+    def test_unexpected_error_calls_all_callbacks(self):
+        api = FakeHfApi()
+        hf = HuggingFace(self._config(), api=api)
+        paths = self._files(3)
+        with mock.patch("arxiv_harvester.hf.CommitOperationAdd", side_effect=ValueError("invalid operation")):
+            for path in paths:
+                hf.add_file(path, callback=self._callback(path))
+            hf.close()
+
+        self.assertEqual(len(api.commits), 0)
+        self.assertEqual(sorted(self.callbacks), sorted((path, False) for path in paths))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,248 @@
+"""
+Integrity validation of the downloaded content, and the recording of an invalid download by the
+PDF harvester
+"""
+
+import io
+import os
+import gzip
+import base64
+import shutil
+import hashlib
+import tarfile
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from arxiv_harvester import integrity
+from arxiv_harvester.integrity import IntegrityError, StreamValidator, ValidatingReader
+
+PDF = b"%PDF-1.5\n" + b"1 0 obj << /Type /Catalog >> endobj\n" * 200 + b"trailer\n%%EOF\n"
+
+def _tar_gz(files):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        for name, data in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+def _validate(data, chunk_size=100, **kwargs):
+    validator = StreamValidator(**kwargs)
+    for i in range(0, len(data), chunk_size):
+        validator.update(data[i:i + chunk_size])
+    validator.finish()
+
+class TestPdfChecks(unittest.TestCase):
+
+    def test_valid_pdf(self):
+        _validate(PDF, kind="pdf")
+        integrity.check_pdf(PDF)
+
+    def test_truncated_pdf(self):
+        with self.assertRaises(IntegrityError) as context:
+            _validate(PDF[:len(PDF) // 2], kind="pdf")
+        self.assertEqual(context.exception.reason, "pdf_eof")
+
+    def test_html_error_page(self):
+        # an error page served with a status 200, detected at the first chunk
+        page = b"<!DOCTYPE html>\n<html><head><title>Service unavailable</title></head><body>Try again later</body></html>\n"
+        validator = StreamValidator("pdf")
+        with self.assertRaises(IntegrityError) as context:
+            validator.update(page)
+        self.assertEqual(context.exception.reason, "pdf_header")
+
+    def test_missing_header(self):
+        with self.assertRaises(IntegrityError) as context:
+            integrity.check_pdf(b"\x00" * 2048 + b"%%EOF\n")
+        self.assertEqual(context.exception.reason, "pdf_header")
+
+class TestLengthAndHashChecks(unittest.TestCase):
+
+    def test_content_length_mismatch(self):
+        _validate(PDF, kind="pdf", expected_length=len(PDF))
+        with self.assertRaises(IntegrityError) as context:
+            _validate(PDF, kind="pdf", expected_length=len(PDF) + 1)
+        self.assertEqual(context.exception.reason, "length")
+
+    def test_response_checks(self):
+        md5 = hashlib.md5(PDF).digest()
+        headers = {"Content-Length": str(len(PDF)), "x-goog-hash": "crc32c=n03x6A==,md5=" + base64.b64encode(md5).decode()}
+        self.assertEqual(integrity.response_checks(headers), (len(PDF), md5.hex()))
+        # the length and the hash of an encoded content are not the ones of the decoded content
+        headers['Content-Encoding'] = "gzip"
+        self.assertEqual(integrity.response_checks(headers), (None, None))
+        self.assertEqual(integrity.response_checks({}), (None, None))
+
+    def test_goog_hash_md5_mismatch(self):
+        header = "md5=" + base64.b64encode(hashlib.md5(b"other content").digest()).decode()
+        with self.assertRaises(IntegrityError) as context:
+            _validate(PDF, md5=integrity.goog_hash_md5(header))
+        self.assertEqual(context.exception.reason, "md5")
+
+    def test_multipart_etag_skips_md5(self):
+        self.assertIsNone(integrity.etag_md5('"d41d8cd98f00b204e9800998ecf8427e-12"'))
+        # no md5 check then, whatever the content
+        _validate(PDF, md5=integrity.etag_md5("d41d8cd98f00b204e9800998ecf8427e-12"))
+
+    def test_kms_etag_skips_md5(self):
+        self.assertIsNone(integrity.etag_md5(hashlib.md5(b"other content").hexdigest(), "aws:kms"))
+        self.assertEqual(integrity.etag_md5(hashlib.md5(PDF).hexdigest(), "AES256"), hashlib.md5(PDF).hexdigest())
+
+    def test_single_part_etag(self):
+        etag = '"' + hashlib.md5(PDF).hexdigest() + '"'
+        _validate(PDF, md5=integrity.etag_md5(etag))
+        with self.assertRaises(IntegrityError) as context:
+            _validate(PDF[:-1], md5=integrity.etag_md5(etag))
+        self.assertEqual(context.exception.reason, "md5")
+
+    def test_invalid_etag(self):
+        self.assertIsNone(integrity.etag_md5(None))
+        self.assertIsNone(integrity.etag_md5("not-a-md5"))
+        self.assertIsNone(integrity.etag_md5("z" * 32))
+
+    def test_check_file(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, "archive.tar")
+            with open(path, "wb") as the_file:
+                the_file.write(PDF)
+            integrity.check_file(path, expected_length=len(PDF), md5=hashlib.md5(PDF).hexdigest(), kind="pdf")
+            with self.assertRaises(IntegrityError) as context:
+                integrity.check_file(path, expected_length=len(PDF) * 2)
+            self.assertEqual(context.exception.reason, "length")
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_validating_reader(self):
+        # the bytes not read by the consumer are read by finish()
+        reader = ValidatingReader(io.BytesIO(PDF), StreamValidator(expected_length=len(PDF), md5=hashlib.md5(PDF).hexdigest()))
+        reader.read(100)
+        reader.finish()
+        self.assertEqual(reader.validator.nb_bytes, len(PDF))
+
+        reader = ValidatingReader(io.BytesIO(PDF[:-10]), StreamValidator(expected_length=len(PDF)))
+        with self.assertRaises(IntegrityError) as context:
+            reader.finish()
+        self.assertEqual(context.exception.reason, "length")
+
+class TestGzipChecks(unittest.TestCase):
+
+    def test_valid_gzip(self):
+        data = gzip.compress(os.urandom(300000))
+        _validate(data, chunk_size=4096, kind="gzip")
+        # several gzip members
+        _validate(data + gzip.compress(b"second member"), chunk_size=4096, kind="gzip")
+
+    def test_corrupt_gzip(self):
+        data = bytearray(gzip.compress(b"\\documentclass{article}\n" * 1000))
+        data[len(data) // 2] ^= 0xff
+        with self.assertRaises(IntegrityError) as context:
+            _validate(bytes(data), kind="gzip")
+        self.assertEqual(context.exception.reason, "gzip")
+
+    def test_truncated_gzip(self):
+        data = gzip.compress(os.urandom(10000))
+        with self.assertRaises(IntegrityError) as context:
+            _validate(data[:-100], kind="gzip")
+        self.assertEqual(context.exception.reason, "gzip")
+
+    def test_source_members(self):
+        member = _tar_gz([("main.tex", b"\\documentclass{article}\n" * 100), ("figure.eps", os.urandom(5000))])
+        integrity.check_source_member(member, "tar.gz")
+        integrity.check_source_member(gzip.compress(b"\\documentclass{article}\n"), "tex")
+        integrity.check_source_member(PDF, "pdf")
+
+    def test_corrupt_tar_member(self):
+        # valid gzip content, but truncated tar archive
+        tar_data = gzip.decompress(_tar_gz([("main.tex", b"x" * 5000)]))
+        with self.assertRaises(IntegrityError) as context:
+            integrity.check_source_member(gzip.compress(tar_data[:3000]), "tar.gz")
+        self.assertEqual(context.exception.reason, "tar")
+
+        with self.assertRaises(IntegrityError) as context:
+            integrity.check_source_member(gzip.compress(b"\x01" * 2048), "tar.gz")
+        self.assertEqual(context.exception.reason, "tar")
+
+    def test_truncated_pdf_member(self):
+        with self.assertRaises(IntegrityError) as context:
+            integrity.check_source_member(PDF[:100], "pdf")
+        self.assertEqual(context.exception.reason, "pdf_eof")
+
+    def test_content_kind(self):
+        self.assertEqual(integrity.content_kind("https://storage.googleapis.com/arxiv/pdf/2101/2101.00001v1.pdf"), "pdf")
+        self.assertEqual(integrity.content_kind("arxiv/ps/2101/2101.00001v1.ps.gz"), "gzip")
+        self.assertIsNone(integrity.content_kind("2101.00001.json"))
+
+class _PdfHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append(self.path)
+        if not self.path.endswith(".pdf"):
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(self.server.content)))
+        self.end_headers()
+        self.wfile.write(self.server.content)
+
+class TestInvalidEntry(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _PdfHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.data_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.data_path)
+
+    def _harvester(self):
+        from arxiv_harvester.harvester import ArXivHarvester
+        config = {"data_path": self.data_path, "compression": False, "integrity_retries": 1, "hedge_budget": 0,
+                  "gcs_base": "http://127.0.0.1:" + str(self.server.server_address[1]) + "/"}
+        return ArXivHarvester(config)
+
+    def _is_committed(self, harvester, identifier):
+        with harvester.env.begin() as txn:
+            return txn.get(identifier.encode()) is not None
+
+    def test_invalid_download_recorded_not_committed(self):
+        harvester = self._harvester()
+        entry = {"id": "2101.00001", "versions": ["v1"]}
+        # truncated PDF served with a status 200 and a matching Content-Length
+        self.server.content = PDF[:len(PDF) // 2]
+        harvester.process_entry(entry)
+        harvester._flush_storage()
+
+        self.assertFalse(self._is_committed(harvester, "2101.00001"))
+        failures = harvester.get_failures()
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(failures[0]['id'], "2101.00001")
+        self.assertEqual(failures[0]['reason'], "pdf_eof")
+        self.assertEqual(failures[0]['attempts'], 1)
+        # downloaded again once before giving up
+        self.assertEqual(self.server.requests, ["/arxiv/pdf/2101/2101.00001v1.pdf"] * 2)
+        # the invalid file is not left under data_path
+        self.assertFalse(os.path.exists(os.path.join(self.data_path, "2101.00001.pdf")))
+
+        # valid at the next run, the failure is cleared
+        self.server.content = PDF
+        harvester.process_entry(entry)
+        harvester._flush_storage()
+        self.assertTrue(self._is_committed(harvester, "2101.00001"))
+        self.assertEqual(harvester.get_failures(), [])
+
+if __name__ == '__main__':
+    unittest.main()
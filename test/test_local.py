@@ -0,0 +1,137 @@
+"""
+Storage of the files on the local file system, published with an atomic rename
+"""
+
+import io
+import os
+import errno
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from arxiv_harvester import local
+from arxiv_harvester.local import Local
+
+CONTENT = b"%PDF-1.5\n" + os.urandom(300000) + b"\n%%EOF\n"
+
+class TestLocal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.data_path = os.path.join(self.tmp_dir, "data")
+        self.source = os.path.join(self.tmp_dir, "2101.00001.pdf")
+        with open(self.source, "wb") as the_file:
+            the_file.write(CONTENT)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _local(self, **kwargs):
+        config = {"data_path": self.data_path}
+        config.update(kwargs)
+        return Local(config)
+
+    def _dest_files(self):
+        # all the files under the destination directory, including the hidden ones
+        return sorted(os.listdir(os.path.join(self.data_path, "arxiv", "2101", "2101.00001")))
+
+    def _read(self, path):
+        with open(path, "rb") as the_file:
+            return the_file.read()
+
+    def test_store_file_moved(self):
+        destination = self._local(local_fsync="full").store_file(self.source, "arxiv/2101/2101.00001")
+        self.assertEqual(destination, os.path.join(self.data_path, "arxiv/2101/2101.00001", "2101.00001.pdf"))
+        self.assertEqual(self._read(destination), CONTENT)
+        self.assertFalse(os.path.exists(self.source))
+        self.assertEqual(self._dest_files(), ["2101.00001.pdf"])
+
+    def test_store_file_copied(self):
+        destination = self._local().store_file(self.source, "arxiv/2101/2101.00001", "paper.pdf", move=False)
+        self.assertEqual(self._read(destination), CONTENT)
+        self.assertTrue(os.path.exists(self.source))
+        self.assertEqual(self._dest_files(), ["paper.pdf"])
+
+    def test_store_file_across_devices(self):
+        # the rename of the source fails as on another file system, the file is then copied into
+        # a staging file, itself renamed to the final path
+        replace = os.replace
+        calls = []
+        def cross_device_replace(src, dst):
+            calls.append((src, dst))
+            if src == self.source:
+                raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+            return replace(src, dst)
+
+        with mock.patch.object(local.os, "replace", side_effect=cross_device_replace):
+            destination = self._local(local_fsync="file").store_file(self.source, "arxiv/2101/2101.00001")
+
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(calls[0], (self.source, destination))
+        staging, final = calls[1]
+        self.assertEqual(final, destination)
+        self.assertEqual(os.path.dirname(staging), os.path.dirname(destination))
+        self.assertTrue(os.path.basename(staging).startswith(".2101.00001.pdf."))
+        self.assertTrue(staging.endswith(".tmp"))
+
+        self.assertEqual(self._read(destination), CONTENT)
+        self.assertFalse(os.path.exists(self.source))
+        self.assertEqual(self._dest_files(), ["2101.00001.pdf"])
+
+    def test_store_file_other_error(self):
+        def failing_replace(src, dst):
+            raise OSError(errno.EACCES, os.strerror(errno.EACCES))
+        with mock.patch.object(local.os, "replace", side_effect=failing_replace):
+            with self.assertRaises(OSError):
+                self._local().store_file(self.source, "arxiv/2101/2101.00001")
+        self.assertTrue(os.path.exists(self.source))
+        self.assertEqual(self._dest_files(), [])
+
+    def test_failed_copy_cleaned(self):
+        # no staging file left when the copy fails
+        with mock.patch.object(local, "_copy_file_data", side_effect=OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))):
+            with self.assertRaises(OSError):
+                self._local().store_file(self.source, "arxiv/2101/2101.00001", move=False)
+        self.assertEqual(self._dest_files(), [])
+        self.assertTrue(os.path.exists(self.source))
+
+    def test_buffered_copy(self):
+        # neither clone nor copy_file_range available
+        with mock.patch.object(local.fcntl, "ioctl", side_effect=OSError(errno.EOPNOTSUPP, os.strerror(errno.EOPNOTSUPP))), \
+             mock.patch.object(local.os, "copy_file_range", side_effect=OSError(errno.EXDEV, os.strerror(errno.EXDEV)), create=True):
+            destination = self._local().store_file(self.source, "arxiv/2101/2101.00001", move=False)
+        self.assertEqual(self._read(destination), CONTENT)
+        self.assertEqual(self._dest_files(), ["2101.00001.pdf"])
+
+    def test_store_fileobj(self):
+        store = self._local(local_fsync="full")
+        destination = store.store_fileobj(io.BytesIO(CONTENT), "arxiv/2101/2101.00001", "2101.00001.zip")
+        self.assertEqual(self._read(destination), CONTENT)
+        # replaced atomically by a new version
+        destination = store.store_fileobj(io.BytesIO(b"new version"), "arxiv/2101/2101.00001", "2101.00001.zip")
+        self.assertEqual(self._read(destination), b"new version")
+        self.assertEqual(self._dest_files(), ["2101.00001.zip"])
+
+    def test_failed_fileobj_cleaned(self):
+        class _FailingReader(object):
+            def read(self, size=-1):
+                raise IOError("connection reset")
+        store = self._local()
+        store.store_fileobj(io.BytesIO(CONTENT), "arxiv/2101/2101.00001", "2101.00001.zip")
+        with self.assertRaises(IOError):
+            store.store_fileobj(_FailingReader(), "arxiv/2101/2101.00001", "2101.00001.zip")
+        # the previous version is kept, without staging file
+        self.assertEqual(self._read(os.path.join(self.data_path, "arxiv/2101/2101.00001", "2101.00001.zip")), CONTENT)
+        self.assertEqual(self._dest_files(), ["2101.00001.zip"])
+
+    def test_staging_files_not_listed(self):
+        store = self._local()
+        store.store_file(self.source, "arxiv/2101/2101.00001")
+        with open(os.path.join(self.data_path, "arxiv/2101/2101.00001", ".2101.00001.json.0123.tmp"), "wb") as the_file:
+            the_file.write(b"{")
+        self.assertEqual(store.list_dirs("arxiv/"), ["arxiv/2101/"])
+        self.assertEqual(list(store.iter_objects("arxiv/")), [("arxiv/2101/2101.00001/2101.00001.pdf", len(CONTENT), None)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+"""
+Selection of the source archives from the arXiv source manifest
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from arxiv_harvester import manifest
+from arxiv_harvester.manifest import select_archives, _identifier_key, _month_key
+
+from s3_stand_in import S3StandInTestCase
+from source_archives import monthly_archive
+
+MANIFEST = """<?xml version='1.0' standalone='yes'?>
+<arXivSRC>
+  <file>
+    <content_md5sum>cacbfede21d5dfef26f367ec99384546</content_md5sum>
+    <filename>src/arXiv_src_9912_001.tar</filename>
+    <first_item>astro-ph9912001</first_item>
+    <last_item>quant-ph9912110</last_item>
+    <md5sum>949ae880fbaf4649a485a8d9e07f370b</md5sum>
+    <num_items>2490</num_items>
+    <seq_num>1</seq_num>
+    <size>225605507</size>
+    <timestamp>2010-12-23 00:13:59</timestamp>
+    <yymm>9912</yymm>
+  </file>
+  <file>
+    <filename>src/arXiv_src_0001_001.tar</filename>
+    <first_item>astro-ph0001001</first_item>
+    <last_item>quant-ph0001119</last_item>
+    <md5sum>5a7e1b2dd1a2fd9dcdd4e06af1cbb6a2</md5sum>
+    <num_items>2365</num_items>
+    <size>245605507</size>
+    <yymm>0001</yymm>
+  </file>
+  <file>
+    <filename>src/arXiv_src_2101_001.tar</filename>
+    <first_item>2101.00001</first_item>
+    <last_item>2101.00003</last_item>
+    <md5sum>0e5b8b4f1ae2c4bde0b5ff3e7d0e2f1a</md5sum>
+    <num_items>3</num_items>
+    <size>%d</size>
+    <yymm>2101</yymm>
+  </file>
+  <file>
+    <filename>src/arXiv_src_2102_001.tar</filename>
+    <first_item>2102.00001</first_item>
+    <last_item>2102.00002</last_item>
+    <md5sum>1f6c9c5f2bf3d5cef1c6006f4f1f3f2b</md5sum>
+    <num_items>2</num_items>
+    <size>%d</size>
+    <yymm>2102</yymm>
+  </file>
+</arXivSRC>
+"""
+
+def _archives(manifest_path):
+    return manifest.parse_manifest(manifest_path, prefix="src/")
+
+class TestIdentifierKey(unittest.TestCase):
+
+    def test_new_style(self):
+        self.assertEqual(_identifier_key("2101.00001"), (202101, 1))
+        self.assertEqual(_identifier_key("0704.0001v2"), (200704, 1))
+        self.assertEqual(_identifier_key("2101.00001"), _identifier_key("2101.00001v3"))
+
+    def test_old_style(self):
+        # identifiers and source item names, the category being ignored
+        self.assertEqual(_identifier_key("hep-th/9901001"), (199901, 1))
+        self.assertEqual(_identifier_key("hep-th9901001"), (199901, 1))
+        self.assertEqual(_identifier_key("math.AG/0001119"), (200001, 119))
+        self.assertLess(_identifier_key("quant-ph9912110"), _identifier_key("astro-ph0001001"))
+
+    def test_invalid(self):
+        self.assertEqual(_identifier_key("not an identifier"), (0, 0))
+
+    def test_month_key(self):
+        self.assertEqual(_month_key("9108"), 199108)
+        self.assertEqual(_month_key("9912"), 199912)
+        self.assertEqual(_month_key("0001"), 200001)
+        self.assertLess(_month_key("9912"), _month_key("0001"))
+
+class TestSelectArchives(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        manifest_path = os.path.join(self.tmp_dir, "arXiv_src_manifest.xml")
+        with open(manifest_path, "w") as the_file:
+            the_file.write(MANIFEST % (1000, 2000))
+        self.archives = _archives(manifest_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _select(self, **kwargs):
+        return [ archive['archive'] for archive in select_archives(self.archives, **kwargs) ]
+
+    def test_parse_manifest(self):
+        self.assertEqual(len(self.archives), 4)
+        self.assertEqual(self.archives[0], {"archive": "src/arXiv_src_9912_001.tar", "yymm": "9912", "first_item": "astro-ph9912001",
+                                            "last_item": "quant-ph9912110", "num_items": 2490, "size": 225605507,
+                                            "md5": "949ae880fbaf4649a485a8d9e07f370b"})
+        self.assertEqual(self.archives[3]['size'], 2000)
+
+    def test_no_selection(self):
+        self.assertEqual(len(self._select()), 4)
+
+    def test_months(self):
+        self.assertEqual(self._select(yymm="2101"), ["src/arXiv_src_2101_001.tar"])
+        self.assertEqual(self._select(yymm="2101, 9912"), ["src/arXiv_src_9912_001.tar", "src/arXiv_src_2101_001.tar"])
+        self.assertEqual(self._select(yymm="2103"), [])
+
+    def test_months_across_2000(self):
+        self.assertEqual(self._select(yymm="9912-0001"), ["src/arXiv_src_9912_001.tar", "src/arXiv_src_0001_001.tar"])
+        self.assertEqual(self._select(yymm="9901-2012"), ["src/arXiv_src_9912_001.tar", "src/arXiv_src_0001_001.tar"])
+        self.assertEqual(self._select(yymm="0001-2112"), ["src/arXiv_src_0001_001.tar", "src/arXiv_src_2101_001.tar", "src/arXiv_src_2102_001.tar"])
+
+    def test_identifier_range(self):
+        self.assertEqual(self._select(id_range="2101.00002:2101.05000"), ["src/arXiv_src_2101_001.tar"])
+        self.assertEqual(self._select(id_range="2101.00004:2102.00001"), ["src/arXiv_src_2102_001.tar"])
+        # old style identifiers, with or without category, across 1999 and 2000
+        self.assertEqual(self._select(id_range="hep-th/9912050:hep-th/0001001"), ["src/arXiv_src_9912_001.tar", "src/arXiv_src_0001_001.tar"])
+        self.assertEqual(self._select(id_range="hep-th0001120:2012.99999"), [])
+
+    def test_months_and_identifier_range(self):
+        self.assertEqual(self._select(yymm="9912-2101", id_range="0001001:2102.00001"), ["src/arXiv_src_0001_001.tar", "src/arXiv_src_2101_001.tar"])
+
+class TestManifestIndexing(S3StandInTestCase):
+
+    def setUp(self):
+        S3StandInTestCase.setUp(self)
+        self.data_path = tempfile.mkdtemp()
+        member_names, archive_2101 = monthly_archive("2101", [1, 2, 3])
+        member_names, archive_2102 = monthly_archive("2102", [1, 2])
+        self.s3.conn.put_object(Bucket=self.bucket_name, Key="src/arXiv_src_2101_001.tar", Body=archive_2101)
+        self.s3.conn.put_object(Bucket=self.bucket_name, Key="src/arXiv_src_2102_001.tar", Body=archive_2102)
+        self.s3.conn.put_object(Bucket=self.bucket_name, Key="src/arXiv_src_manifest.xml",
+                                Body=(MANIFEST % (len(archive_2101), len(archive_2102))).encode())
+
+    def tearDown(self):
+        shutil.rmtree(self.data_path)
+
+    def _harvester(self):
+        from arxiv_harvester.harvester_sources import ArXivSourceHarvester
+        config = {"data_path": self.data_path, "arxiv-source": self.s3_config(), "source_manifest": "src/arXiv_src_manifest.xml",
+                  "source_processes": 0, "stats_interval": 0}
+        return ArXivSourceHarvester(config)
+
+    def test_index_selected_months(self):
+        harvester = self._harvester()
+        # the archives are taken from the manifest, without listing the bucket
+        with mock.patch.object(harvester.s3_source, "get_s3_list") as get_s3_list:
+            harvester.index_sources(yymm="2102")
+        get_s3_list.assert_not_called()
+        self.assertTrue(harvester.is_archive_indexed("src/arXiv_src_2102_001.tar"))
+        self.assertFalse(harvester.is_archive_indexed("src/arXiv_src_2101_001.tar"))
+        self.assertFalse(os.path.exists(os.path.join(self.data_path, "list_source_files.txt")))
+
+        with mock.patch.object(harvester.s3_source, "get_s3_list") as get_s3_list:
+            harvester.index_sources(id_range="2101.00002:2101.00002")
+        get_s3_list.assert_not_called()
+        self.assertTrue(harvester.is_archive_indexed("src/arXiv_src_2101_001.tar"))
+        self.assertIsNotNone(harvester.get_member_location("2101.00002"))
+
+    def test_index_without_manifest(self):
+        self.s3.conn.delete_object(Bucket=self.bucket_name, Key="src/arXiv_src_manifest.xml")
+        harvester = self._harvester()
+        with mock.patch.object(harvester.s3_source, "get_s3_list", return_value=["src/arXiv_src_2101_001.tar"]) as get_s3_list:
+            harvester.index_sources()
+        get_s3_list.assert_called_once_with("")
+        self.assertTrue(harvester.is_archive_indexed("src/arXiv_src_2101_001.tar"))
+        self.assertFalse(harvester.is_archive_indexed("src/arXiv_src_2102_001.tar"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+"""
+Priority scheduling of the entries to be harvested
+"""
+
+import os
+import time
+import random
+import shutil
+import tempfile
+import unittest
+import email.utils
+
+from arxiv_harvester.scheduler import HarvestScheduler
+
+DAY = 24 * 3600
+
+def _entry(identifier, timestamp, categories="math.AG", comments=None):
+    entry = {"id": identifier, "versions": ["v1"], "versions_dates": [email.utils.formatdate(timestamp, usegmt=True)],
+             "categories": categories}
+    if comments is not None:
+        entry["comments"] = comments
+    return entry
+
+class TestHarvestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.data_path = tempfile.mkdtemp()
+        self.scheduler = HarvestScheduler({"data_path": self.data_path, "schedule_categories": ["cs.CL"]})
+        self.now = int(time.time())
+
+    def tearDown(self):
+        shutil.rmtree(self.data_path)
+
+    def _entries(self, nb_fresh, nb_category, nb_default, nb_large):
+        # entries of every class, the older ones being more than a year old, each entry with its own
+        # date, in random order
+        entries = []
+        for i in range(nb_fresh):
+            entries.append(_entry("fresh-" + str(i), self.now - i * 60))
+        for i in range(nb_category):
+            entries.append(_entry("category-" + str(i), self.now - 400 * DAY - i * DAY, categories="cs.CL cs.AI"))
+        for i in range(nb_default):
+            entries.append(_entry("default-" + str(i), self.now - 400 * DAY - i * DAY))
+        for i in range(nb_large):
+            entries.append(_entry("large-" + str(i), self.now - 400 * DAY - i * DAY, comments="62 pages, 12 figures"))
+        random.Random(42).shuffle(entries)
+        return entries
+
+    def _classes(self, entries):
+        return [ entry["id"].split("-")[0] for entry in entries ]
+
+    def test_priority(self):
+        self.assertEqual(self.scheduler.priority(_entry("2101.00001", self.now - DAY))[0], "fresh")
+        self.assertEqual(self.scheduler.priority(_entry("2101.00001", self.now - 40 * DAY, categories="cs.CL"))[0], "category")
+        self.assertEqual(self.scheduler.priority(_entry("2101.00001", self.now - 40 * DAY, comments="12 pages"))[0], "default")
+        self.assertEqual(self.scheduler.priority(_entry("2101.00001", self.now - 40 * DAY, comments="120 pages"))[0], "large")
+        # date from the identifier without version dates
+        self.assertEqual(self.scheduler.priority({"id": "0704.0001"})[0], "default")
+
+    def test_weighted_interleave(self):
+        scheduled = list(self.scheduler.schedule(self._entries(80, 40, 20, 10)))
+        self.assertEqual(len(scheduled), 150)
+        classes = self._classes(scheduled)
+        # every round of 15 entries has 8 fresh, 4 category, 2 default and 1 large entries
+        for start in range(0, 150, 15):
+            window = classes[start:start + 15]
+            self.assertEqual([ window.count(name) for name in ["fresh", "category", "default", "large"] ], [8, 4, 2, 1])
+        # the spool is removed once the entries are scheduled
+        self.assertFalse(os.path.exists(os.path.join(self.data_path, "schedule")))
+
+    def test_no_class_starves(self):
+        # a large backlog of fresh entries does not delay the other classes
+        classes = self._classes(self.scheduler.schedule(self._entries(1000, 3, 3, 3)))
+        self.assertEqual(len(classes), 1009)
+        # the k-th entry of the lowest class is served within the first k rounds of 15 entries
+        positions = [ i for i, name in enumerate(classes) if name == "large" ]
+        for k, position in enumerate(positions):
+            self.assertLess(position, 15 * (k + 1))
+        self.assertEqual(classes[:15].count("category"), 3)
+        # once the other classes are empty, the fresh entries take all the share
+        self.assertEqual(classes[30:], ["fresh"] * 979)
+
+    def test_newest_first_in_class(self):
+        scheduled = list(self.scheduler.schedule(self._entries(80, 40, 20, 10)))
+        for name in ["fresh", "category", "default", "large"]:
+            identifiers = [ entry["id"] for entry in scheduled if entry["id"].startswith(name + "-") ]
+            self.assertEqual(identifiers, [ name + "-" + str(i) for i in range(len(identifiers)) ])
+
+    def test_zero_weight(self):
+        scheduler = HarvestScheduler({"data_path": self.data_path, "schedule_categories": ["cs.CL"], "schedule_weights": {"large": 0}})
+        classes = self._classes(scheduler.schedule(self._entries(8, 4, 2, 1)))
+        self.assertEqual(len(classes), 14)
+        self.assertNotIn("large", classes)
+
+if __name__ == '__main__':
+    unittest.main()
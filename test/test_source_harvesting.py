@@ -0,0 +1,130 @@
+"""
+Harvesting of source archives downloaded from S3 before their processing, against a local S3
+stand-in (moto server)
+"""
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+
+from arxiv_harvester.harvester_sources import ArXivSourceHarvester
+
+from s3_stand_in import S3StandInTestCase
+from source_archives import monthly_archive
+
+ARCHIVE = "src/arXiv_src_2101_001.tar"
+
+class _SourceHarvestingTestCase(S3StandInTestCase):
+
+    def setUp(self):
+        S3StandInTestCase.setUp(self)
+        self.data_path = tempfile.mkdtemp()
+        member_names, self.archive_data = monthly_archive("2101", [1, 2, 3])
+        self.s3.conn.put_object(Bucket=self.bucket_name, Key=ARCHIVE, Body=self.archive_data)
+        self.file_list = os.path.join(self.data_path, "archives.txt")
+        with open(self.file_list, "w") as the_file:
+            the_file.write(ARCHIVE + "\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.data_path)
+
+    def _harvester(self, **kwargs):
+        config = {"data_path": self.data_path, "arxiv-source": self.s3_config(), "source_manifest": "",
+                  "source_processes": 0, "stats_interval": 0}
+        config.update(kwargs)
+        return ArXivSourceHarvester(config)
+
+class TestArchiveDiskBudget(_SourceHarvestingTestCase):
+
+    def _harvest_without_head(self, harvester):
+        # the HEAD request of the archive fails
+        with mock.patch.object(harvester.s3_source, "get_object_head", return_value=None), \
+             mock.patch.object(harvester.disk_budget, "acquire", wraps=harvester.disk_budget.acquire) as acquire:
+            harvester.harvest_sources(file_list=self.file_list)
+        return [ call.args[0] for call in acquire.call_args_list ]
+
+    def test_size_from_head(self):
+        harvester = self._harvester()
+        with mock.patch.object(harvester.disk_budget, "acquire", wraps=harvester.disk_budget.acquire) as acquire:
+            harvester.harvest_sources(file_list=self.file_list)
+        self.assertEqual([ call.args[0] for call in acquire.call_args_list ], [len(self.archive_data)])
+        self.assertTrue(harvester._is_archive_done(ARCHIVE))
+        # released once processed
+        self.assertEqual(harvester.disk_budget.used, 0)
+
+    def test_size_from_manifest(self):
+        harvester = self._harvester()
+        harvester.planned_archives[ARCHIVE] = {"archive": ARCHIVE, "size": 123456, "md5": None}
+        self.assertEqual(self._harvest_without_head(harvester), [123456])
+        self.assertTrue(harvester._is_archive_done(ARCHIVE))
+
+    def test_size_estimate(self):
+        harvester = self._harvester(archive_size_estimate=500 * 1024 * 1024)
+        self.assertEqual(self._harvest_without_head(harvester), [500 * 1024 * 1024])
+        self.assertTrue(harvester._is_archive_done(ARCHIVE))
+
+    def test_unknown_size_skipped(self):
+        harvester = self._harvester()
+        with mock.patch.object(harvester.s3_source, "download_file") as download_file:
+            self.assertEqual(self._harvest_without_head(harvester), [])
+        download_file.assert_not_called()
+        self.assertFalse(harvester._is_archive_done(ARCHIVE))
+
+class TestResumeAndRetry(_SourceHarvestingTestCase):
+
+    def _store_buffer(self, harvester, failing=()):
+        # store_buffer of the harvester failing for the given papers, the identifiers of the papers
+        # being recorded
+        stored = []
+        store_buffer = harvester._store_buffer
+        def _store_buffer(buffer, file_name, identifier):
+            stored.append(identifier)
+            if identifier in failing:
+                return False
+            return store_buffer(buffer, file_name, identifier)
+        return mock.patch.object(harvester, "_store_buffer", side_effect=_store_buffer), stored
+
+    def test_resume_skips_stored_papers(self):
+        harvester = self._harvester()
+        archive_path = os.path.join(self.data_path, "arXiv_src_2101_001.tar")
+        with open(archive_path, "wb") as the_file:
+            the_file.write(self.archive_data)
+
+        patch, stored = self._store_buffer(harvester, failing=["2101.00002"])
+        with patch:
+            self.assertEqual(harvester.process_archive(ARCHIVE, archive_path), 2)
+        self.assertEqual(stored, ["2101.00001", "2101.00002", "2101.00003"])
+        self.assertEqual(harvester.get_paper_status("2101.00002")['status'], "failed")
+
+        # the papers already stored are not processed again, but count in the archive
+        patch, stored = self._store_buffer(harvester)
+        with patch:
+            self.assertEqual(harvester.process_archive(ARCHIVE, archive_path), 3)
+        self.assertEqual(stored, ["2101.00002"])
+        for identifier in ["2101.00001", "2101.00002", "2101.00003"]:
+            self.assertEqual(harvester.get_paper_status(identifier)['status'], "stored")
+
+    def test_retry_failed_papers(self):
+        harvester = self._harvester()
+        patch, stored = self._store_buffer(harvester, failing=["2101.00002"])
+        with patch:
+            harvester.harvest_sources(file_list=self.file_list)
+        self.assertTrue(harvester._is_archive_done(ARCHIVE))
+        self.assertEqual(harvester.get_failed_archives(), [ARCHIVE])
+
+        # only the failed paper of the archive is processed again
+        patch, stored = self._store_buffer(harvester)
+        with patch:
+            harvester.harvest_sources(retry_failed=True)
+        self.assertEqual(stored, ["2101.00002"])
+        self.assertEqual(harvester.get_paper_status("2101.00002")['status'], "stored")
+        self.assertEqual(harvester.get_failed_archives(), [])
+        with zipfile.ZipFile(io.BytesIO(harvester.get_source_zip("2101.00002"))) as zip_file:
+            self.assertIn(b"2101.00002", zip_file.read("main.tex"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+"""
+Byte-range index of the source archives, built by scanning only the tar headers with ranged GETs
+"""
+
+import io
+import os
+import tarfile
+import unittest
+
+from arxiv_harvester.source_index import RangedReader, scan_archive, member_locations
+
+from source_archives import source_archive
+
+ARCHIVE = "src/arXiv_src_2101_001.tar"
+
+class _RangedObjects(object):
+    # S3 backend serving ranged GETs of objects held in memory, the requested ranges being recorded
+
+    def __init__(self, objects):
+        self.objects = objects
+        self.ranges = []
+
+    def get_object_size(self, file_path):
+        if file_path not in self.objects:
+            return None
+        return len(self.objects[file_path])
+
+    def get_object_range(self, file_path, start, end):
+        if file_path not in self.objects:
+            return None
+        self.ranges.append((start, end))
+        return self.objects[file_path][start:end + 1]
+
+class TestSourceIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.contents = {}
+        for number in range(1, 6):
+            self.contents["2101/2101.%05d.gz" % number] = os.urandom(200000 + number)
+        self.contents["2101/2101.00006.pdf"] = b"%PDF-1.5\n" + os.urandom(100000) + b"\n%%EOF\n"
+        members = list(self.contents.items())
+        # not a source member
+        members.insert(0, ("2101/README", b"arXiv sources of 2101\n"))
+        self.data = source_archive(members)
+        self.s3 = _RangedObjects({ARCHIVE: self.data})
+
+    def test_scan_archive(self):
+        members = scan_archive(self.s3, ARCHIVE)
+        self.assertEqual(len(members), 7)
+
+        locations = member_locations(ARCHIVE, members)
+        self.assertEqual([ identifier for identifier, location in locations ], [ "2101.%05d" % number for number in range(1, 7) ])
+        for identifier, location in locations:
+            self.assertEqual(location['archive'], ARCHIVE)
+            offset, size = location['offset'], location['size']
+            self.assertEqual(self.data[offset:offset + size], self.contents[location['member']])
+
+    def test_only_headers_fetched(self):
+        reader = RangedReader(self.s3, ARCHIVE, len(self.data), block_size=4096)
+        with tarfile.open(fileobj=reader, mode="r:") as tar:
+            self.assertEqual(len(tar.getmembers()), 7)
+        # one small block per member header, instead of the whole archive
+        self.assertLess(reader.bytes_fetched, len(self.data) / 20)
+        self.assertEqual(reader.bytes_fetched, sum(end - start + 1 for start, end in self.s3.ranges))
+
+    def test_ranged_reader(self):
+        reader = RangedReader(self.s3, ARCHIVE, len(self.data), block_size=1024)
+        self.assertEqual(reader.read(10), self.data[:10])
+        # within the same block, no new GET
+        self.assertEqual(reader.read(100), self.data[10:110])
+        self.assertEqual(len(self.s3.ranges), 1)
+        # a read larger than a block is fetched at once
+        reader.seek(5000)
+        self.assertEqual(reader.read(3000), self.data[5000:8000])
+        self.assertEqual(self.s3.ranges[-1], (5000, 7999))
+        reader.seek(-10, io.SEEK_END)
+        self.assertEqual(reader.read(), self.data[-10:])
+        self.assertEqual(reader.read(), b"")
+        self.assertEqual(reader.tell(), len(self.data))
+
+    def test_missing_archive(self):
+        self.assertIsNone(scan_archive(self.s3, "src/arXiv_src_2102_001.tar"))
+        reader = RangedReader(self.s3, "src/arXiv_src_2102_001.tar", 1000)
+        with self.assertRaises(IOError):
+            reader.read(10)
+
+if __name__ == '__main__':
+    unittest.main()
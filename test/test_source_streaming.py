@@ -0,0 +1,117 @@
+"""
+Streaming of the source archives from S3 (harvest_sources in streaming mode), against a local S3
+stand-in (moto server)
+"""
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+
+import arxiv_harvester.integrity as integrity
+from arxiv_harvester.harvester_sources import ArXivSourceHarvester
+
+from s3_stand_in import S3StandInTestCase
+from source_archives import monthly_archive
+
+ARCHIVE = "src/arXiv_src_2101_001.tar"
+
+class _TruncatedBody(object):
+    # S3 response body closed by the server before its end, without error
+
+    def __init__(self, body, nb_bytes):
+        self.body = body
+        self.remaining = nb_bytes
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.body.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.body.close()
+
+class TestSourceStreaming(S3StandInTestCase):
+
+    def setUp(self):
+        S3StandInTestCase.setUp(self)
+        self.data_path = tempfile.mkdtemp()
+        member_names, self.archive_data = monthly_archive("2101", [1, 2, 3])
+        self.s3.conn.put_object(Bucket=self.bucket_name, Key=ARCHIVE, Body=self.archive_data)
+        self.file_list = os.path.join(self.data_path, "archives.txt")
+        with open(self.file_list, "w") as the_file:
+            the_file.write(ARCHIVE + "\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.data_path)
+
+    def _harvester(self):
+        config = {"data_path": self.data_path, "arxiv-source": self.s3_config(), "source_manifest": "",
+                  "source_processes": 0, "stats_interval": 0}
+        return ArXivSourceHarvester(config)
+
+    def _staged_files(self):
+        # archives or staging files left under data_path
+        staged = []
+        for root, dirs, files in os.walk(self.data_path):
+            for name in files:
+                if name.startswith("arXiv_src_") or name.endswith(".tmp"):
+                    staged.append(os.path.join(root, name))
+        return staged
+
+    def test_archive_streamed(self):
+        harvester = self._harvester()
+        harvester.harvest_sources(file_list=self.file_list, streaming=True)
+
+        for identifier in ["2101.00001", "2101.00002", "2101.00003"]:
+            self.assertEqual(harvester.get_paper_status(identifier)['status'], "stored")
+            with zipfile.ZipFile(io.BytesIO(harvester.get_source_zip(identifier))) as zip_file:
+                self.assertIn(identifier.encode(), zip_file.read("main.tex"))
+        self.assertTrue(harvester._is_archive_done(ARCHIVE))
+        with harvester.env_source.begin() as txn:
+            self.assertEqual(txn.get(ARCHIVE.encode()), b"3")
+        # the members are indexed as they are read
+        self.assertTrue(harvester.is_archive_indexed(ARCHIVE))
+        self.assertEqual(self._staged_files(), [])
+
+    def test_truncated_stream_not_committed(self):
+        harvester = self._harvester()
+        get_object_stream = harvester.s3_source.get_object_stream
+        # the body ends in the padding after the end of the tar archive, so that the tar reader
+        # does not notice the truncation
+        def truncated_stream(file_path):
+            return _TruncatedBody(get_object_stream(file_path), len(self.archive_data) - 1024)
+
+        # errors raised by the validation of the stream once the tar archive is read
+        errors = []
+        def finish(reader):
+            try:
+                original_finish(reader)
+            except Exception as e:
+                errors.append(e)
+                raise
+
+        original_finish = integrity.ValidatingReader.finish
+        with mock.patch.object(harvester.s3_source, "get_object_stream", side_effect=truncated_stream), \
+             mock.patch.object(integrity.ValidatingReader, "finish", autospec=True, side_effect=finish):
+            harvester.harvest_sources(file_list=self.file_list, streaming=True)
+
+        self.assertEqual(len(errors), 1)
+        self.assertIsInstance(errors[0], integrity.IntegrityError)
+        self.assertEqual(errors[0].reason, "length")
+        self.assertFalse(harvester._is_archive_done(ARCHIVE))
+        self.assertEqual(self._staged_files(), [])
+
+        # processed again by the next run, the papers already stored being skipped
+        harvester.harvest_sources(file_list=self.file_list, streaming=True)
+        self.assertTrue(harvester._is_archive_done(ARCHIVE))
+        with harvester.env_source.begin() as txn:
+            self.assertEqual(txn.get(ARCHIVE.encode()), b"3")
+
+if __name__ == '__main__':
+    unittest.main()
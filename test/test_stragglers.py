@@ -0,0 +1,184 @@
+"""
+Hedged requests and deadlines of the entries (stragglers module)
+"""
+
+import time
+import threading
+import unittest
+from unittest import mock
+
+from arxiv_harvester.stragglers import Cancellation, Cancelled, DeadlineWatchdog, HedgeBudget, hedged_call
+
+# delay before the hedge of the tests, and max time waited for an event
+DELAY = 0.05
+TIMEOUT = 5
+
+def _wait_cancelled(cancellation):
+    # an attempt blocked until it is cancelled
+    if not cancellation._event.wait(TIMEOUT):
+        raise AssertionError("attempt not cancelled")
+    cancellation.check()
+
+class TestHedgedCall(unittest.TestCase):
+
+    def setUp(self):
+        self.budget = HedgeBudget(ratio=1.0, max_in_flight=1)
+        self.hedge_started = threading.Event()
+        self.tokens = {}
+
+    def _attempt(self, primary, hedge):
+        # func of hedged_call, running primary(cancellation) for the first attempt and
+        # hedge(cancellation) for the hedge
+        def func(attempt, cancellation):
+            self.tokens[attempt] = cancellation
+            if attempt == 0:
+                return primary(cancellation)
+            self.hedge_started.set()
+            return hedge(cancellation)
+        return func
+
+    def _after_hedge_started(self, result):
+        def primary(cancellation):
+            self.assertTrue(self.hedge_started.wait(TIMEOUT))
+            if isinstance(result, BaseException):
+                raise result
+            return result
+        return primary
+
+    def test_fast_primary_not_hedged(self):
+        func = self._attempt(lambda cancellation: "primary", lambda cancellation: "hedge")
+        self.assertEqual(hedged_call(func, 10, self.budget), (0, "primary"))
+        self.assertFalse(self.hedge_started.is_set())
+        self.assertEqual(self.budget.hedges, 0)
+
+    def test_primary_wins(self):
+        func = self._attempt(self._after_hedge_started("primary"), _wait_cancelled)
+        self.assertEqual(hedged_call(func, DELAY, self.budget), (0, "primary"))
+        # the hedge is cancelled, and its budget released once it ends
+        self.assertTrue(self.tokens[1].cancelled())
+        self.assertFalse(self.tokens[0].cancelled())
+        self._assert_released()
+
+    def test_hedge_wins(self):
+        func = self._attempt(_wait_cancelled, lambda cancellation: "hedge")
+        self.assertEqual(hedged_call(func, DELAY, self.budget), (1, "hedge"))
+        self.assertTrue(self.tokens[0].cancelled())
+        self.assertFalse(self.tokens[1].cancelled())
+        self._assert_released()
+
+    def test_primary_fails_hedge_succeeds(self):
+        primary_failed = threading.Event()
+        def primary(cancellation):
+            self.assertTrue(self.hedge_started.wait(TIMEOUT))
+            primary_failed.set()
+            raise ConnectionError("primary failed")
+        def hedge(cancellation):
+            self.assertTrue(primary_failed.wait(TIMEOUT))
+            return "hedge"
+        self.assertEqual(hedged_call(self._attempt(primary, hedge), DELAY, self.budget), (1, "hedge"))
+        self._assert_released()
+
+    def test_both_attempts_fail(self):
+        def hedge(cancellation):
+            raise ConnectionError("hedge failed")
+        func = self._attempt(self._after_hedge_started(ConnectionError("primary failed")), hedge)
+        with self.assertRaises(ConnectionError) as context:
+            hedged_call(func, DELAY, self.budget)
+        self.assertEqual(str(context.exception), "primary failed")
+        self._assert_released()
+
+    def test_hedge_denied_by_budget(self):
+        # no hedge allowed, the slow primary request is waited for
+        budget = HedgeBudget(ratio=0, max_in_flight=1)
+        def primary(cancellation):
+            time.sleep(DELAY * 4)
+            return "primary"
+        func = self._attempt(primary, lambda cancellation: "hedge")
+        self.assertEqual(hedged_call(func, DELAY, budget), (0, "primary"))
+        self.assertFalse(self.hedge_started.is_set())
+
+    def test_parent_cancelled(self):
+        parent = Cancellation()
+        def primary(cancellation):
+            self.assertTrue(self.hedge_started.wait(TIMEOUT))
+            parent.cancel("deadline exceeded")
+            return _wait_cancelled(cancellation)
+        func = self._attempt(primary, _wait_cancelled)
+        with self.assertRaises(Cancelled):
+            hedged_call(func, DELAY, self.budget, parent=parent)
+        self.assertTrue(self.tokens[1].cancelled())
+        self._assert_released()
+
+    def _assert_released(self):
+        # released by the hedge thread once the hedge returns
+        for i in range(int(TIMEOUT / 0.01)):
+            if self.budget.in_flight == 0:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.budget.in_flight, 0)
+
+class TestHedgeBudget(unittest.TestCase):
+
+    def test_ratio(self):
+        budget = HedgeBudget(ratio=0.1, max_in_flight=10)
+        self.assertFalse(budget.acquire())
+        for i in range(10):
+            budget.record_request()
+        self.assertTrue(budget.acquire())
+        budget.release()
+        # one hedge for 10 requests, even when the first one is finished
+        self.assertFalse(budget.acquire())
+        for i in range(10):
+            budget.record_request()
+        self.assertTrue(budget.acquire())
+        self.assertEqual(budget.hedges, 2)
+
+    def test_max_in_flight(self):
+        budget = HedgeBudget(ratio=1.0, max_in_flight=2)
+        for i in range(100):
+            budget.record_request()
+        self.assertTrue(budget.acquire())
+        self.assertTrue(budget.acquire())
+        self.assertFalse(budget.acquire())
+        budget.release()
+        self.assertTrue(budget.acquire())
+        self.assertEqual(budget.in_flight, 2)
+
+class TestDeadlineWatchdog(unittest.TestCase):
+
+    def test_expired_deadline_cancelled(self):
+        watchdog = DeadlineWatchdog(interval=0.01)
+        deadline = watchdog.track("entry 2101.00001", 0.05)
+        child = Cancellation(deadline)
+        interrupt = mock.Mock()
+        deadline.register(interrupt)
+        child_interrupt = mock.Mock()
+        child.register(child_interrupt)
+
+        self.assertTrue(child._event.wait(TIMEOUT))
+        self.assertTrue(deadline.cancelled())
+        interrupt.assert_called_once_with()
+        child_interrupt.assert_called_once_with()
+        with self.assertRaises(Cancelled) as context:
+            child.check()
+        self.assertIn("exceeded", str(context.exception))
+
+        # a child or an interrupt added once cancelled is cancelled or called immediately
+        late_interrupt = mock.Mock()
+        deadline.register(late_interrupt)
+        late_interrupt.assert_called_once_with()
+        self.assertTrue(Cancellation(deadline).cancelled())
+
+    def test_untracked_deadline_not_cancelled(self):
+        watchdog = DeadlineWatchdog(interval=0.01)
+        self.assertIsNone(watchdog.track("entry", None))
+        self.assertIsNone(watchdog.track("entry", 0))
+        deadline = watchdog.track("entry 2101.00001", 0.05)
+        watchdog.untrack(deadline)
+        # an expiring deadline, cancelled after the untracked one would have been
+        other = watchdog.track("entry 2101.00002", 0.05)
+        self.assertTrue(other._event.wait(TIMEOUT))
+        self.assertFalse(deadline.cancelled())
+
+if __name__ == '__main__':
+    unittest.main()
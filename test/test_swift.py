@@ -0,0 +1,329 @@
+"""
+Batched uploads to SWIFT, against a local stand-in of the SWIFT API (v1 auth, containers, objects
+and static large objects)
+"""
+
+import os
+import json
+import hashlib
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, unquote
+
+from unittest import mock
+
+from swiftclient.client import ClientException
+from swiftclient.service import SwiftError
+
+from arxiv_harvester.swift import Swift
+
+class FakeSwiftHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, headers=None, body=b""):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if len(body) > 0 and self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            data = b""
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return data
+                data += self.rfile.read(size)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _route(self):
+        # (container, object name, query) of an authorized storage request, None if replied
+        server = self.server
+        url = urlsplit(self.path)
+        if url.path == "/auth/v1.0":
+            with server.lock:
+                server.nb_auth += 1
+                token = "token-" + str(server.nb_auth)
+                server.tokens.add(token)
+            self._reply(200, {"X-Storage-Url": server.storage_url, "X-Auth-Token": token})
+            return None
+        if self.headers.get("X-Auth-Token") not in server.tokens:
+            self._body()
+            self._reply(401)
+            return None
+        parts = url.path[len("/v1/AUTH_test/"):].split("/", 1)
+        container = unquote(parts[0])
+        object_name = unquote(parts[1]) if len(parts) > 1 else None
+        return container, object_name, url.query
+
+    def do_HEAD(self):
+        route = self._route()
+        if route is None:
+            return
+        container, object_name, query = route
+        with self.server.lock:
+            if object_name is None and self.server.container_status is not None:
+                self._reply(self.server.container_status)
+            elif container not in self.server.containers:
+                self._reply(404)
+            elif object_name is None:
+                self._reply(204)
+            elif object_name in self.server.containers[container]:
+                self._reply(200, {"ETag": "0"})
+            else:
+                self._reply(404)
+
+    def do_GET(self):
+        route = self._route()
+        if route is not None:
+            self._reply(404)
+
+    def do_POST(self):
+        route = self._route()
+        if route is None:
+            return
+        container, object_name, query = route
+        with self.server.lock:
+            exists = container in self.server.containers
+        self._reply(204 if exists else 404)
+
+    def do_PUT(self):
+        route = self._route()
+        if route is None:
+            return
+        container, object_name, query = route
+        body = self._body()
+        server = self.server
+        with server.lock:
+            if object_name is None:
+                server.containers.setdefault(container, {})
+                self._reply(201)
+                return
+            server.puts[object_name] = server.puts.get(object_name, 0) + 1
+            failures = server.failures.get(object_name, 0)
+            if failures != 0:
+                # refused without retry by the client, the object is uploaded again by the next attempt
+                server.failures[object_name] = failures - 1
+                self._reply(422)
+                return
+            if container not in server.containers:
+                self._reply(404)
+                return
+            etag = hashlib.md5(body).hexdigest()
+            if "multipart-manifest=put" in query:
+                segments = json.loads(body.decode("UTF-8"))
+                server.manifests[object_name] = [ segment['path'] for segment in segments ]
+                # the ETag of a static large object is the MD5 of the ETags of its segments
+                etag = '"' + hashlib.md5("".join(segment['etag'] for segment in segments).encode()).hexdigest() + '"'
+            server.containers[container][object_name] = body
+        self._reply(201, {"ETag": etag})
+
+class FakeSwift(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self):
+        ThreadingHTTPServer.__init__(self, ("127.0.0.1", 0), FakeSwiftHandler)
+        self.lock = threading.Lock()
+        self.storage_url = "http://127.0.0.1:" + str(self.server_address[1]) + "/v1/AUTH_test"
+        self.nb_auth = 0
+        self.tokens = set()
+        self.containers = {}
+        # status of the container HEAD requests, if not the actual one
+        self.container_status = None
+        self.manifests = {}
+        # object name -> number of PUT requests
+        self.puts = {}
+        # object name -> number of next PUT requests to refuse, -1 for all
+        self.failures = {}
+
+class TestSwiftBatchUpload(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeSwift()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.callbacks = {}
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _swift(self, **kwargs):
+        config = {"data_path": self.tmp_dir, "swift_container": "arxiv", "swift_batch_max_delay": 300,
+                  "swift": {"auth": "http://127.0.0.1:" + str(self.server.server_address[1]) + "/auth/v1.0",
+                            "user": "test:tester", "key": "testing", "auth_version": "1.0"}}
+        config.update(kwargs)
+        return Swift(config)
+
+    def _files(self, prefix, n, size=10):
+        paths = []
+        for i in range(n):
+            path = os.path.join(self.tmp_dir, prefix + "-" + str(i) + ".pdf")
+            with open(path, "wb") as the_file:
+                the_file.write(os.urandom(size))
+            paths.append(path)
+        return paths
+
+    def _callback(self, name):
+        def callback(success):
+            self.callbacks[name] = success
+        return callback
+
+    def test_groups_uploaded_in_one_batch(self):
+        swift = self._swift()
+        groups = dict(("entry" + str(i), self._files("entry" + str(i), 2)) for i in range(5))
+        for name, paths in groups.items():
+            swift.add_files(paths, "arxiv/" + name, callback=self._callback(name), clean=True)
+        swift.close()
+
+        self.assertEqual(self.callbacks, dict((name, True) for name in groups))
+        objects = self.server.containers["arxiv"]
+        self.assertEqual(len(objects), 10)
+        for name, paths in groups.items():
+            for path in paths:
+                self.assertIn("arxiv/" + name + "/" + os.path.basename(path), objects)
+                self.assertFalse(os.path.exists(path))
+        # one authentication shared by the upload threads
+        self.assertEqual(self.server.nb_auth, 1)
+
+    def test_object_failure_reported_to_its_group(self):
+        swift = self._swift(swift_upload_max_attempts=3)
+        ok_paths = self._files("ok", 2)
+        failed_paths = self._files("failed", 2)
+        self.server.failures["failed/" + os.path.basename(failed_paths[1])] = -1
+        swift.add_files(ok_paths, "ok", callback=self._callback("ok"), clean=True)
+        swift.add_files(failed_paths, "failed", callback=self._callback("failed"), clean=True)
+        swift.close()
+
+        self.assertEqual(self.callbacks, {"ok": True, "failed": False})
+        # only the failed object is uploaded again, up to the max number of attempts
+        self.assertEqual(self.server.puts["failed/" + os.path.basename(failed_paths[1])], 3)
+        self.assertEqual(self.server.puts["failed/" + os.path.basename(failed_paths[0])], 1)
+        self.assertEqual(self.server.puts["ok/" + os.path.basename(ok_paths[0])], 1)
+        # the files of the failed group are kept for a later harvesting
+        for path in ok_paths:
+            self.assertFalse(os.path.exists(path))
+        for path in failed_paths:
+            self.assertTrue(os.path.exists(path))
+
+    def test_transient_failure_retried(self):
+        swift = self._swift()
+        paths = self._files("entry", 3)
+        object_name = "entry/" + os.path.basename(paths[2])
+        self.server.failures[object_name] = 1
+        swift.add_files(paths, "entry", callback=self._callback("entry"))
+        swift.close()
+
+        self.assertEqual(self.callbacks, {"entry": True})
+        self.assertEqual(self.server.puts[object_name], 2)
+        self.assertEqual(len(self.server.containers["arxiv"]), 3)
+
+    def test_large_object_uploaded_by_segments(self):
+        swift = self._swift(swift_segment_size=100)
+        large_path = self._files("large", 1, size=250)[0]
+        small_path = self._files("small", 1)[0]
+        swift.add_files([large_path, small_path], "entry", callback=self._callback("entry"))
+        swift.close()
+
+        self.assertEqual(self.callbacks, {"entry": True})
+        object_name = "entry/" + os.path.basename(large_path)
+        segments = self.server.manifests[object_name]
+        self.assertEqual(len(segments), 3)
+        content = b"".join(self.server.containers["arxiv_segments"][segment.split("/", 2)[2]] for segment in segments)
+        with open(large_path, "rb") as the_file:
+            self.assertEqual(content, the_file.read())
+        # the small object of the group is not segmented
+        self.assertNotIn("entry/" + os.path.basename(small_path), self.server.manifests)
+
+    def test_segment_failure_reported_to_its_group(self):
+        swift = self._swift(swift_segment_size=100, swift_upload_max_attempts=2)
+        large_path = self._files("large", 1, size=250)[0]
+        other_path = self._files("other", 1)[0]
+        # every upload of the manifest of the large object is refused
+        self.server.failures["entry/" + os.path.basename(large_path)] = -1
+        swift.add_files([large_path], "entry", callback=self._callback("large"))
+        swift.add_files([other_path], "other", callback=self._callback("other"))
+        swift.close()
+
+        self.assertEqual(self.callbacks, {"large": False, "other": True})
+        self.assertNotIn("entry/" + os.path.basename(large_path), self.server.manifests)
+
+    def test_rejected_token_renewed(self):
+        swift = self._swift()
+        paths = self._files("first", 1)
+        swift.add_files(paths, "first", callback=self._callback("first"))
+        swift.flush()
+        # the token expires before the end of its ttl
+        self.server.tokens.clear()
+        paths = self._files("second", 2)
+        swift.add_files(paths, "second", callback=self._callback("second"))
+        swift.close()
+
+        self.assertEqual(self.callbacks, {"first": True, "second": True})
+        self.assertEqual(len(self.server.containers["arxiv"]), 3)
+        self.assertGreaterEqual(self.server.nb_auth, 2)
+
+class TestSwiftContainer(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeSwift()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _swift(self):
+        return Swift({"data_path": self.tmp_dir, "swift_container": "arxiv",
+                      "swift": {"auth": "http://127.0.0.1:" + str(self.server.server_address[1]) + "/auth/v1.0",
+                                "user": "test:tester", "key": "testing", "auth_version": "1.0"}})
+
+    def test_missing_container_created(self):
+        swift = self._swift()
+        swift._ensure_container()
+        self.assertTrue(swift._container_checked)
+        self.assertIn("arxiv", self.server.containers)
+
+    def test_container_error_checked_again(self):
+        swift = self._swift()
+        self.server.container_status = 403
+        swift._ensure_container()
+        # not created, and checked again at the next upload
+        self.assertFalse(swift._container_checked)
+        self.assertNotIn("arxiv", self.server.containers)
+
+        self.server.container_status = None
+        swift._ensure_container()
+        self.assertTrue(swift._container_checked)
+        self.assertIn("arxiv", self.server.containers)
+
+    def test_stat_error_by_status(self):
+        for http_status in [401, 500]:
+            swift = self._swift()
+            error = SwiftError("stat failed", container="arxiv", exc=ClientException("stat failed", http_status=http_status))
+            with mock.patch("arxiv_harvester.swift.SwiftService.stat", side_effect=error), \
+                 mock.patch("arxiv_harvester.swift.SwiftService.post") as post, \
+                 mock.patch.object(swift, "_reauthenticate") as reauthenticate:
+                swift._ensure_container()
+            # only a missing container is created
+            post.assert_not_called()
+            self.assertEqual(reauthenticate.called, http_status == 401)
+            self.assertFalse(swift._container_checked)
+
+if __name__ == '__main__':
+    unittest.main()